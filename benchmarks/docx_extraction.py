@@ -0,0 +1,70 @@
+"""Compares streamed DOCX extraction against the old python-docx paragraph join.
+
+Usage: python benchmarks/docx_extraction.py [--pages 250] [--file existing.docx]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# The app module refuses to import without a key; the benchmark never calls the API
+os.environ.setdefault("GEMINI_API_KEY", "benchmark")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from docx import Document  # noqa: E402
+
+import streamlit_app  # noqa: E402
+
+PARAGRAPHS_PER_PAGE = 9
+SENTENCE = "The quick brown fox jumps over the lazy dog while the students take careful notes. "
+
+def legacy_extract_docx_text(file):
+    doc = Document(file)
+    return "\n".join([paragraph.text for paragraph in doc.paragraphs])
+
+def build_document(path, pages):
+    doc = Document()
+    doc.sections[0].header.paragraphs[0].text = "Benchmark header"
+    for page in range(pages):
+        doc.add_heading(f"Section {page + 1}", level=2)
+        for _ in range(PARAGRAPHS_PER_PAGE - 2):
+            doc.add_paragraph(SENTENCE * 6)
+        if page % 5 == 0:
+            table = doc.add_table(rows=4, cols=3)
+            for row in table.rows:
+                for cell in row.cells:
+                    cell.text = "cell value"
+        doc.add_page_break()
+    doc.save(path)
+
+def measure(label, function, path):
+    tracemalloc.start()
+    started = time.perf_counter()
+    text = function(path)
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{label:<12} {elapsed:8.2f} s  peak {peak / 1024 / 1024:8.1f} MB  {len(text):>10} chars")
+    return elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--pages", type=int, default=250)
+    parser.add_argument("--file", help="benchmark an existing .docx instead of a generated one")
+    args = parser.parse_args()
+    
+    with tempfile.TemporaryDirectory() as work_dir:
+        path = args.file
+        if not path:
+            path = os.path.join(work_dir, "benchmark.docx")
+            build_document(path, args.pages)
+            print(f"Generated {args.pages}-page document ({os.path.getsize(path) / 1024:.0f} KB)")
+        
+        legacy = measure("python-docx", legacy_extract_docx_text, path)
+        streamed = measure("streamed", streamlit_app.extract_docx_text, path)
+        print(f"Speedup: {legacy / streamed:.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,379 @@
+"""Simulates a class of concurrent sessions against a fake Gemini backend.
+
+Each simulated user logs in through check_password, toggles prebuilt commands,
+pastes text or images into the upload panel and sends chat turns, all through
+Streamlit's AppTest driver. Gemini is replaced by a local stand-in with
+configurable latency, stalls and error rate, so the numbers measure this app's
+server-side cost rather than the API.
+
+Usage: python benchmarks/load_test.py --users 1,2,4,8,16 --turns 5 --latency 0.8
+
+With the default quota the ramp flattens at the app's own rate limiter; pass
+--rpm and --max-concurrency to find where the server itself saturates.
+"""
+import argparse
+import base64
+import json
+import os
+import random
+import resource
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import types
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from io import BytesIO
+
+from google.api_core.exceptions import DeadlineExceeded
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "streamlit_app.py")
+
+# Every password secret the app reads, mapped to the access level it grants
+PASSWORDS = {
+    "PASSWORD": "Platinum",
+    "OTHERPW": "Platinum",
+    "BASE4PW": "Platinum",
+    "MMPW": "Platinum",
+    "AVYAYPW": "Platinum",
+    "BASE3PW": "Gold",
+    "BASE2PW": "Silver",
+    "BASE1PW": "Bronze",
+}
+LEVEL_PASSWORDS = {"Platinum": "PASSWORD", "Gold": "BASE3PW", "Silver": "BASE2PW", "Bronze": "BASE1PW"}
+COMMANDS = ["/synonyms", "/summarize", "/aphgfrq", "/answer4math", "/cornellformat", "/paraphrase"]
+PROMPTS = [
+    "urbanization",
+    "Explain the demographic transition model with an example.",
+    "Solve 3x + 7 = 22 and 2x^2 - 8 = 0.",
+    "Photosynthesis converts light energy into chemical energy stored in glucose. " * 20,
+]
+
+# Fake Gemini backend
+
+STALL_FACTOR = 20  # a stalled call takes this many times the normal latency
+
+class FakeBackendStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.errors = 0
+
+    def record(self, error=False):
+        with self.lock:
+            self.calls += 1
+            self.errors += int(error)
+
+class FakeResponse:
+    def __init__(self, text, prompt_tokens):
+        self.text = text
+        self.usage_metadata = types.SimpleNamespace(
+            prompt_token_count=prompt_tokens,
+            cached_content_token_count=0,
+            candidates_token_count=len(text) // 4,
+            total_token_count=prompt_tokens + len(text) // 4,
+        )
+        self._chunks = [types.SimpleNamespace(text=word + " ") for word in text.split(" ")]
+
+    def __iter__(self):
+        return iter(self._chunks)
+
+    def resolve(self):
+        return self
+
+class FakeStream(FakeResponse):
+    """Streams the reply word by word over the call's latency and honours request_options timeouts."""
+
+    def __init__(self, text, prompt_tokens, latency, timeout):
+        super().__init__(text, prompt_tokens)
+        self.timeout = timeout
+        self.started = time.monotonic()
+        # Half the latency before the first chunk, the rest spread over the chunks. Like the real
+        # client, the call itself blocks until the first chunk arrives
+        self.delays = [latency / 2 / len(self._chunks)] * (len(self._chunks) - 1)
+        self.wait(latency / 2)
+
+    def wait(self, delay):
+        if self.timeout is not None and time.monotonic() + delay - self.started > self.timeout:
+            time.sleep(max(0.0, self.timeout - (time.monotonic() - self.started)))
+            raise DeadlineExceeded("Deadline Exceeded")
+        time.sleep(delay)
+
+    def __iter__(self):
+        yield self._chunks[0]
+        for chunk, delay in zip(self._chunks[1:], self.delays):
+            self.wait(delay)
+            yield chunk
+
+class FakeChatSession:
+    def __init__(self, model, history):
+        self.model = model
+        self.history = list(history or [])
+
+    def send_message(self, content, **kwargs):
+        response = self.model.generate_content(self.history + [{"role": "user", "parts": [str(content)]}], **kwargs)
+        self.history = self.history + [
+            {"role": "user", "parts": [str(content)[:200]]},
+            {"role": "model", "parts": [response.text]},
+        ]
+        return response
+
+def make_fake_model(config, stats):
+    class FakeGenerativeModel:
+        def __init__(self, model_name="gemini-1.5-flash", generation_config=None, system_instruction=None, **kwargs):
+            self.model_name = model_name
+
+        def start_chat(self, history=None, **kwargs):
+            return FakeChatSession(self, history)
+
+        def generate_content(self, contents, stream=False, request_options=None, **kwargs):
+            latency = max(0.0, random.gauss(config.latency, config.jitter))
+            if random.random() < config.stall_rate:
+                latency *= STALL_FACTOR
+            if random.random() < config.error_rate:
+                time.sleep(latency)
+                stats.record(error=True)
+                raise Exception("429 Resource has been exhausted (rate_limit)")
+            stats.record()
+            words = " ".join(random.choice(("geography", "population", "answer", "because", "example")) for _ in range(config.reply_words))
+            timeout = (request_options or {}).get("timeout")
+            if stream:
+                return FakeStream(f"{self.model_name}: {words}", len(str(contents)) // 4, latency, timeout)
+            if timeout is not None and latency > timeout:
+                time.sleep(timeout)
+                raise DeadlineExceeded("Deadline Exceeded")
+            time.sleep(latency)
+            return FakeResponse(f"{self.model_name}: {words}", len(str(contents)) // 4)
+
+        def count_tokens(self, contents):
+            return types.SimpleNamespace(total_tokens=len(str(contents)) // 4)
+
+    return FakeGenerativeModel
+
+def install_fake_backend(config, stats):
+    import google.generativeai as genai
+    
+    genai.configure = lambda **kwargs: None
+    genai.GenerativeModel = make_fake_model(config, stats)
+    remote_file = types.SimpleNamespace(name="files/fake", state=types.SimpleNamespace(name="ACTIVE"))
+    genai.upload_file = lambda **kwargs: remote_file
+    genai.get_file = lambda name: remote_file
+
+# AppTest was written for one script run at a time: every run installs its own
+# mock Runtime singleton, swaps st.secrets, patches config.get_option and
+# compiles the script, then undoes all of it. Overlapping runs in threads tear
+# each other's globals down mid-run, so install them once and share them, the
+# way a real server shares one Runtime between sessions.
+
+def share_apptest_globals(secrets):
+    import streamlit as st
+    from streamlit import config
+    from streamlit.runtime import Runtime
+    from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+    from streamlit.runtime.secrets import Secrets
+    from streamlit.testing.v1 import app_test, local_script_runner
+    
+    class PinnedRuntime:
+        """Stands in for the Runtime class inside AppTest; keeps the first mock runtime installed."""
+        
+        def __getattr__(self, name):
+            return getattr(Runtime, name)
+        
+        def __setattr__(self, name, value):
+            if name == "_instance" and (value is None or Runtime._instance is not None):
+                return
+            setattr(Runtime, name, value)
+        
+        def __dir__(self):
+            return dir(Runtime)
+    
+    script_cache = ScriptCache()
+    compile_lock = threading.Lock()
+    get_bytecode = script_cache.get_bytecode
+    
+    def locked_get_bytecode(script_path):
+        with compile_lock:
+            return get_bytecode(script_path)
+    
+    script_cache.get_bytecode = locked_get_bytecode
+    
+    shared_secrets = Secrets()
+    shared_secrets._secrets = dict(secrets)
+    st.secrets = shared_secrets
+    config.set_option("global.appTest", True)
+    
+    app_test.Runtime = PinnedRuntime()
+    app_test.ScriptCache = lambda: script_cache
+    local_script_runner.ScriptCache = lambda: script_cache
+    app_test.patch_config_options = lambda overrides: nullcontext()
+
+# Simulated users
+
+def deep_sizeof(obj, seen=None):
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj, 0)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(k, seen) + deep_sizeof(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_sizeof(item, seen) for item in obj)
+    elif isinstance(obj, BytesIO):
+        size += obj.getbuffer().nbytes
+    elif hasattr(obj, "__dict__") and not isinstance(obj, type):
+        size += deep_sizeof(vars(obj), seen)
+    return size
+
+def sample_image_data_url():
+    from PIL import Image
+    
+    buffer = BytesIO()
+    Image.new("RGB", (1600, 1200), (random.randrange(256), 90, 160)).save(buffer, format="PNG")
+    return "data:image/png;base64," + base64.b64encode(buffer.getvalue()).decode()
+
+def simulate_user(user_index, config):
+    from streamlit.testing.v1 import AppTest
+    
+    rng = random.Random(config.seed + user_index)
+    level = config.levels[user_index % len(config.levels)]
+    result = {"level": level, "login": None, "turns": [], "failed_turns": 0, "exceptions": 0, "state_bytes": 0}
+    
+    at = AppTest.from_file(APP_PATH, default_timeout=config.timeout)
+    at.run()
+    
+    started = time.perf_counter()
+    at.text_input(key="password").set_value(f"{LEVEL_PASSWORDS[level].lower()}-secret").run()
+    result["login"] = time.perf_counter() - started
+    result["exceptions"] += len(at.exception)
+    
+    for _ in range(config.turns):
+        time.sleep(config.think)
+        
+        if level in ("Gold", "Platinum") and rng.random() < config.command_rate:
+            try:
+                at.button(key=f"cmd_{rng.choice(COMMANDS)}").click().run()
+            except KeyError:
+                # The panel did not render on this rerun; counted below as a failed turn if it persists
+                pass
+        
+        if level == "Platinum" and rng.random() < config.upload_rate:
+            if rng.random() < 0.5:
+                at.session_state["clipboard_data"] = {"format": "image", "data": sample_image_data_url()}
+            else:
+                at.session_state["clipboard_data"] = {"format": "text", "data": rng.choice(PROMPTS) * 5}
+            at.run()
+        
+        if not at.chat_input:
+            # An uncaught exception stopped the script before the chat box rendered
+            result["failed_turns"] += 1
+            at.run()
+            continue
+        
+        started = time.perf_counter()
+        at.chat_input[0].set_value(rng.choice(PROMPTS)).run()
+        result["turns"].append(time.perf_counter() - started)
+        result["exceptions"] += len(at.exception)
+    
+    result["state_bytes"] = deep_sizeof(at._session_state.filtered_state)
+    return result
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+def run_level(users, config, stats):
+    calls_before, errors_before = stats.calls, stats.errors
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=users) as pool:
+        results = list(pool.map(lambda i: simulate_user(i, config), range(users)))
+    elapsed = time.perf_counter() - started
+    
+    turns = [latency for result in results for latency in result["turns"]]
+    logins = [result["login"] for result in results]
+    return {
+        "users": users,
+        "turns": len(turns),
+        "elapsed_s": round(elapsed, 2),
+        "throughput_turns_per_s": round(len(turns) / elapsed, 3) if elapsed else 0.0,
+        "turn_p50_s": round(percentile(turns, 0.50), 3),
+        "turn_p95_s": round(percentile(turns, 0.95), 3),
+        "turn_p99_s": round(percentile(turns, 0.99), 3),
+        "turn_max_s": round(max(turns, default=0.0), 3),
+        "login_p95_s": round(percentile(logins, 0.95), 3),
+        "failed_turns": sum(result["failed_turns"] for result in results),
+        "app_exceptions": sum(result["exceptions"] for result in results),
+        "backend_calls": stats.calls - calls_before,
+        "backend_errors": stats.errors - errors_before,
+        "session_state_kb_avg": round(statistics.mean(result["state_bytes"] for result in results) / 1024, 1),
+        "process_max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+def find_saturation(rows, slo_p95, min_gain):
+    for previous, row in zip(rows, rows[1:]):
+        if row["turn_p95_s"] > slo_p95:
+            return row["users"], f"p95 {row['turn_p95_s']} s exceeds the {slo_p95} s target"
+        if row["throughput_turns_per_s"] < previous["throughput_turns_per_s"] * (1 + min_gain):
+            return previous["users"], f"throughput stopped scaling beyond {previous['users']} users"
+    return None, "not reached at the tested concurrency"
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", default="1,2,4,8,16", help="comma-separated concurrency levels to ramp through")
+    parser.add_argument("--turns", type=int, default=5, help="chat turns per simulated user")
+    parser.add_argument("--levels", default="Platinum,Gold,Silver,Bronze", help="access levels to cycle users through")
+    parser.add_argument("--latency", type=float, default=0.8, help="mean fake model latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.2, help="standard deviation of fake latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of fake model calls that fail")
+    parser.add_argument("--stall-rate", type=float, default=0.0, help=f"fraction of fake model calls that take {STALL_FACTOR}x as long")
+    parser.add_argument("--reply-words", type=int, default=60)
+    parser.add_argument("--command-rate", type=float, default=0.5)
+    parser.add_argument("--upload-rate", type=float, default=0.3)
+    parser.add_argument("--rpm", type=int, help="override the app's model request quota (MAINFRAME_REQUESTS_PER_MINUTE)")
+    parser.add_argument("--max-concurrency", type=int, help="override MAINFRAME_MAX_CONCURRENCY")
+    parser.add_argument("--think", type=float, default=0.0, help="seconds between a user's turns")
+    parser.add_argument("--timeout", type=float, default=300.0, help="per-rerun timeout")
+    parser.add_argument("--slo-p95", type=float, default=10.0, help="turn latency target used to call saturation")
+    parser.add_argument("--min-gain", type=float, default=0.1, help="throughput gain below which scaling has stopped")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="also write the report to this file")
+    config = parser.parse_args()
+    config.levels = [level.strip() for level in config.levels.split(",")]
+    
+    # The app keeps history, uploads and checkpoints under its data dir; isolate each run
+    os.environ.setdefault("GEMINI_API_KEY", "load-test")
+    os.environ["MAINFRAME_DATA_DIR"] = tempfile.mkdtemp(prefix="mainframe_load_")
+    if config.rpm:
+        os.environ["MAINFRAME_REQUESTS_PER_MINUTE"] = str(config.rpm)
+    if config.max_concurrency:
+        os.environ["MAINFRAME_MAX_CONCURRENCY"] = str(config.max_concurrency)
+    random.seed(config.seed)
+    
+    stats = FakeBackendStats()
+    install_fake_backend(config, stats)
+    share_apptest_globals({secret: f"{secret.lower()}-secret" for secret in PASSWORDS})
+    
+    rows = []
+    for users in [int(value) for value in config.users.split(",")]:
+        row = run_level(users, config, stats)
+        rows.append(row)
+        print(
+            f"{row['users']:>4} users  {row['throughput_turns_per_s']:>7.2f} turns/s  "
+            f"p50 {row['turn_p50_s']:>6.2f}s  p95 {row['turn_p95_s']:>6.2f}s  p99 {row['turn_p99_s']:>6.2f}s  "
+            f"state {row['session_state_kb_avg']:>8.1f} KB/session  rss {row['process_max_rss_mb']:>7.1f} MB  "
+            f"errors {row['backend_errors']}/{row['backend_calls']}  exceptions {row['app_exceptions']}  failed turns {row['failed_turns']}"
+        )
+    
+    saturation, reason = find_saturation(rows, config.slo_p95, config.min_gain)
+    print(f"Saturation point: {saturation if saturation else 'none'} ({reason})")
+    
+    if config.json:
+        with open(config.json, "w") as f:
+            json.dump({"levels": rows, "saturation_users": saturation, "saturation_reason": reason}, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""Checks that worker processes share one request quota through the shared backend.
+
+Several processes draw tokens from the model-request bucket as fast as the
+limiter allows. With a shared backend (sqlite, redis) the total granted stays
+at the configured rate no matter how many workers run; with the per-process
+memory backend it grows with the worker count.
+
+The fakeredis backend runs the Redis code path (cache round trip, expiry and
+the Lua token bucket) against an in-process stand-in, with worker threads in
+place of processes; it needs `pip install "fakeredis[lua]"`.
+
+Usage: python benchmarks/shared_backend.py --backend sqlite --workers 4 --rpm 120 --seconds 10
+       python benchmarks/shared_backend.py --backend redis --redis-url redis://localhost:6379/0
+       python benchmarks/shared_backend.py --backend fakeredis --seconds 5
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def worker(config, results):
+    # The app module refuses to import without a key; the benchmark never calls the API
+    os.environ.setdefault("GEMINI_API_KEY", "benchmark")
+    os.environ["MAINFRAME_SHARED_BACKEND"] = config.backend
+    os.environ["MAINFRAME_SHARED_DB"] = config.db
+    os.environ["MAINFRAME_REDIS_URL"] = config.redis_url
+    os.environ["MAINFRAME_REQUESTS_PER_MINUTE"] = str(config.rpm)
+    sys.path.insert(0, ROOT)
+    import streamlit_app
+
+    limiter = streamlit_app.get_rate_limiter()
+    granted = 0
+    started = time.time()
+    deadline = started + config.seconds
+    while time.time() < deadline:
+        limiter.acquire()
+        granted += 1
+
+    # Every worker extracts the same document; only the first one should pay for it
+    computed = []
+    streamlit_app.cached_text("extract", "benchmark-document", lambda: computed.append(1) or "text", 60)
+    backend_hits = 0 if computed else 1
+    results.put((granted, backend_hits, started, time.time()))
+
+def check_fake_redis(config):
+    import fakeredis
+    os.environ.setdefault("GEMINI_API_KEY", "benchmark")
+    sys.path.insert(0, ROOT)
+    import streamlit_app
+
+    backend = streamlit_app.RedisBackend(fakeredis.FakeRedis())
+    backend.set("extract", "benchmark-document", b"text", ttl=1)
+    stored = backend.get("extract", "benchmark-document")
+    missing = backend.get("extract", "other-document")
+    time.sleep(1.1)
+    expired = backend.get("extract", "benchmark-document")
+    print(f"fakeredis cache: stored {stored!r}, missing {missing!r}, after ttl {expired!r}")
+    if stored != b"text" or missing is not None or expired is not None:
+        sys.exit("fakeredis cache round trip failed")
+
+    # Threads stand in for workers: every one of them draws on the same Lua-refilled bucket
+    rate = config.rpm / 60.0
+    capacity = int(os.getenv("MAINFRAME_MAX_CONCURRENCY", "4"))
+    granted = []
+    started = time.time()
+    deadline = started + config.seconds
+
+    def draw():
+        count = 0
+        while time.time() < deadline:
+            wait = backend.take_token("model_requests", rate, capacity)
+            if wait:
+                time.sleep(min(wait, max(0.0, deadline - time.time())))
+            else:
+                count += 1
+        granted.append(count)
+
+    threads = [threading.Thread(target=draw) for _ in range(config.workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    window = time.time() - started
+    expected = rate * window + capacity
+    print(f"fakeredis: {config.workers} workers were granted {sum(granted)} requests in {window:.1f} s "
+          f"(one shared quota allows about {expected:.0f})")
+    if sum(granted) > expected + 1:
+        sys.exit("fakeredis token bucket granted more than the shared quota")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--backend", default="sqlite", choices=["memory", "sqlite", "redis", "fakeredis"])
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--rpm", type=int, default=120)
+    parser.add_argument("--seconds", type=float, default=10.0)
+    parser.add_argument("--db", default=os.path.join(tempfile.mkdtemp(prefix="mainframe_shared_"), "shared.db"))
+    parser.add_argument("--redis-url", default="redis://localhost:6379/0")
+    config = parser.parse_args()
+    if config.backend == "fakeredis":
+        check_fake_redis(config)
+        return
+
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=worker, args=(config, results)) for _ in range(config.workers)]
+    for process in processes:
+        process.start()
+    outcomes = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+
+    granted = sum(outcome[0] for outcome in outcomes)
+    # Workers start a little apart, so the quota applies to the span from the first start to the last finish
+    window = max(outcome[3] for outcome in outcomes) - min(outcome[2] for outcome in outcomes)
+    # The bucket starts full (one token per in-flight slot), then refills at the configured rate
+    expected = config.rpm / 60.0 * window + int(os.getenv("MAINFRAME_MAX_CONCURRENCY", "4"))
+    print(f"{config.backend}: {config.workers} workers were granted {granted} requests in {window:.1f} s "
+          f"(one shared quota allows about {expected:.0f})")
+    print(f"Extraction cache hits across workers: {sum(outcome[1] for outcome in outcomes)} of {config.workers}")
+
+if __name__ == "__main__":
+    main()
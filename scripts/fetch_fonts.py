@@ -0,0 +1,63 @@
+"""Downloads the self-hosted web fonts into static/fonts.
+
+static/fonts.css declares one latin WOFF2 file per font family. This fetches
+them from the Google Fonts CSS API once, at build or deploy time, so browsers
+load them from the app instead of an external CDN. The app links fonts.css
+only when every file is present and uses the CDN otherwise.
+
+Usage: python scripts/fetch_fonts.py [--force]
+"""
+import argparse
+import os
+import re
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FONT_DIR = os.path.join(ROOT, "static", "fonts")
+CSS_API = "https://fonts.googleapis.com/css2?family={spec}&display=swap"
+
+# File slug -> family spec; variable fonts cover the weight range in one file
+FONTS = {
+    "montserrat": "Montserrat:wght@300..700",
+    "orbitron": "Orbitron:wght@400..700",
+    "dm-sans": "DM+Sans:wght@300..700",
+    "roboto": "Roboto:wght@300..700",
+    "open-sans": "Open+Sans:wght@300..700",
+    "lato": "Lato:wght@400",
+    "poppins": "Poppins:wght@400",
+    "ubuntu": "Ubuntu:wght@400",
+    "playfair-display": "Playfair+Display:wght@400..700",
+}
+# The API picks the font format from the user agent; a current browser gets WOFF2
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0 Safari/537.36"
+LATIN_FACE = re.compile(r"/\* latin \*/\s*@font-face\s*\{[^}]*?url\((?P<url>[^)]+)\)", re.S)
+ANY_URL = re.compile(r"url\((?P<url>[^)]+)\)")
+
+def fetch(url):
+    request = urllib.request.Request(url, headers={"User-Agent": USER_AGENT})
+    with urllib.request.urlopen(request, timeout=30) as response:
+        return response.read()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--force", action="store_true", help="download files that already exist")
+    args = parser.parse_args()
+
+    os.makedirs(FONT_DIR, exist_ok=True)
+    for slug, spec in FONTS.items():
+        path = os.path.join(FONT_DIR, f"{slug}.woff2")
+        if os.path.exists(path) and not args.force:
+            print(f"{slug}: already present")
+            continue
+        css = fetch(CSS_API.format(spec=spec)).decode("utf-8")
+        # Families without subsets have a single face and no "latin" comment
+        match = LATIN_FACE.search(css) or ANY_URL.search(css)
+        if match is None:
+            raise SystemExit(f"{slug}: no font URL in the CSS API response")
+        data = fetch(match.group("url").strip("'\""))
+        with open(path, "wb") as f:
+            f.write(data)
+        print(f"{slug}: {len(data) // 1024} KB")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+// Forwards pasted images and text to the app. Loaded once per page; reruns reuse it.
+(function() {
+    if (window.mainframeClipboard) {
+        return;
+    }
+    window.mainframeClipboard = true;
+
+    document.addEventListener('paste', function(e) {
+        if (document.activeElement.tagName !== 'TEXTAREA' && document.activeElement.tagName !== 'INPUT') {
+            e.preventDefault();
+            const items = e.clipboardData.items;
+
+            for (const item of items) {
+                if (item.type.indexOf('image') !== -1) {
+                    const blob = item.getAsFile();
+                    const reader = new FileReader();
+                    reader.onload = function(e) {
+                        const base64data = e.target.result;
+                        window.parent.postMessage({
+                            type: 'clipboard_paste',
+                            data: base64data,
+                            format: 'image'
+                        }, '*');
+                    };
+                    reader.readAsDataURL(blob);
+                } else if (item.type === 'text/plain') {
+                    item.getAsString(function(text) {
+                        window.parent.postMessage({
+                            type: 'clipboard_paste',
+                            data: text,
+                            format: 'text'
+                        }, '*');
+                    });
+                }
+            }
+        }
+    });
+    window.addEventListener('message', function(e) {
+        if (e.data.type === 'clipboard_paste') {
+            const args = {
+                'data': e.data.data,
+                'format': e.data.format
+            };
+            window.parent.postMessage({
+                type: 'streamlit:set_widget_value',
+                key: 'clipboard_data',
+                value: args
+            }, '*');
+        }
+    });
+})();
@@ -1,102 +1,280 @@
 import streamlit as st
+import streamlit.components.v1 as components
+from streamlit.runtime import Runtime
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
 import time
 import re
 import os
+import sys
 import mimetypes
 import tempfile
+import zipfile
+import shutil
+import subprocess
 import speech_recognition as sr
 import hashlib
+import mmap
+import sqlite3
+import string
+import struct
+import uuid
+import zlib
 from PyPDF2 import PdfReader
-from docx import Document
 import pytesseract
-from PIL import Image
+from PIL import Image, ImageOps
 import pandas as pd
 import json
 import xml.etree.ElementTree as ET
 from io import BytesIO
 import base64
+import atexit
+import functools
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, as_completed, wait
+from contextlib import contextmanager, nullcontext
 from datetime import datetime, timedelta
+from types import SimpleNamespace
 try: 
     import fitz  # PyMuPDF 
 except ImportError: 
     fitz = None 
+try:
+    from lxml import etree as docx_etree
+except ImportError:
+    docx_etree = ET
+try:
+    import redis
+except ImportError:
+    redis = None
+
+# Rerun profiler: with MAINFRAME_PROFILE=1 each section of a rerun is timed (wall and CPU) and
+# charged for the bytes it sends to the browser, aggregated across sessions in this process
+PROFILE_ENABLED = os.getenv("MAINFRAME_PROFILE", "0") == "1"
+PROFILE_DIR = os.getenv("MAINFRAME_PROFILE_DIR")  # defaults to DATA_DIR/profile
+PROFILE_DUMP_EVERY = 50  # full reruns between flamegraph dumps
+PROFILE_METRICS = ("wall", "cpu", "bytes")
+NO_PROFILE = nullcontext()
+
+class RerunProfiler:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        # Stack path -> calls plus total and self wall (s), CPU (s) and bytes
+        self.sections = {}
+        self.runs = 0
+        atexit.register(self.dump)
+
+    def watch_output(self):
+        # Messages are counted on their way to the session, against the innermost open section
+        ctx = get_script_run_ctx(suppress_warning=True)
+        if ctx is None or getattr(ctx._enqueue, "profiler", None) is self:
+            return
+        enqueue = ctx._enqueue
+        
+        def counted(msg):
+            frames = getattr(self.local, "frames", None)
+            if frames:
+                frames[-1]["bytes"] += msg.ByteSize()
+            enqueue(msg)
+        
+        counted.profiler = self
+        ctx._enqueue = counted
+
+    @contextmanager
+    def section(self, name):
+        frames = self.local.__dict__.setdefault("frames", [])
+        if not frames:
+            self.watch_output()
+        frame = {
+            "path": f"{frames[-1]['path']};{name}" if frames else name,
+            "bytes": 0, "child_wall": 0.0, "child_cpu": 0.0, "child_bytes": 0,
+        }
+        frames.append(frame)
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - wall, time.thread_time() - cpu
+            frames.pop()
+            total_bytes = frame["bytes"] + frame["child_bytes"]
+            if frames:
+                frames[-1]["child_wall"] += wall
+                frames[-1]["child_cpu"] += cpu
+                frames[-1]["child_bytes"] += total_bytes
+            with self.lock:
+                stats = self.sections.setdefault(frame["path"], [0, 0.0, 0.0, 0, 0.0, 0.0, 0])
+                stats[0] += 1
+                stats[1] += wall
+                stats[2] += cpu
+                stats[3] += total_bytes
+                stats[4] += wall - frame["child_wall"]
+                stats[5] += cpu - frame["child_cpu"]
+                stats[6] += frame["bytes"]
+                if frame["path"] == "main":
+                    self.runs += 1
+                    dump = self.runs % PROFILE_DUMP_EVERY == 0
+            if frame["path"] == "main" and dump:
+                self.dump()
+
+    def folded(self, metric):
+        # Flamegraph "folded stacks": one line per stack with its self cost (microseconds or bytes)
+        index = 4 + PROFILE_METRICS.index(metric)
+        scale = 1 if metric == "bytes" else 1e6
+        with self.lock:
+            lines = [f"{path} {int(stats[index] * scale)}" for path, stats in sorted(self.sections.items())]
+        return "\n".join(lines) + "\n"
+
+    def dump(self):
+        if not self.sections:
+            return
+        directory = PROFILE_DIR or os.path.join(DATA_DIR, "profile")
+        os.makedirs(directory, exist_ok=True)
+        # One file set per process; concatenate them to merge workers
+        for metric in PROFILE_METRICS:
+            path = os.path.join(directory, f"rerun-{os.getpid()}.{metric}.folded")
+            with open(path + ".tmp", "w") as f:
+                f.write(self.folded(metric))
+            os.replace(path + ".tmp", path)
+
+    def table(self):
+        with self.lock:
+            rows = [
+                {
+                    "section": path,
+                    "calls": calls,
+                    "wall ms/call": round(wall * 1000 / calls, 2),
+                    "cpu ms/call": round(cpu * 1000 / calls, 2),
+                    "KB/call": round(sent / 1024 / calls, 1),
+                    "wall s total": round(wall, 3),
+                }
+                for path, (calls, wall, cpu, sent, *_) in self.sections.items()
+            ]
+        return pd.DataFrame(rows).sort_values("wall s total", ascending=False) if rows else pd.DataFrame()
+
+@st.cache_resource
+def get_rerun_profiler():
+    return RerunProfiler()
+
+def profile_section(name):
+    return get_rerun_profiler().section(name) if PROFILE_ENABLED else NO_PROFILE
+
+def profiled(function):
+    # No wrapper at all unless profiling is on
+    if not PROFILE_ENABLED:
+        return function
+    
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with profile_section(function.__name__):
+            return function(*args, **kwargs)
+    
+    return wrapper
+
+# Browser preferences are loaded and saved through one batched localStorage bridge
+PREFERENCE_KEYS = {
+    "login": "mainframe_ai_login",
+    "font": "mainframe_ai_font",
+    "custom_commands": "mainframe_ai_custom_commands",
+    "accessibility": "mainframe_ai_accessibility",
+}
+DEFAULT_FONT_PREFERENCES = {
+    "font_family": "Montserrat",
+    "text_size": "medium"
+}
+DEFAULT_ACCESSIBILITY = {
+    "high_contrast": False
+}
+
+preferences_bridge = components.declare_component(
+    "mainframe_preferences",
+    path=os.path.join(os.path.dirname(os.path.abspath(__file__)), "components", "preferences")
+)
+
+@profiled
+def sync_preferences():
+    if 'stored_preferences' not in st.session_state:
+        # Server-side copy first, so the page renders with known values before the browser answers
+        st.session_state.stored_preferences = get_history_store().load_preferences(st.session_state.session_id)
+        st.session_state.pending_preference_writes = {}
+        st.session_state.preference_writes = {}
+        st.session_state.preference_write_id = 0
+
+    if st.session_state.pending_preference_writes:
+        st.session_state.preference_writes = st.session_state.pending_preference_writes
+        st.session_state.pending_preference_writes = {}
+        st.session_state.preference_write_id += 1
+
+    browser_state = preferences_bridge(
+        keys=list(PREFERENCE_KEYS.values()),
+        writes=st.session_state.preference_writes,
+        write_id=st.session_state.preference_write_id,
+        cookie=session_cookie(),
+        key="preferences_bridge",
+        default=None
+    )
+
+    if browser_state and browser_state.get("loaded") and not st.session_state.get('browser_preferences_loaded'):
+        st.session_state.browser_preferences_loaded = True
+        browser_values = {key: value for key, value in browser_state.get("values", {}).items() if value is not None}
+        if browser_values:
+            st.session_state.stored_preferences.update(browser_values)
+            # Derived state is rebuilt from the browser's values on this run
+            for name in ('persistent_login', 'font_preferences', 'custom_commands', 'accessibility'):
+                st.session_state.pop(name, None)
+
+def get_preference(name, default):
+    raw = st.session_state.stored_preferences.get(PREFERENCE_KEYS[name])
+    if raw is None:
+        return default
+    try:
+        return json.loads(raw)
+    except ValueError:
+        return default
+
+def set_preference(name, value):
+    key = PREFERENCE_KEYS[name]
+    raw = json.dumps(value) if value is not None else None
+    if raw is None:
+        st.session_state.stored_preferences.pop(key, None)
+    else:
+        st.session_state.stored_preferences[key] = raw
+    st.session_state.pending_preference_writes[key] = raw
+    get_history_store().save_preference(st.session_state.session_id, key, raw)
 
 # Check for password in session state and persistent login
 def get_persistent_login():
     if 'persistent_login' in st.session_state:
         return st.session_state.persistent_login
     
-    # Try to load from local storage
-    placeholder_div = st.empty()
-    placeholder_div.markdown(
-        """
-        <div id="check_persistent_login" style="display:none;"></div>
-        <script>
-            const checkLogin = document.getElementById('check_persistent_login');
-            const loginData = localStorage.getItem('mainframe_ai_login');
-            if (loginData) {
-                const loginInfo = JSON.parse(loginData);
-                if (loginInfo && loginInfo.expiry && new Date(loginInfo.expiry) > new Date()) {
-                    checkLogin.innerText = 'true';
-                } else {
-                    localStorage.removeItem('mainframe_ai_login');
-                    checkLogin.innerText = 'false';
-                }
-            } else {
-                checkLogin.innerText = 'false';
-            }
-            setTimeout(() => {
-                window.parent.postMessage({
-                    type: 'streamlit:setComponentValue',
-                    value: checkLogin.innerText === 'true',
-                    dataType: 'bool',
-                    key: 'persistent_login_check'
-                }, '*');
-            }, 100);
-        </script>
-        """,
-        unsafe_allow_html=True
-    )
+    login_info = get_preference("login", None)
+    try:
+        valid = datetime.fromisoformat(login_info["expiry"]) > datetime.now()
+    except (KeyError, TypeError, ValueError):
+        valid = False
     
-    # Wait for the JavaScript to set the value
-    if 'persistent_login_check' in st.session_state:
-        placeholder_div.empty()
-        st.session_state.persistent_login = st.session_state.persistent_login_check
-        return st.session_state.persistent_login
+    if login_info is not None and not valid:
+        set_preference("login", None)
     
-    return False
+    st.session_state.persistent_login = valid
+    return st.session_state.persistent_login
 
 def set_persistent_login():
     # Set expiry to 30 days from now
     expiry = (datetime.now() + timedelta(days=30)).isoformat()
-    
-    st.markdown(
-        f"""
-        <script>
-            localStorage.setItem('mainframe_ai_login', JSON.stringify({{
-                expiry: '{expiry}'
-            }}));
-        </script>
-        """,
-        unsafe_allow_html=True
-    )
+    set_preference("login", {"expiry": expiry})
     st.session_state.persistent_login = True
 
 def clear_persistent_login():
-    st.markdown(
-        """
-        <script>
-            localStorage.removeItem('mainframe_ai_login');
-        </script>
-        """,
-        unsafe_allow_html=True
-    )
+    set_preference("login", None)
     st.session_state.persistent_login = False
 
 if 'access_level' not in st.session_state:
     st.session_state['access_level'] = None
 
+@profiled
 def check_password(): 
     """Returns a tuple: (True/False, access_level) indicating password correctness and access level.""" 
 
@@ -146,64 +324,12 @@ def check_password():
 
 def initialize_font_preferences():
     if 'font_preferences' not in st.session_state:
-        # Try to load from local storage
-        placeholder_div = st.empty()
-        placeholder_div.markdown(
-            """
-            <div id="load_font_preferences" style="display:none;"></div>
-            <script>
-                const prefDiv = document.getElementById('load_font_preferences');
-                const savedPrefs = localStorage.getItem('mainframe_ai_font');
-                if (savedPrefs) {
-                    prefDiv.innerText = savedPrefs;
-                } else {
-                    prefDiv.innerText = JSON.stringify({
-                        font_family: "Montserrat",
-                        text_size: "medium"
-                    });
-                }
-                setTimeout(() => {
-                    window.parent.postMessage({
-                        type: 'streamlit:setComponentValue',
-                        value: prefDiv.innerText,
-                        dataType: 'string',
-                        key: 'loaded_font_preferences'
-                    }, '*');
-                }, 100);
-            </script>
-            """,
-            unsafe_allow_html=True
-        )
-        
-        # Wait for the JavaScript to set the value
-        if 'loaded_font_preferences' in st.session_state:
-            placeholder_div.empty()
-            try:
-                st.session_state.font_preferences = json.loads(st.session_state.loaded_font_preferences)
-            except:
-                # Default preferences if loading fails
-                st.session_state.font_preferences = {
-                    "font_family": "Montserrat",
-                    "text_size": "medium"
-                }
-        else:
-            # Default preferences
-            st.session_state.font_preferences = {
-                "font_family": "Montserrat",
-                "text_size": "medium"
-            }
+        st.session_state.font_preferences = get_preference("font", dict(DEFAULT_FONT_PREFERENCES))
 
 def save_font_preferences():
-    prefs_json = json.dumps(st.session_state.font_preferences)
-    st.markdown(
-        f"""
-        <script>
-            localStorage.setItem('mainframe_ai_font', '{prefs_json}');
-        </script>
-        """,
-        unsafe_allow_html=True
-    )
+    set_preference("font", st.session_state.font_preferences)
 
+@profiled
 def apply_font_preferences():
     font_family = st.session_state.font_preferences.get("font_family", "Montserrat")
     text_size = st.session_state.font_preferences.get("text_size", "medium")
@@ -216,98 +342,40 @@ def apply_font_preferences():
         "x-large": "1.4rem"
     }
     
-    font_size = size_map[text_size]
-    
-    # Apply CSS based on preferences
-    st.markdown(f"""
-    <style>
-        @import url('https://fonts.googleapis.com/css2?family={font_family.replace(' ', '+')}:wght@300;400;500;600;700&display=swap');
-        
-        * {{
-            font-family: '{font_family}', sans-serif !important;
-            font-size: {font_size} !important;
-        }}
-        
-        .stMarkdown, .stText, .stTitle, .stHeader {{
-            font-family: '{font_family}', sans-serif !important;
-        }}
-        
-        .stButton button {{
-            font-family: '{font_family}', sans-serif !important;
-        }}
-        
-        .stTextInput input {{
-            font-family: '{font_family}', sans-serif !important;
-        }}
-        
-        .stSelectbox select {{
-            font-family: '{font_family}', sans-serif !important;
-        }}
-        
-        /* Adjust heading sizes proportionally */
-        h1 {{
-            font-size: calc({font_size} * 2.0) !important;
-        }}
-        
-        h2 {{
-            font-size: calc({font_size} * 1.5) !important;
-        }}
-        
-        h3 {{
-            font-size: calc({font_size} * 1.3) !important;
-        }}
-    </style>
-    """, unsafe_allow_html=True)
+    # The stylesheet reads these variables; the defaults need no override at all
+    if font_family != DEFAULT_FONT_PREFERENCES["font_family"] or text_size != DEFAULT_FONT_PREFERENCES["text_size"]:
+        st.markdown(
+            f"<style>:root{{--mf-font-family:'{font_family}';--mf-font-size:{size_map[text_size]}}}</style>",
+            unsafe_allow_html=True
+        )
 
 
 def initialize_custom_commands():
+    # Commands that older versions kept in browser storage are copied into the server-side registry.
+    # The browser copy stays until the session cookie they were imported under has come back from the browser.
     if 'custom_commands' not in st.session_state:
-        # Try to load from local storage
-        placeholder_div = st.empty()
-        placeholder_div.markdown(
-            """
-            <div id="load_commands" style="display:none;"></div>
-            <script>
-                const cmdDiv = document.getElementById('load_commands');
-                const savedCmds = localStorage.getItem('mainframe_ai_custom_commands');
-                if (savedCmds) {
-                    cmdDiv.innerText = savedCmds;
-                } else {
-                    cmdDiv.innerText = JSON.stringify({});
-                }
-                setTimeout(() => {
-                    window.parent.postMessage({
-                        type: 'streamlit:setComponentValue',
-                        value: cmdDiv.innerText,
-                        dataType: 'string',
-                        key: 'loaded_commands'
-                    }, '*');
-                }, 100);
-            </script>
-            """,
-            unsafe_allow_html=True
-        )
-        
-        # Wait for the JavaScript to set the value
-        if 'loaded_commands' in st.session_state:
-            placeholder_div.empty()
+        legacy_commands = get_preference("custom_commands", {})
+        registry = get_command_registry()
+        owner = st.session_state.session_id
+        imported = []
+        for name, info in legacy_commands.items():
+            current = registry.get(name, owner)
+            if current is not None and current.owner == owner:
+                # Imported on an earlier visit; edits made since then win over the browser copy
+                imported.append(name)
+                continue
             try:
-                st.session_state.custom_commands = json.loads(st.session_state.loaded_commands)
-            except:
-                st.session_state.custom_commands = {}
-        else:
-            st.session_state.custom_commands = {}
-
-def save_custom_commands():
-    cmds_json = json.dumps(st.session_state.custom_commands)
-    st.markdown(
-        f"""
-        <script>
-            localStorage.setItem('mainframe_ai_custom_commands', '{cmds_json}');
-        </script>
-        """,
-        unsafe_allow_html=True
-    )
+                command = Command(
+                    name, info.get("title", name), info.get("description", ""),
+                    info["prompt"].replace("{", "{{").replace("}", "}}"), info.get("message_text", "")
+                )
+                registry.save(command, owner)
+                imported.append(name)
+            except (KeyError, ValueError):
+                continue
+        if legacy_commands and session_cookie_stored():
+            set_preference("custom_commands", None)
+        st.session_state.custom_commands = imported
 
 # Initialize Gemini API
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
@@ -323,137 +391,33 @@ st.set_page_config(
     layout="wide"
 )
 
-# Custom CSS
-st.markdown("""
-<style>
-    @import url('https://fonts.googleapis.com/css2?family=Montserrat:wght@300;400;500;600;700&display=swap');
+# Page styles and scripts are static files (served from ./static with enableStaticServing), so
+# each rerun sends a couple of short tags and the browser fetches and caches the files once
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
 
-    * {
-        font-family: 'Montserrat', sans-serif !important;
-    }
+@st.cache_resource
+def static_url(name):
+    # The content hash in the URL changes with the file, so a cached copy is never stale
+    with open(os.path.join(STATIC_DIR, name), "rb") as f:
+        digest = hashlib.sha256(f.read()).hexdigest()[:12]
+    return f"app/static/{name}?v={digest}"
 
-    .stChatInputContainer {
-        display: flex;
-        align-items: center;
-    }
-    .back-button {
-        width: 300px;
-        margin-top: 20px;
-        padding: 10px 20px;
-        font-size: 18px;
-        background-color: #0b1936;
-        color: #5799f7;
-        border: 2px solid #4a83d4;
-        border-radius: 10px;
-        cursor: pointer;
-        transition: all 0.3s ease;
-        font-family: 'Montserrat', sans-serif !important;
-        text-transform: uppercase;
-        letter-spacing: 2px;
-        box-shadow: 0 0 15px rgba(74, 131, 212, 0.3);
-        position: relative;
-        overflow: hidden;
-        display: inline-block;
-    }
-    .back-button:before {
-        content: 'BACK TO INTERLINK';
-        display: flex;
-        align-items: center;
-        justify-content: center;
-        position: absolute;
-        top: 0;
-        left: 0;
-        right: 0;
-        bottom: 0;
-        background-color: #0b1936;
-        transition: transform 0.3s ease;
-        font-size: 18px;
-        color: #5799f7;
-        text-align: center;
-        font-family: 'Montserrat', sans-serif !important;
-    }
-    .back-button:hover {
-        background-color: #1c275c;
-        color: #73abfa;
-        transform: translateY(-2px);
-        box-shadow: 0 6px 8px rgba(74, 131, 212, 0.2);
-    }
-    .back-button:hover:before {
-        transform: translateY(-100%);
-        color: #73abfa;
-    }
-    .file-preview {
-        max-height: 200px;
-        overflow: hidden;
-        margin-bottom: 10px;
-    }
-    .file-preview img, .file-preview video, .file-preview audio {
-        max-width: 100%;
-        max-height: 200px;
-        object-fit: contain;
-    }
+# Web fonts are self-hosted once scripts/fetch_fonts.py has fetched them; until then the Google Fonts CDN serves them
+FONT_FILES = re.findall(r"url\('(fonts/[^']+)'\)", open(os.path.join(STATIC_DIR, "fonts.css"), encoding="utf-8").read())
+FONTS_SELF_HOSTED = all(os.path.exists(os.path.join(STATIC_DIR, name)) for name in FONT_FILES)
+GOOGLE_FONTS_URL = (
+    "https://fonts.googleapis.com/css2?family=Montserrat:wght@300..700&family=Orbitron:wght@400..700"
+    "&family=DM+Sans:wght@300..700&family=Roboto:wght@300..700&family=Open+Sans:wght@300..700&family=Lato"
+    "&family=Poppins&family=Ubuntu&family=Playfair+Display:wght@400..700&display=swap"
+)
 
-    .stMarkdown, .stText, .stTitle, .stHeader {
-        font-family: 'Montserrat', sans-serif !important;
-    }
-    
-    .stButton button {
-        font-family: 'Montserrat', sans-serif !important;
-    }
-    
-    .stTextInput input {
-        font-family: 'Montserrat', sans-serif !important;
-    }
-    
-    .stSelectbox select {
-        font-family: 'Montserrat', sans-serif !important;
-    }
-</style>
-<script>
-document.addEventListener('paste', function(e) {
-    if (document.activeElement.tagName !== 'TEXTAREA' && document.activeElement.tagName !== 'INPUT') {
-        e.preventDefault();
-        const items = e.clipboardData.items;
-        
-        for (const item of items) {
-            if (item.type.indexOf('image') !== -1) {
-                const blob = item.getAsFile();
-                const reader = new FileReader();
-                reader.onload = function(e) {
-                    const base64data = e.target.result;
-                    window.parent.postMessage({
-                        type: 'clipboard_paste',
-                        data: base64data,
-                        format: 'image'
-                    }, '*');
-                };
-                reader.readAsDataURL(blob);
-            } else if (item.type === 'text/plain') {
-                item.getAsString(function(text) {
-                    window.parent.postMessage({
-                        type: 'clipboard_paste',
-                        data: text,
-                        format: 'text'
-                    }, '*');
-                });
-            }
-        }
-    }
-});
-window.addEventListener('message', function(e) {
-    if (e.data.type === 'clipboard_paste') {
-        const args = {
-            'data': e.data.data,
-            'format': e.data.format
-        };
-        window.parent.postMessage({
-            type: 'streamlit:set_widget_value',
-            key: 'clipboard_data',
-            value: args
-        }, '*');
-    }
-});
-</script>""", unsafe_allow_html=True)
+with profile_section("page_css"):
+    font_stylesheet = static_url("fonts.css") if FONTS_SELF_HOSTED else GOOGLE_FONTS_URL
+    st.markdown(
+        f'<link rel="stylesheet" href="{font_stylesheet}"><link rel="stylesheet" href="{static_url("app.css")}">',
+        unsafe_allow_html=True
+    )
+    st.html(f'<script src="{static_url("clipboard.js")}"></script>', unsafe_allow_javascript=True)
 
 generation_config = {
     "temperature": 0,
@@ -555,19 +519,58 @@ PREBUILT_COMMANDS = {
     # Add more as needed
 }
 
+# Scanned PDF pages (no text layer) are rendered and OCR'd; text-layer pages stay on the fast path
+PDF_MIN_TEXT_CHARS = 20
+PDF_OCR_DPI = int(os.getenv("MAINFRAME_PDF_OCR_DPI", "300"))
+PDF_OCR_WORKERS = int(os.getenv("MAINFRAME_PDF_OCR_WORKERS", str(os.cpu_count() or 2)))
+
+@st.cache_resource
+def get_ocr_pool():
+    return ThreadPoolExecutor(max_workers=PDF_OCR_WORKERS, thread_name_prefix="ocr")
+
+def page_needs_ocr(page, text):
+    return len(text.strip()) < PDF_MIN_TEXT_CHARS and bool(page.get_images())
+
+def ocr_page_image(width, height, samples):
+    # Tesseract runs as a subprocess, so OCR threads work in parallel
+    return pytesseract.image_to_string(Image.frombytes("L", (width, height), samples))
+
+def extract_pdf_pages(pdf_document):
+    pool = get_ocr_pool()
+    page_texts = []
+    ocr_futures = {}
+    
+    for page_num in range(len(pdf_document)):
+        page = pdf_document[page_num]
+        text = page.get_text()
+        page_texts.append(text)
+        if not page_needs_ocr(page, text):
+            continue
+        
+        # Rendering stays on this thread (PyMuPDF documents are not thread-safe); only OCR is pooled
+        if len(ocr_futures) >= PDF_OCR_WORKERS * 2:
+            oldest = min(ocr_futures)
+            page_texts[oldest] = ocr_futures.pop(oldest).result()
+        pixmap = page.get_pixmap(dpi=PDF_OCR_DPI, colorspace=fitz.csGRAY)
+        ocr_futures[page_num] = pool.submit(ocr_page_image, pixmap.width, pixmap.height, pixmap.samples)
+    
+    for page_num, future in ocr_futures.items():
+        page_texts[page_num] = future.result()
+    return "".join(page_texts)
+
 def extract_pdf_text(file): 
     try: 
         if fitz: # Check if fitz is available 
             try: 
-                pdf_document = fitz.open(stream=file.read(), filetype="pdf") 
-                text = "" 
-                for page_num in range(len(pdf_document)): 
-                    page = pdf_document[page_num] 
-                    text += page.get_text() 
-                return text 
+                if isinstance(file, str): 
+                    pdf_document = fitz.open(file) 
+                else: 
+                    pdf_document = fitz.open(stream=file.read(), filetype="pdf") 
+                return extract_pdf_pages(pdf_document) 
             except Exception as e: 
                 # Fall back to PyPDF2 if PyMuPDF fails 
-                file.seek(0)  # Reset file pointer 
+                if not isinstance(file, str): 
+                    file.seek(0)  # Reset file pointer 
                 pdf = PdfReader(file) 
                 text = "" 
                 for page in pdf.pages: 
@@ -575,7 +578,8 @@ def extract_pdf_text(file):
                 return text 
         else: 
             # Handle case where PyMuPDF is not installed 
-            file.seek(0) 
+            if not isinstance(file, str): 
+                file.seek(0) 
             pdf = PdfReader(file) 
             text = "" 
             for page in pdf.pages: 
@@ -584,13 +588,186 @@ def extract_pdf_text(file):
     except Exception as e: 
         return f"Error extracting PDF text: {str(e)}" 
 
+# DOCX text is streamed out of the package XML instead of building a python-docx object model
+W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+MC_FALLBACK = "{http://schemas.openxmlformats.org/markup-compatibility/2006}Fallback"
+DOCX_BODY_PART = "word/document.xml"
+DOCX_NOTE_PARTS = [
+    ("word/footnotes.xml", "Footnotes"),
+    ("word/endnotes.xml", "Endnotes"),
+    ("word/comments.xml", "Comments"),
+]
+DOCX_SKIPPED_NOTE_TYPES = {"separator", "continuationSeparator", "continuationNotice"}
+
+def collect_docx_text(element, parts):
+    for node in element:
+        tag = node.tag
+        if tag == W + "t":
+            parts.append(node.text or "")
+        elif tag == W + "tab":
+            parts.append("\t")
+        elif tag in (W + "br", W + "cr"):
+            parts.append("\n")
+        elif tag == W + "p":
+            # Paragraphs nested in text boxes start on their own line
+            parts.append("\n")
+            collect_docx_text(node, parts)
+        elif tag == MC_FALLBACK:
+            # Text boxes are stored twice (modern and VML fallback); read only one copy
+            continue
+        else:
+            collect_docx_text(node, parts)
+
+def docx_paragraph_text(paragraph):
+    parts = []
+    collect_docx_text(paragraph, parts)
+    text = "".join(parts).strip()
+    if not text:
+        return ""
+    
+    properties = paragraph.find(W + "pPr")
+    if properties is not None:
+        style = properties.find(W + "pStyle")
+        style_name = style.get(W + "val", "") if style is not None else ""
+        heading = re.fullmatch(r"(?i)heading(\d)", style_name)
+        if heading:
+            return "#" * min(int(heading.group(1)), 6) + " " + text
+        if style_name.lower() == "title":
+            return "# " + text
+        if properties.find(W + "numPr") is not None or style_name.lower().startswith("list"):
+            return "- " + text
+    return text
+
+def docx_table_text(table):
+    rows = []
+    for row in table.iter(W + "tr"):
+        cells = []
+        for cell in row.findall(W + "tc"):
+            parts = []
+            collect_docx_text(cell, parts)
+            cells.append(" ".join("".join(parts).split()).replace("|", "\\|"))
+        if any(cells):
+            rows.append("| " + " | ".join(cells) + " |")
+    return "\n".join(rows)
+
+def docx_block_text(element):
+    if element.tag == W + "p":
+        return docx_paragraph_text(element)
+    if element.tag == W + "tbl":
+        return docx_table_text(element)
+    if element.tag == W + "sdt":
+        content = element.find(W + "sdtContent")
+        if content is not None:
+            return "\n".join(text for text in (docx_block_text(child) for child in content) if text)
+    return ""
+
+def release_docx_element(element):
+    element.clear()
+    # lxml can also drop already-processed siblings, keeping memory flat on long documents
+    if hasattr(element, "getprevious"):
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+
+def stream_docx_blocks(part, block_depth):
+    """Yields paragraph and table text in document order from a WordprocessingML part."""
+    depth = 0
+    for event, element in docx_etree.iterparse(part, events=("start", "end")):
+        if event == "start":
+            depth += 1
+            continue
+        if depth == block_depth:
+            text = docx_block_text(element)
+            if text:
+                yield text
+            release_docx_element(element)
+        depth -= 1
+
+def stream_docx_notes(part):
+    depth = 0
+    for event, element in docx_etree.iterparse(part, events=("start", "end")):
+        if event == "start":
+            depth += 1
+            continue
+        if depth == 2:
+            if element.get(W + "type") not in DOCX_SKIPPED_NOTE_TYPES:
+                text = "\n".join(text for text in (docx_block_text(child) for child in element) if text)
+                if text:
+                    yield f"[{element.get(W + 'id', '')}] {text}"
+            release_docx_element(element)
+        depth -= 1
+
+def docx_unique_parts(package, names):
+    texts = []
+    for name in names:
+        with package.open(name) as part:
+            text = "\n".join(stream_docx_blocks(part, block_depth=2))
+        if text and text not in texts:
+            texts.append(text)
+    return "\n".join(texts)
+
 def extract_docx_text(file):
     try:
-        doc = Document(file)
-        return "\n".join([paragraph.text for paragraph in doc.paragraphs])
+        with zipfile.ZipFile(file) as package:
+            names = set(package.namelist())
+            sections = []
+            
+            headers = [name for name in sorted(names) if re.fullmatch(r"word/header\d*\.xml", name)]
+            footers = [name for name in sorted(names) if re.fullmatch(r"word/footer\d*\.xml", name)]
+            
+            header_text = docx_unique_parts(package, headers)
+            if header_text:
+                sections.append("Header:\n" + header_text)
+            
+            with package.open(DOCX_BODY_PART) as part:
+                sections.append("\n".join(stream_docx_blocks(part, block_depth=3)))
+            
+            footer_text = docx_unique_parts(package, footers)
+            if footer_text:
+                sections.append("Footer:\n" + footer_text)
+            
+            for name, title in DOCX_NOTE_PARTS:
+                if name in names:
+                    with package.open(name) as part:
+                        notes = list(stream_docx_notes(part))
+                    if notes:
+                        sections.append(f"{title}:\n" + "\n".join(notes))
+            
+            return "\n\n".join(section for section in sections if section.strip())
     except Exception as e:
         return f"Error extracting DOCX text: {str(e)}"
 
+def extract_doc_text(file):
+    # Word 97-2003 binaries: antiword/catdoc read them directly, LibreOffice converts to DOCX
+    try:
+        with tempfile.TemporaryDirectory(prefix="mainframe_doc_") as work_dir:
+            if isinstance(file, str):
+                path = file
+            else:
+                path = os.path.join(work_dir, "input.doc")
+                with open(path, "wb") as f:
+                    file.seek(0)
+                    shutil.copyfileobj(file, f)
+            
+            for tool in ("antiword", "catdoc"):
+                if shutil.which(tool):
+                    result = subprocess.run([tool, path], capture_output=True, timeout=120)
+                    if result.returncode == 0 and result.stdout.strip():
+                        return result.stdout.decode("utf-8", errors="replace")
+            
+            office = shutil.which("soffice") or shutil.which("libreoffice")
+            if office:
+                subprocess.run(
+                    [office, "--headless", "--convert-to", "docx", "--outdir", work_dir, path],
+                    capture_output=True, timeout=300
+                )
+                converted = os.path.join(work_dir, os.path.splitext(os.path.basename(path))[0] + ".docx")
+                if os.path.exists(converted):
+                    return extract_docx_text(converted)
+            
+            return "Error extracting DOC text: no converter available (install antiword or LibreOffice)"
+    except Exception as e:
+        return f"Error extracting DOC text: {str(e)}"
+
 def extract_image_text(file):
     try:
         image = Image.open(file)
@@ -603,12 +780,17 @@ def process_structured_data(file, mime_type):
         if mime_type == 'text/csv':
             df = pd.read_csv(file)
             return df.to_string()
+        elif mime_type == XLSX_MIME_TYPE:
+            sheets = pd.read_excel(file, sheet_name=None)
+            return "\n\n".join(f"Sheet {name}:\n{df.to_string()}" for name, df in sheets.items())
         elif mime_type == 'application/json':
-            return json.dumps(json.load(file), indent=2)
+            with open_source(file) as f:
+                return json.dumps(json.load(f), indent=2)
         elif mime_type == 'application/xml':
             tree = ET.parse(file)
             return ET.tostring(tree.getroot(), encoding='unicode', method='xml')
-        return file.read().decode('utf-8')
+        with open_source(file) as f:
+            return f.read().decode('utf-8')
     except Exception as e:
         return f"Error processing structured data: {str(e)}"
 
@@ -638,19 +820,20 @@ def handle_clipboard_data():
     clipboard_data = st.session_state.get('clipboard_data') 
     if clipboard_data: 
         try: 
+            # Pasted content is spooled straight to the upload store rather than kept as BytesIO
             if clipboard_data['format'] == 'image': 
                 img_data = base64.b64decode(clipboard_data['data'].split(',')[1]) 
-                file = BytesIO(img_data) 
-                file.name = f'pasted_image_{int(time.time())}.png' 
-                #Crucial change: Add the pasted file to uploaded_files 
-                if 'uploaded_files' not in st.session_state: 
-                    st.session_state.uploaded_files = [] 
-                st.session_state.uploaded_files.append(file) 
-                return file  # Return the file object 
+                normalized, mime_type = normalize_image(img_data, 'image/png') 
+                extension = '.jpg' if mime_type == 'image/jpeg' else '.png' 
+                name = f'pasted_image_{int(time.time())}{extension}' 
+                stored = get_upload_store().put(st.session_state.session_id, name, normalized, kind="paste", keep=attached_digests()) 
+                stored.original_size = len(img_data) 
+                return stored 
             elif clipboard_data['format'] == 'text': 
-                file = BytesIO(clipboard_data['data'].encode()) 
-                file.name = f'pasted_text_{int(time.time())}.txt' 
-                return file 
+                name = f'pasted_text_{int(time.time())}.txt' 
+                return get_upload_store().put(
+                    st.session_state.session_id, name, clipboard_data['data'].encode(), kind="paste", keep=attached_digests()
+                ) 
         except Exception as e: 
             st.error(f"Error processing clipboard data: {e}") 
         finally: 
@@ -658,151 +841,282 @@ def handle_clipboard_data():
     return None 
 
 def save_accessibility_preferences():
-    prefs_json = json.dumps(st.session_state.accessibility)
-    st.markdown(
-        f"""
-        <script>
-            localStorage.setItem('mainframe_ai_accessibility', '{prefs_json}');
-        </script>
-        """,
-        unsafe_allow_html=True
-    )
+    set_preference("accessibility", st.session_state.accessibility)
 
+@profiled
 def apply_accessibility_settings():
     if 'accessibility' not in st.session_state:
-        # Try to load from local storage
-        placeholder_div = st.empty()
-        placeholder_div.markdown(
-            """
-            <div id="load_accessibility" style="display:none;"></div>
-            <script>
-                const accDiv = document.getElementById('load_accessibility');
-                const savedPrefs = localStorage.getItem('mainframe_ai_accessibility');
-                if (savedPrefs) {
-                    accDiv.innerText = savedPrefs;
-                } else {
-                    accDiv.innerText = JSON.stringify({
-                        high_contrast: false
-                    });
-                }
-                setTimeout(() => {
-                    window.parent.postMessage({
-                        type: 'streamlit:setComponentValue',
-                        value: accDiv.innerText,
-                        dataType: 'string',
-                        key: 'loaded_accessibility'
-                    }, '*');
-                }, 100);
-            </script>
-            """,
-            unsafe_allow_html=True
-        )
-        
-        # Wait for the JavaScript to set the value
-        if 'loaded_accessibility' in st.session_state:
-            placeholder_div.empty()
-            try:
-                st.session_state.accessibility = json.loads(st.session_state.loaded_accessibility)
-            except:
-                # Default preferences if loading fails
-                st.session_state.accessibility = {
-                    "high_contrast": False
-                }
-        else:
-            # Default preferences
-            st.session_state.accessibility = {
-                "high_contrast": False
-            }
-    
-    # Apply accessibility settings
-    high_contrast = st.session_state.accessibility.get('high_contrast', False)
-    
-    css = []
+        st.session_state.accessibility = get_preference("accessibility", dict(DEFAULT_ACCESSIBILITY))
     
-    if high_contrast:
-        css.append("""
-        * {
-            color: white !important;
-            background-color: black !important;
-        }
-        a, button, .stButton button {
-            color: yellow !important;
-            border-color: yellow !important;
-        }
-        .stTextInput input, .stSelectbox select {
-            color: white !important;
-            background-color: #333 !important;
-            border: 2px solid yellow !important;
-        }
-        """)
-    
-    if css:
-        st.markdown(f"<style>{''.join(css)}</style>", unsafe_allow_html=True)
+    # High contrast is a second stylesheet, linked only while it is on
+    if st.session_state.accessibility.get('high_contrast', False):
+        st.markdown(f'<link rel="stylesheet" href="{static_url("contrast.css")}">', unsafe_allow_html=True)
+
+# File types come from the content, not the name: a signature table is matched against the
+# first few KB, and cheap structural checks run before any extractor touches the file
+MIME_MAPPINGS = {
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg', 
+    '.png': 'image/png',
+    '.gif': 'image/gif',
+    '.bmp': 'image/bmp',
+    '.webp': 'image/webp',
+    '.tiff': 'image/tiff',
+    '.mp4': 'video/mp4',
+    '.avi': 'video/x-msvideo', 
+    '.mov': 'video/quicktime',
+    '.mkv': 'video/x-matroska',
+    '.webm': 'video/webm',
+    '.mp3': 'audio/mpeg',
+    '.wav': 'audio/wav',
+    '.ogg': 'audio/ogg',
+    '.m4a': 'audio/mp4',
+    '.pdf': 'application/pdf',
+    '.doc': 'application/msword',
+    '.docx': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    '.txt': 'text/plain',
+    '.csv': 'text/csv',
+    '.xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    '.json': 'application/json',
+    '.xml': 'application/xml'
+}
+SUPPORTED_MIME_TYPES = set(MIME_MAPPINGS.values())
+TEXT_MIME_TYPES = {'text/plain', 'text/csv', 'application/json', 'application/xml'}
+XLSX_MIME_TYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+# Gemini takes none of these as inline data, so their extracted text is sent instead
+EXTRACTED_MIME_TYPES = {
+    'application/msword',
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    XLSX_MIME_TYPE,
+}
+# DOCX and XLSX are both zip packages; the part that must be present tells them apart
+ZIP_CONTAINER_PARTS = {
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document': 'word/document.xml',
+    'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet': 'xl/workbook.xml',
+}
+SNIFF_BYTES = 4096
+# Order matters: specific signatures come before the generic container they share a prefix with.
+# Short magics that plain text can start with ("BM", "ID3", "OggS") also match the header fields after them.
+MAGIC_SIGNATURES = [
+    (rb"%PDF-", 'application/pdf'),
+    (rb"\x89PNG\r\n\x1a\n", 'image/png'),
+    (rb"\xff\xd8\xff", 'image/jpeg'),
+    (rb"GIF8[79]a", 'image/gif'),
+    (rb"II\*\x00|MM\x00\*", 'image/tiff'),
+    (rb"RIFF....WEBP", 'image/webp'),
+    (rb"RIFF....WAVE", 'audio/wav'),
+    (rb"RIFF....AVI ", 'video/x-msvideo'),
+    (rb"....ftyp", 'video/mp4'),
+    (rb"\x1a\x45\xdf\xa3.{0,64}?webm", 'video/webm'),
+    (rb"\x1a\x45\xdf\xa3", 'video/x-matroska'),
+    (rb"OggS\x00[\x00-\x07]", 'audio/ogg'),
+    (rb"ID3[\x02-\x04]\x00|\xff[\xe2\xe3\xf2\xf3\xfa\xfb]", 'audio/mpeg'),
+    (rb"PK\x03\x04", 'application/zip'),
+    (rb"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1", 'application/msword'),
+    # Reserved bytes are zero and the DIB header has one of the known sizes
+    (rb"BM....\x00\x00\x00\x00....[\x0c\x28\x34\x38\x40\x6c\x7c]\x00\x00\x00", 'image/bmp'),
+]
+# ISO media (MP4, M4A, MOV, HEIC, AVIF) shares one container; the major brand names the content.
+# Generic brands such as isom and mp42 are used by audio and video alike, so the extension decides.
+ISO_MEDIA_BRANDS = {
+    b"M4A ": 'audio/mp4', b"M4B ": 'audio/mp4', b"qt  ": 'video/quicktime',
+    b"heic": 'image/heic', b"heix": 'image/heic', b"mif1": 'image/heif', b"avif": 'image/avif',
+}
+ISO_MEDIA_TYPES = {'video/mp4', 'audio/mp4', 'video/quicktime'}
+MAGIC_PATTERN = re.compile(b"|".join(b"(" + pattern + b")" for pattern, _ in MAGIC_SIGNATURES), re.DOTALL)
+TEXT_CONTROL_BYTES = bytes(set(range(32)) - {9, 10, 12, 13})
+UPLOAD_MAX_PDF_PAGES = int(os.getenv("MAINFRAME_MAX_PDF_PAGES", "1500"))
+UPLOAD_MAX_IMAGE_PIXELS = int(os.getenv("MAINFRAME_MAX_IMAGE_MEGAPIXELS", "50")) * 1000 * 1000
+UPLOAD_MAX_MEDIA_SECONDS = int(os.getenv("MAINFRAME_MAX_MEDIA_MINUTES", "120")) * 60
+UPLOAD_MAX_UNZIPPED = 1024 * 1024 * 1024
+
+def read_header(file, size=SNIFF_BYTES):
+    source = file_source(file)
+    if isinstance(source, str):
+        with open(source, "rb") as f:
+            return f.read(size)
+    if hasattr(source, "getbuffer"):
+        return bytes(source.getbuffer()[:size])
+    position = source.tell()
+    source.seek(0)
+    header = source.read(size)
+    source.seek(position)
+    return header
+
+def sniff_mime_type(header):
+    match = MAGIC_PATTERN.match(header)
+    if match:
+        return MAGIC_SIGNATURES[match.lastindex - 1][1]
+    # The PDF header may follow up to 1 KB of junk
+    if b"%PDF-" in header[:1024]:
+        return 'application/pdf'
+    return None
+
+def looks_like_text(header):
+    if b"\x00" in header:
+        return False
+    return len(header.translate(None, delete=TEXT_CONTROL_BYTES)) >= len(header) * 0.99
 
 def detect_file_type(uploaded_file):
+    # Spooled files remember their type, so the header is read once per upload
+    mime_type = getattr(uploaded_file, "mime_type", None)
+    if mime_type:
+        return mime_type
+    
     filename = uploaded_file.name
-    file_ext = os.path.splitext(filename)[1].lower()
-    
-    mime_mappings = {
-        '.jpg': 'image/jpeg',
-        '.jpeg': 'image/jpeg', 
-        '.png': 'image/png',
-        '.gif': 'image/gif',
-        '.bmp': 'image/bmp',
-        '.webp': 'image/webp',
-        '.tiff': 'image/tiff',
-        '.mp4': 'video/mp4',
-        '.avi': 'video/x-msvideo', 
-        '.mov': 'video/quicktime',
-        '.mkv': 'video/x-matroska',
-        '.webm': 'video/webm',
-        '.mp3': 'audio/mpeg',
-        '.wav': 'audio/wav',
-        '.ogg': 'audio/ogg',
-        '.m4a': 'audio/mp4',
-        '.pdf': 'application/pdf',
-        '.doc': 'application/msword',
-        '.docx': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
-        '.txt': 'text/plain',
-        '.csv': 'text/csv',
-        '.xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-        '.json': 'application/json',
-        '.xml': 'application/xml'
-    }
+    declared = MIME_MAPPINGS.get(os.path.splitext(filename)[1].lower()) or mimetypes.guess_type(filename)[0]
+    header = read_header(uploaded_file)
+    mime_type = sniff_mime_type(header)
     
-    if file_ext in mime_mappings:
-        return mime_mappings[file_ext]
+    if mime_type == 'application/zip':
+        mime_type = declared if declared in ZIP_CONTAINER_PARTS else mime_type
+    elif mime_type == 'video/mp4':
+        mime_type = ISO_MEDIA_BRANDS.get(header[8:12]) or (declared if declared in ISO_MEDIA_TYPES else mime_type)
+    elif mime_type is None:
+        if looks_like_text(header):
+            mime_type = declared if declared in TEXT_MIME_TYPES else 'text/plain'
+        else:
+            mime_type = 'application/octet-stream'
     
-    mime_type, _ = mimetypes.guess_type(filename)
-    return mime_type or 'application/octet-stream'
+    if hasattr(uploaded_file, "mime_type"):
+        uploaded_file.mime_type = mime_type
+    return mime_type
+
+def iter_boxes(f, end):
+    """Yields (type, body offset, end offset) for each ISO media box up to end."""
+    while f.tell() + 8 <= end:
+        start = f.tell()
+        size, kind = struct.unpack(">I4s", f.read(8))
+        header = 8
+        if size == 1:
+            size = struct.unpack(">Q", f.read(8))[0]
+            header = 16
+        elif size == 0:
+            size = end - start
+        if size < header:
+            return
+        yield kind, start + header, start + size
+        f.seek(start + size)
+
+def mp4_duration(f):
+    # Only the box headers are read; moov is found by skipping over mdat, wherever it sits
+    f.seek(0, os.SEEK_END)
+    end = f.tell()
+    f.seek(0)
+    for kind, body, box_end in iter_boxes(f, end):
+        if kind != b"moov":
+            continue
+        f.seek(body)
+        for child, child_body, _ in iter_boxes(f, box_end):
+            if child == b"mvhd":
+                f.seek(child_body)
+                if f.read(1) == b"\x01":
+                    f.seek(child_body + 20)
+                    timescale, duration = struct.unpack(">IQ", f.read(12))
+                else:
+                    f.seek(child_body + 12)
+                    timescale, duration = struct.unpack(">II", f.read(8))
+                return duration / timescale if timescale else None
+        return None
+    return None
+
+def wav_duration(f):
+    f.seek(12)
+    byte_rate = None
+    while True:
+        chunk = f.read(8)
+        if len(chunk) < 8:
+            return None
+        kind, size = struct.unpack("<4sI", chunk)
+        if kind == b"fmt ":
+            byte_rate = struct.unpack("<I", f.read(12)[8:12])[0]
+            f.seek(size - 12 + (size & 1), os.SEEK_CUR)
+        elif kind == b"data":
+            return size / byte_rate if byte_rate else None
+        else:
+            f.seek(size + (size & 1), os.SEEK_CUR)
+
+def validate_upload(file):
+    """Checks an upload's type and size limits from its headers. Returns why it was rejected, or None."""
+    mime_type = detect_file_type(file)
+    if mime_type not in SUPPORTED_MIME_TYPES:
+        return "its contents are not a supported file type"
+    if file.size == 0:
+        return "the file is empty"
     
+    source = file_source(file)
+    try:
+        if mime_type == 'application/pdf':
+            if fitz:
+                with fitz.open(source) as pdf_document:
+                    if pdf_document.needs_pass:
+                        return "the PDF is password-protected"
+                    pages = pdf_document.page_count
+            else:
+                pdf = PdfReader(source)
+                if pdf.is_encrypted:
+                    return "the PDF is password-protected"
+                pages = len(pdf.pages)
+            if pages > UPLOAD_MAX_PDF_PAGES:
+                return f"the PDF has {pages} pages; the limit is {UPLOAD_MAX_PDF_PAGES}"
+        elif mime_type.startswith('image/'):
+            # Image.open only parses the header; pixels are decoded later, if at all
+            with Image.open(source) as image:
+                width, height = image.size
+            if width * height > UPLOAD_MAX_IMAGE_PIXELS:
+                return f"the image is {width}x{height}; the limit is {UPLOAD_MAX_IMAGE_PIXELS // 1000000} megapixels"
+        elif mime_type in ('audio/wav', 'video/mp4', 'video/quicktime', 'audio/mp4'):
+            with open_source(source) as f:
+                duration = wav_duration(f) if mime_type == 'audio/wav' else mp4_duration(f)
+            if duration is None:
+                return "the file is truncated or its header is damaged"
+            if duration > UPLOAD_MAX_MEDIA_SECONDS:
+                return f"it runs {format_timestamp(duration)}; the limit is {UPLOAD_MAX_MEDIA_SECONDS // 60} minutes"
+        elif mime_type in ZIP_CONTAINER_PARTS:
+            with zipfile.ZipFile(source) as package:
+                names = package.namelist()
+                unzipped = sum(info.file_size for info in package.infolist())
+            if ZIP_CONTAINER_PARTS[mime_type] not in names:
+                return "the package is missing its main document part"
+            if unzipped > UPLOAD_MAX_UNZIPPED:
+                return f"it expands to {format_bytes(unzipped)}, more than {format_bytes(UPLOAD_MAX_UNZIPPED)}"
+    except Exception:
+        return f"it could not be read as {mime_type}"
+    return None
+
+@profiled
 def initialize_session_state():
+    if 'session_id' not in st.session_state:
+        st.session_state.session_id = get_session_id()
+
+    # Load stored preferences (one browser round trip for all of them)
+    sync_preferences()
+
     # Initialize font preferences
     initialize_font_preferences()
     apply_font_preferences()
     apply_accessibility_settings()
     
     if 'chat_model' not in st.session_state:
-        st.session_state.chat_model = genai.GenerativeModel(
-            model_name="gemini-1.5-flash",
-            generation_config=generation_config,
-            system_instruction=SYSTEM_INSTRUCTION,
-        )
+        st.session_state.chat_model = get_route_model(DEFAULT_ROUTE)
+
+    if 'history_limit' not in st.session_state:
+        st.session_state.history_limit = HISTORY_PAGE_SIZE
 
     if 'chat_session' not in st.session_state:
-        st.session_state.chat_session = st.session_state.chat_model.start_chat(history=[])
+        st.session_state.chat_session = st.session_state.chat_model.start_chat(
+            history=build_chat_history(st.session_state.session_id)
+        )
 
     if 'messages' not in st.session_state:
-        initial_message = """Hello! Mainframe AI speaking. How can I assist you today?"""
-        st.session_state.messages = [
-            {"role": "assistant", "content": initial_message}
-        ]
+        load_history()
     
     if 'uploaded_files' not in st.session_state:
         st.session_state.uploaded_files = []
         
-    if 'processed_audio_hashes' not in st.session_state:
-        st.session_state.processed_audio_hashes = set()
+    # The recorder only ever holds the latest clip, so one hash is enough to skip reruns of it
+    if 'last_audio_hash' not in st.session_state:
+        st.session_state.last_audio_hash = None
         
     if 'camera_image' not in st.session_state:
         st.session_state.camera_image = None
@@ -820,10 +1134,15 @@ def initialize_session_state():
     # For custom command form
     if 'show_custom_cmd_form' not in st.session_state:
         st.session_state.show_custom_cmd_form = False
+    
+    if 'fan_out_commands' not in st.session_state:
+        st.session_state.fan_out_commands = []
 
+@profiled
 def get_audio_hash(audio_data):
     return hashlib.md5(audio_data.getvalue()).hexdigest()
 
+@profiled
 def convert_audio_to_text(audio_file):
     recognizer = sr.Recognizer()
     try:
@@ -836,12 +1155,14 @@ def convert_audio_to_text(audio_file):
     except sr.RequestError as e:
         raise Exception(f"Could not request results from speech recognition service; {str(e)}")
 
+@profiled
 def save_audio_file(audio_data):
     audio_bytes = audio_data.getvalue()
     with tempfile.NamedTemporaryFile(delete=False, suffix='.wav') as tmpfile:
         tmpfile.write(audio_bytes)
         return tmpfile.name
 
+@profiled
 def handle_chat_response(response, message_placeholder, command_message=""):
     full_response = ""
     
@@ -872,36 +1193,54 @@ def handle_chat_response(response, message_placeholder, command_message=""):
     message_placeholder.markdown(full_response, unsafe_allow_html=True)
     return full_response
     
+@profiled
 def show_file_preview(uploaded_file):
     mime_type = detect_file_type(uploaded_file)
     
     if mime_type.startswith('image/'):
-        st.sidebar.image(uploaded_file, use_container_width=True)
+        st.sidebar.image(file_source(uploaded_file), use_container_width=True)
     elif mime_type.startswith('video/'):
-        st.sidebar.video(uploaded_file)
+        st.sidebar.video(file_source(uploaded_file))
     elif mime_type.startswith('audio/'):
-        st.sidebar.audio(uploaded_file)
+        st.sidebar.audio(file_source(uploaded_file))
     else:
         st.sidebar.info(f"Uploaded: {uploaded_file.name} (Type: {mime_type})")
 
+def extract_file_text(file, mime_type):
+    """Returns the text of a document, image or data upload, or None for types with no extractor."""
+    source = file_source(file)
+    extractor = None
+    if mime_type.startswith('application/pdf'):
+        extractor = extract_pdf_text
+    elif mime_type == 'application/msword':
+        extractor = extract_doc_text
+    elif mime_type == 'application/vnd.openxmlformats-officedocument.wordprocessingml.document':
+        extractor = extract_docx_text
+    elif mime_type.startswith('image/'):
+        extractor = extract_image_text
+    elif mime_type in TEXT_MIME_TYPES or mime_type == XLSX_MIME_TYPE:
+        extractor = lambda source: process_structured_data(source, mime_type)
+    
+    if extractor and getattr(file, "digest", None):
+        # Spooled files are content-addressed, so any worker can reuse the text
+        return cached_text("extract", f"{file.digest}:{mime_type}", lambda: extractor(source), EXTRACTION_CACHE_TTL)
+    if extractor:
+        return extractor(source)
+    return None
+
 def prepare_chat_input(prompt, files):
     input_parts = []
     
     for file in files:
         mime_type = detect_file_type(file)
-        content = None
         
         try:
-            if mime_type.startswith('application/pdf'):
-                content = extract_pdf_text(file)
-            elif mime_type in ['application/msword', 'application/vnd.openxmlformats-officedocument.wordprocessingml.document']:
-                content = extract_docx_text(file)
-            elif mime_type.startswith('image/'):
-                content = extract_image_text(file)
-            elif mime_type in ['text/csv', 'application/json', 'application/xml', 'text/plain']:
-                content = process_structured_data(file, mime_type)
+            content = extract_file_text(file, mime_type)
             
-            if content:
+            if content and content.startswith("Error "):
+                # Extractors report failures as text; show it instead of sending it as document content
+                st.error(f"{file.name}: {content}")
+            elif content:
                 input_parts.append({
                     'type': mime_type,
                     'content': content,
@@ -914,209 +1253,2661 @@ def prepare_chat_input(prompt, files):
     input_parts.append(prompt)
     return input_parts
 
-def main(): 
-    # Check password and get access level 
-    password_correct, access_level = check_password() 
-    if not password_correct: 
-        return 
-    
-    initialize_session_state()
+# Local storage for server-side state (checkpoints, caches, ...)
+DATA_DIR = os.getenv("MAINFRAME_DATA_DIR", os.path.join(tempfile.gettempdir(), "mainframe_ai"))
 
-    # Set the title based on access level 
-    title_suffix = f" ({access_level} Level)" if access_level else "" 
-    st.title(f"💬 Mainframe AI{title_suffix}") 
+# Caches and rate-limit buckets shared between worker processes.
+# "memory" is per process; "sqlite" is shared by every worker on one host (put the file
+# under /dev/shm to keep it in RAM); "redis" is shared across hosts.
+SHARED_BACKEND = os.getenv("MAINFRAME_SHARED_BACKEND", "memory")
+SHARED_DB_PATH = os.getenv("MAINFRAME_SHARED_DB", os.path.join(DATA_DIR, "shared.db"))
+REDIS_URL = os.getenv("MAINFRAME_REDIS_URL", "redis://localhost:6379/0")
+MEMORY_BACKEND_ENTRIES = 1024
+SHARED_PURGE_EVERY = 500
+EXTRACTION_CACHE_TTL = 7 * 24 * 60 * 60
+RESPONSE_CACHE_TTL = 24 * 60 * 60
 
-    # Sign Out Button and Settings
-    with st.sidebar:
-        
-        # Conditional display of sidebar elements 
-        if access_level: #Only show if password is correct 
-            if access_level != "Bronze": 
-                with st.expander("**Settings & Preferences**", expanded=False): 
-                    # Font selection
-                    available_fonts = [
-                        "Montserrat", "Orbitron", "DM Sans", "Calibri", 
-                        "Arial", "Times New Roman", "Roboto", "Open Sans",
-                        "Lato", "Poppins", "Ubuntu", "Playfair Display"
-                    ]
-                    
-                    # Font search/filter
-                    font_search = st.text_input("Search Fonts", key="font_search")
-                    filtered_fonts = [f for f in available_fonts if font_search.lower() in f.lower()] if font_search else available_fonts
-                    
-                    font_family = st.selectbox(
-                        "Font Family",
-                        filtered_fonts,
-                        index=filtered_fonts.index(st.session_state.font_preferences["font_family"]) if st.session_state.font_preferences["font_family"] in filtered_fonts else 0,
-                        key="font_family_select"
-                    )
-                    
-                    # Font selection and application button
-                    if st.button("Apply Font", key="apply_font"):
-                        st.session_state.font_preferences = {
-                            "font_family": font_family
-                        }
-                        save_font_preferences()
-                        st.rerun()
-                    
-                    # Add accessibility options directly (not in another expander)
-                    st.markdown("---")
-                    st.markdown("**Accessibility Options**")
-                    
-                    # Initialize accessibility state if needed
-                    if 'accessibility' not in st.session_state:
-                        st.session_state.accessibility = {
-                            'high_contrast': False
-                        }
-                    
-                    # High contrast mode
-                    high_contrast = st.checkbox(
-                        "High Contrast Mode", 
-                        value=st.session_state.accessibility.get('high_contrast', False),
-                        key="high_contrast",
-                        help="Increases color contrast for better visibility"
-                    )
-                    
-                    
-                    # Apply settings button
-                    if st.button("Apply Settings", key="apply_accessibility"):
-                        st.session_state.accessibility = {
-                            'high_contrast': high_contrast
-                        }
-                        save_accessibility_preferences()
-                        st.rerun()
+class MemoryBackend:
+    def __init__(self, max_entries=MEMORY_BACKEND_ENTRIES):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.buckets = {}
+        self.max_entries = max_entries
 
-            if access_level == "Platinum": 
-                with st.expander("**File Upload**", expanded=False): 
-                    st.markdown("**ALWAYS** upload one file at a time.")
-                    clipboard_file = handle_clipboard_data()
-                    if clipboard_file:
-                        st.session_state.uploaded_files.append(clipboard_file)
-                    uploaded_files = st.file_uploader(
-                        "Upload files to analyze", 
-                        type=[
-                            'png', 'jpg', 'jpeg', 'gif', 'bmp', 'webp', 'tiff',
-                            'mp4', 'avi', 'mov', 'mkv', 'webm',
-                            'mp3', 'wav', 'ogg', 'm4a',
-                            'pdf', 'doc', 'docx', 'txt', 'csv', 'xlsx', 'json', 'xml'
-                        ],
-                        accept_multiple_files=True
-                    )
-        
-                    if uploaded_files:
-                        oversized_files = []
-                        valid_files = []
-                        
-                        for file in uploaded_files:
-                            if file.size > 100 * 1024 * 1024:  # 100MB limit
-                                oversized_files.append(file.name)
-                            else:
-                                valid_files.append(file)
-                        
-                        if oversized_files:
-                            st.warning(f"Files exceeding 100MB limit: {', '.join(oversized_files)}")
-                        
-                        st.session_state.uploaded_files = valid_files
+    def get(self, namespace, key):
+        with self.lock:
+            entry = self.entries.get((namespace, key))
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires is not None and expires < time.time():
+                del self.entries[(namespace, key)]
+                return None
+            self.entries.move_to_end((namespace, key))
+            return value
 
-            if access_level in ["Silver", "Gold", "Platinum"]: 
-                with st.expander("**Camera Input**", expanded=False): 
-                    camera_enabled = st.checkbox("Enable camera", value=st.session_state.camera_enabled)
-                    
-                    if camera_enabled != st.session_state.camera_enabled:
-                        st.session_state.camera_enabled = camera_enabled
-                        st.session_state.camera_image = None
-                        
-                    if st.session_state.camera_enabled:
-                        camera_image = st.camera_input("Take a picture")
-                        if camera_image is not None:
-                            st.session_state.camera_image = camera_image
-                            st.image(camera_image, caption="Captured Image")
-                            st.success("Image captured! You can now ask about the image.")
+    def set(self, namespace, key, value, ttl=None):
+        with self.lock:
+            self.entries[(namespace, key)] = (value, time.time() + ttl if ttl else None)
+            self.entries.move_to_end((namespace, key))
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
 
-                with st.expander("**Voice Input**", expanded=False): 
-                    audio_input = st.audio_input("Record your question")
+    def take_token(self, name, rate, capacity):
+        """Takes one token from the named bucket; returns 0, or the seconds to wait before retrying."""
+        with self.lock:
+            now = time.monotonic()
+            tokens, updated = self.buckets.get(name, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            self.buckets[name] = (tokens, now)
+            return wait
 
-            if access_level in ["Gold", "Platinum"]: 
-                with st.expander("**Prebuilt Commands**", expanded=False): 
-                    if 'current_command' not in st.session_state:
-                        st.session_state.current_command = None
-                        
-                    st.write("**Active:**", st.session_state.current_command if st.session_state.current_command else "None")
-                    
-                    for cmd, info in PREBUILT_COMMANDS.items():
-                        col1, col2 = st.columns([4, 1])
-                        
-                        with col1:
-                            button_active = st.session_state.current_command == cmd
-                            if st.button(
-                                info["title"],
-                                key=f"cmd_{cmd}",
-                                type="primary" if button_active else "secondary"
-                            ):
-                                if st.session_state.current_command == cmd:
-                                    st.session_state.current_command = None
-                                else:
-                                    st.session_state.current_command = cmd
-                                st.rerun()
-                        
-                        with col2:
-                            help_key = f"help_{cmd}"
-                            if help_key not in st.session_state:
-                                st.session_state[help_key] = False
-                            
-                            button_text = "×" if st.session_state[help_key] else "?"
-                            if st.button(button_text, key=f"help_btn_{cmd}"):
-                                st.session_state[help_key] = not st.session_state[help_key]
-                                st.rerun()
-                        
-                        if st.session_state[help_key]:
-                            st.info(info["description"])
+class SQLiteBackend:
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.lock = threading.Lock()
+        self.writes = 0
+        # Autocommit, so take_token can hold its own BEGIN IMMEDIATE across the read and the write
+        self.conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS cache (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value BLOB NOT NULL,
+                expires REAL,
+                PRIMARY KEY (namespace, key)
+            )"""
+        )
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS buckets (
+                name TEXT PRIMARY KEY,
+                tokens REAL NOT NULL,
+                updated REAL NOT NULL
+            )"""
+        )
 
-    # Display messages
-    for message in st.session_state.messages:
-        with st.chat_message(message["role"]):
-            st.markdown(message["content"], unsafe_allow_html=True)
+    def get(self, namespace, key):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT value, expires FROM cache WHERE namespace = ? AND key = ?", (namespace, key)
+            ).fetchone()
+        if row is None or (row[1] is not None and row[1] < time.time()):
+            return None
+        return row[0]
 
-    # Handle audio input safely
-    audio_input = None  # Initialize the variable to avoid UnboundLocalError
-    
-    if 'audio_input' in st.session_state:
-        audio_input = st.session_state.audio_input
-    
-    # Handle audio input
-    if audio_input is not None:
-        audio_hash = get_audio_hash(audio_input)
-        
-        if audio_hash not in st.session_state.processed_audio_hashes:
+    def set(self, namespace, key, value, ttl=None):
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO cache (namespace, key, value, expires) VALUES (?, ?, ?, ?)",
+                (namespace, key, value, now + ttl if ttl else None),
+            )
+            self.writes += 1
+            if self.writes % SHARED_PURGE_EVERY == 0:
+                self.conn.execute("DELETE FROM cache WHERE expires < ?", (now,))
+
+    def take_token(self, name, rate, capacity):
+        with self.lock:
+            # The write lock makes the read-refill-write atomic across processes
+            self.conn.execute("BEGIN IMMEDIATE")
             try:
-                audio_file = save_audio_file(audio_input)
-                st.audio(audio_input, format='audio/wav')
-                
-                try:
-                    st.info("Converting speech to text...")
-                    transcribed_text = convert_audio_to_text(audio_file)
-                    
-                    st.success("Speech converted to text!")
-                    st.text(f"Transcribed text: {transcribed_text}")
-                    
-                    st.chat_message("user").markdown(transcribed_text)
-                    st.session_state.messages.append({"role": "user", "content": transcribed_text})
-                    
-                    with st.chat_message("assistant"):
-                        message_placeholder = st.empty()
-                        response = st.session_state.chat_session.send_message(transcribed_text)
-                        full_response = handle_chat_response(response, message_placeholder)
+                now = time.time()
+                row = self.conn.execute("SELECT tokens, updated FROM buckets WHERE name = ?", (name,)).fetchone()
+                tokens = capacity if row is None else min(capacity, row[0] + max(0.0, now - row[1]) * rate)
+                wait = 0.0
+                if tokens >= 1:
+                    tokens -= 1
+                else:
+                    wait = (1 - tokens) / rate
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO buckets (name, tokens, updated) VALUES (?, ?, ?)", (name, tokens, now)
+                )
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+        return wait
+
+# Refill and take in one server-side step; the Redis clock is shared by every host
+REDIS_TOKEN_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or capacity
+local updated = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return tostring(wait)
+"""
+
+class RedisBackend:
+    """Works with any redis-py compatible client, including in-process stand-ins such as fakeredis."""
+
+    def __init__(self, client, prefix="mainframe:"):
+        self.client = client
+        self.prefix = prefix
+        self.token_script = client.register_script(REDIS_TOKEN_SCRIPT)
+
+    def get(self, namespace, key):
+        return self.client.get(f"{self.prefix}{namespace}:{key}")
+
+    def set(self, namespace, key, value, ttl=None):
+        self.client.set(f"{self.prefix}{namespace}:{key}", value, ex=int(ttl) if ttl else None)
+
+    def take_token(self, name, rate, capacity):
+        return float(self.token_script(keys=[f"{self.prefix}bucket:{name}"], args=[rate, capacity]))
+
+@st.cache_resource
+def get_shared_backend():
+    if SHARED_BACKEND == "sqlite":
+        return SQLiteBackend(SHARED_DB_PATH)
+    if SHARED_BACKEND == "redis":
+        if redis is None:
+            raise RuntimeError("MAINFRAME_SHARED_BACKEND=redis needs the redis package")
+        return RedisBackend(redis.Redis.from_url(REDIS_URL))
+    return MemoryBackend()
+
+def cached_text(namespace, key, compute, ttl):
+    """Returns compute() through the shared cache; text is stored zlib-compressed."""
+    backend = get_shared_backend()
+    cached = backend.get(namespace, key)
+    if cached is not None:
+        return zlib.decompress(cached).decode("utf-8")
+    text = compute()
+    # Extractors report failures as "Error ..." text; those are retried, not cached
+    if text and not text.startswith("Error "):
+        backend.set(namespace, key, zlib.compress(text.encode("utf-8")), ttl)
+    return text
+
+# Model request throttling. The requests-per-minute bucket lives in the shared backend, so
+# every worker draws on one quota; the in-flight cap is per process.
+MODEL_REQUESTS_PER_MINUTE = int(os.getenv("MAINFRAME_REQUESTS_PER_MINUTE", "60"))
+MODEL_MAX_CONCURRENCY = int(os.getenv("MAINFRAME_MAX_CONCURRENCY", "4"))
+
+class RateLimiter:
+    """Token bucket (requests per minute) combined with a cap on in-flight requests."""
+
+    def __init__(self, requests_per_minute, max_concurrency, backend, name="model_requests"):
+        self.rate = requests_per_minute / 60.0
+        self.capacity = max(1.0, float(max_concurrency))
+        self.max_concurrency = max_concurrency
+        self.backend = backend
+        self.name = name
+        self.slots = threading.BoundedSemaphore(max_concurrency)
+
+    def acquire(self, deadline=None):
+        while True:
+            wait = self.backend.take_token(self.name, self.rate, self.capacity)
+            if not wait:
+                return
+            if deadline is not None and time.monotonic() + wait > deadline:
+                raise RequestDeadlineExceeded("The request quota was not available before the time limit.")
+            time.sleep(wait)
+
+    @contextmanager
+    def slot(self, deadline=None):
+        # Time spent queueing here counts against the caller's deadline (time.monotonic)
+        timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+        if not self.slots.acquire(timeout=timeout):
+            raise RequestDeadlineExceeded("No request slot was free before the time limit.")
+        try:
+            self.acquire(deadline)
+            yield
+        finally:
+            self.slots.release()
+
+@st.cache_resource
+def get_rate_limiter():
+    return RateLimiter(MODEL_REQUESTS_PER_MINUTE, MODEL_MAX_CONCURRENCY, get_shared_backend())
+
+# Map-reduce summarization for documents larger than a single request
+MAP_REDUCE_COMMANDS = {"/summarize", "/litanalysis"}
+MAP_REDUCE_THRESHOLD_TOKENS = int(os.getenv("MAINFRAME_MAP_REDUCE_THRESHOLD", "100000"))
+MAP_REDUCE_CHUNK_TOKENS = 24000
+MAP_REDUCE_FAN_IN = 8
+MAP_REDUCE_INSTRUCTION_TOKENS = 2000
+# A stuck section fails after this long; the checkpoint keeps the others for the retry
+MAP_REDUCE_SECTION_TIMEOUT = float(os.getenv("MAINFRAME_MAP_REDUCE_SECTION_TIMEOUT", "120"))
+MAP_REDUCE_VERSION = "1"
+CHARS_PER_TOKEN = 4
+CHECKPOINT_DIR = os.path.join(DATA_DIR, "checkpoints")
+
+MAP_REDUCE_FOCUS = {
+    "/summarize": "Capture the key points, important concepts, facts and key definitions.",
+    "/litanalysis": "Capture the plot events, characters and their development, themes, main ideas and symbolism, with short quotes where they matter.",
+}
+
+MAP_PROMPT = """You are reading section {index} of {total} of a longer document. Write detailed notes on this section only. {focus}
+Do not add an introduction or conclusion.
+
+{chunk}"""
+
+REDUCE_PROMPT = """The following are notes on consecutive sections of one document, in order. Merge them into a single set of notes that keeps the order of events and every important detail while removing repetition. {focus}
+
+{notes}"""
+
+MAP_REDUCE_FINAL_NOTE = "The document was too long to send whole, so it was condensed section by section. The notes below cover the entire document in order; treat them as the document itself."
+
+def estimate_tokens(text):
+    # Rough heuristic that avoids a count_tokens round trip for every check
+    return len(text) // CHARS_PER_TOKEN + 1
+
+def split_oversized_text(text, max_chars):
+    pieces = []
+    current = ""
+    for sentence in re.split(r'(?<=[.!?])\s+', text):
+        while len(sentence) > max_chars:
+            if current:
+                pieces.append(current)
+                current = ""
+            pieces.append(sentence[:max_chars])
+            sentence = sentence[max_chars:]
+        if current and len(current) + len(sentence) + 1 > max_chars:
+            pieces.append(current)
+            current = ""
+        current = f"{current} {sentence}" if current else sentence
+    if current:
+        pieces.append(current)
+    return pieces
+
+def split_into_chunks(text, max_tokens=MAP_REDUCE_CHUNK_TOKENS):
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    chunks = []
+    current = []
+    current_len = 0
+    
+    for paragraph in re.split(r'\n\s*\n', text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        pieces = [paragraph] if len(paragraph) <= max_chars else split_oversized_text(paragraph, max_chars)
+        for piece in pieces:
+            if current and current_len + len(piece) + 2 > max_chars:
+                chunks.append("\n\n".join(current))
+                current = []
+                current_len = 0
+            current.append(piece)
+            current_len += len(piece) + 2
+    
+    if current:
+        chunks.append("\n\n".join(current))
+    return chunks
+
+def group_for_reduce(partials, max_tokens=MAP_REDUCE_CHUNK_TOKENS):
+    groups = []
+    current = []
+    current_tokens = 0
+    for partial in partials:
+        tokens = estimate_tokens(partial)
+        if current and (len(current) >= MAP_REDUCE_FAN_IN or current_tokens + tokens > max_tokens):
+            groups.append(current)
+            current = []
+            current_tokens = 0
+        current.append(partial)
+        current_tokens += tokens
+    if current:
+        groups.append(current)
+    return groups
+
+def load_checkpoint(key):
+    try:
+        with open(os.path.join(CHECKPOINT_DIR, f"{key}.json"), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_checkpoint(key, data):
+    os.makedirs(CHECKPOINT_DIR, exist_ok=True)
+    path = os.path.join(CHECKPOINT_DIR, f"{key}.json")
+    # Write then rename so a crash never leaves a half-written checkpoint
+    with tempfile.NamedTemporaryFile("w", dir=CHECKPOINT_DIR, delete=False, suffix=".tmp", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(f.name, path)
+
+def clear_checkpoint(key):
+    try:
+        os.unlink(os.path.join(CHECKPOINT_DIR, f"{key}.json"))
+    except OSError:
+        pass
+
+def call_model(model, limiter, prompt, usage=None, config=None, timeout=MAP_REDUCE_SECTION_TIMEOUT, deadline=None):
+    # One-shot request from a worker thread; usage tags are built on the script thread
+    with limiter.slot(deadline):
+        started = time.perf_counter()
+        try:
+            response = model.generate_content(prompt, generation_config=config, request_options={"timeout": timeout})
+        except Exception:
+            if usage:
+                record_usage(usage, None, time.perf_counter() - started, ok=False)
+            raise
+        if usage:
+            record_usage(usage, response, time.perf_counter() - started)
+        return response.text
+
+def generate_text(model, limiter, prompt, usage=None):
+    # Identical section prompts (the same document summarized again, on any worker) reuse the notes
+    key = hashlib.sha256(f"{model.model_name}\0{prompt}".encode("utf-8")).hexdigest()
+    return cached_text("responses", key, lambda: call_model(model, limiter, prompt, usage), RESPONSE_CACHE_TTL)
+
+def run_map_reduce_stage(stage, prompts, model, limiter, checkpoint, key, progress=None, label="", usage=None):
+    done = checkpoint.setdefault(stage, {})
+    results = [done.get(str(i)) for i in range(len(prompts))]
+    pending = [i for i, result in enumerate(results) if result is None]
+    first_error = None
+    
+    if progress:
+        progress(len(prompts) - len(pending), len(prompts), label)
+    
+    with ThreadPoolExecutor(max_workers=limiter.max_concurrency) as pool:
+        futures = {pool.submit(generate_text, model, limiter, prompts[i], usage): i for i in pending}
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                results[i] = future.result()
+            except Exception as e:
+                # Keep collecting so every finished section is checkpointed before failing
+                first_error = first_error or e
+                continue
+            done[str(i)] = results[i]
+            save_checkpoint(key, checkpoint)
+            if progress:
+                progress(sum(result is not None for result in results), len(prompts), label)
+    
+    if first_error:
+        raise first_error
+    return results
+
+@profiled
+def run_map_reduce(document_text, command, model, limiter, progress=None, usage=None):
+    """Condenses a document into ordered notes that fit in one request. Returns (notes, checkpoint_key)."""
+    focus = MAP_REDUCE_FOCUS.get(command.name, MAP_REDUCE_FOCUS["/summarize"])
+    # Keyed on the command's digest, so editing a command never resumes notes made for the old version
+    key = hashlib.sha256(f"{MAP_REDUCE_VERSION}\0{command.digest}\0{document_text}".encode("utf-8")).hexdigest()
+    checkpoint = load_checkpoint(key)
+    
+    chunks = split_into_chunks(document_text)
+    prompts = [
+        MAP_PROMPT.format(index=i + 1, total=len(chunks), focus=focus, chunk=chunk)
+        for i, chunk in enumerate(chunks)
+    ]
+    partials = run_map_reduce_stage("map", prompts, model, limiter, checkpoint, key, progress, "Reading sections", usage)
+    
+    # Reduce in rounds until the notes fit in a single request
+    round_number = 1
+    while len(partials) > 1 and estimate_tokens("\n\n".join(partials)) > MAP_REDUCE_CHUNK_TOKENS:
+        groups = group_for_reduce(partials)
+        prompts = [REDUCE_PROMPT.format(focus=focus, notes="\n\n".join(group)) for group in groups]
+        partials = run_map_reduce_stage(
+            f"reduce_{round_number}", prompts, model, limiter, checkpoint, key, progress,
+            f"Combining notes (round {round_number})", usage
+        )
+        round_number += 1
+    
+    return "\n\n".join(partials), key
+
+@profiled
+def collect_document_text(prompt, files):
+    parts = prepare_chat_input(prompt, files)
+    texts = [part['content'] for part in parts if isinstance(part, dict)]
+    texts.append(prompt)
+    return "\n\n".join(texts)
+
+# Upper bounds on the text a file can yield, read from headers; extraction (and OCR) only runs
+# when the bound says the input could need map-reduce
+PDF_PAGE_MAX_TOKENS = 2000
+IMAGE_TEXT_MAX_TOKENS = 2000
+
+def document_token_ceiling(file):
+    mime_type = detect_file_type(file)
+    source = file_source(file)
+    try:
+        if mime_type == 'application/pdf':
+            if fitz:
+                with fitz.open(source) as pdf_document:
+                    return pdf_document.page_count * PDF_PAGE_MAX_TOKENS
+            return len(PdfReader(source).pages) * PDF_PAGE_MAX_TOKENS
+        if mime_type in ZIP_CONTAINER_PARTS:
+            # Markup makes the XML parts larger than the text in them
+            with zipfile.ZipFile(source) as package:
+                return sum(info.file_size for info in package.infolist() if info.filename.endswith(".xml")) // CHARS_PER_TOKEN
+    except Exception:
+        pass
+    if mime_type.startswith('image/'):
+        return IMAGE_TEXT_MAX_TOKENS
+    if mime_type.startswith(('video/', 'audio/')) or mime_type == 'application/octet-stream':
+        return 0
+    return file.size // CHARS_PER_TOKEN
+
+
+# Per-item mode for list commands: each term or problem is answered on its own, in parallel,
+# cached by command and normalized item, then put back together in order
+LIST_COMMANDS = {"/weeklyhgflashcards", "/synonyms", "/answer4math"}
+LIST_MIN_ITEMS = 4
+LIST_MAX_ITEMS = int(os.getenv("MAINFRAME_LIST_MAX_ITEMS", "100"))
+# Requests one list may send, so a single student can't drain the shared per-minute quota; past
+# this the uncached items are grouped several to a request and the answers split back apart
+LIST_MAX_REQUESTS = int(os.getenv("MAINFRAME_LIST_MAX_REQUESTS", str(max(1, MODEL_REQUESTS_PER_MINUTE // 4))))
+LIST_BATCH_NOTE = (
+    "Answer each item marked [[n]] above on its own. Start each answer with a line holding only that "
+    "item's marker, such as [[1]], and do not repeat the item itself."
+)
+LIST_BATCH_ANSWER = re.compile(r"^[ \t*#]*\[\[(\d+)\]\][ \t*]*$", re.MULTILINE)
+# In-flight items per list; the rest of the process's slots stay free for other sessions
+LIST_MAX_PARALLEL = max(1, MODEL_MAX_CONCURRENCY // 2)
+LIST_ITEM_CACHE_TTL = 30 * 24 * 3600
+LIST_MARKER = re.compile(r"^(?:(?P<number>#?\d{1,3}[.)])|[-*•+])\s+")
+# Unmarked items must be bare terms: up to three words of letters, no digits or sentence punctuation
+LIST_WORD = r"[^\W\d_]+(?:['’-][^\W\d_]+)*"
+LIST_TERM = re.compile(rf"{LIST_WORD}(?: {LIST_WORD}){{0,2}}")
+
+def split_list_items(text):
+    """Returns (preamble, [(label, item), ...]) when the text is a list, else None."""
+    lines = [line.strip() for line in text.splitlines() if line.strip()]
+    preamble = []
+    items = []
+    if sum(1 for line in lines if LIST_MARKER.match(line)) >= LIST_MIN_ITEMS:
+        for line in lines:
+            match = LIST_MARKER.match(line)
+            if match:
+                items.append([match.group("number") or "", line[match.end():]])
+            elif items:
+                # Unmarked lines continue the item above (multi-line problems)
+                items[-1][1] += "\n" + line
+            else:
+                preamble.append(line)
+    elif lines:
+        # Unmarked lines or one comma-separated line only count when every piece is a bare term;
+        # a word problem or paragraph split into lines would lose its context
+        if len(lines) > 1 and lines[0].endswith(":"):
+            preamble, lines = lines[:1], lines[1:]
+        if len(lines) == 1:
+            head, _, terms = lines[0].rpartition(":")
+            preamble += [head + ":"] if head else []
+            lines = re.split(r"[;,]", terms)
+        pieces = [" ".join(line.split()) for line in lines if line.strip()]
+        if all(LIST_TERM.fullmatch(piece) for piece in pieces):
+            items = [["", piece] for piece in pieces]
+    if not LIST_MIN_ITEMS <= len(items) <= LIST_MAX_ITEMS:
+        return None
+    return "\n".join(preamble), [tuple(item) for item in items]
+
+def normalize_item(text):
+    return re.sub(r"\s+", " ", text).strip(" .;,:").lower()
+
+def split_batch_answers(text, count):
+    """Maps item index to its answer in a batched reply; items the model skipped are left out."""
+    pieces = LIST_BATCH_ANSWER.split(text)
+    answers = {}
+    for number, answer in zip(pieces[1::2], pieces[2::2]):
+        index = int(number) - 1
+        if 0 <= index < count and index not in answers and answer.strip():
+            answers[index] = answer.strip()
+    return answers
+
+@profiled
+def run_list_command(chat_session, command, preamble, items, progress=None):
+    """Answers the items separately, in parallel, and returns the reassembled text and the route.
+    When the uncached items outnumber LIST_MAX_REQUESTS they are sent several to a request."""
+    prompts = [command.render(f"{preamble}\n\n{text}" if preamble else text) for _, text in items]
+    route = route_request(max(estimate_tokens(prompt) for prompt in prompts), (), command)
+    limiter = get_rate_limiter()
+    config = {"max_output_tokens": route["max_output_tokens"]}
+    if "temperature" in route:
+        config["temperature"] = route["temperature"]
+    usage = usage_tags(route["tier"], command.name)
+    
+    # The same term from any student, any week, hits the same entry; repeats in one list are asked once
+    keys = [
+        hashlib.sha256("\0".join(
+            (command.digest, route["model_name"], normalize_item(preamble), normalize_item(text))
+        ).encode("utf-8")).hexdigest()
+        for _, text in items
+    ]
+    unique = dict(zip(keys, prompts))
+    texts = dict(zip(keys, (text for _, text in items)))
+    backend = get_shared_backend()
+    answers = {}
+    for key in unique:
+        cached = backend.get("list_items", key)
+        if cached is not None:
+            answers[key] = zlib.decompress(cached).decode("utf-8").strip()
+    missing = [key for key in unique if key not in answers]
+    size = -(-len(missing) // LIST_MAX_REQUESTS)
+    requests = []
+    for start in range(0, len(missing), size or 1):
+        batch = missing[start:start + size]
+        if len(batch) == 1:
+            requests.append((batch, unique[batch[0]]))
+            continue
+        marked = "\n\n".join(f"[[{number}]] {texts[key]}" for number, key in enumerate(batch, 1))
+        requests.append((batch, command.render(f"{preamble}\n\n{marked}" if preamble else marked) + "\n\n" + LIST_BATCH_NOTE))
+    check_token_budget(sum(estimate_tokens(prompt) for _, prompt in requests))
+    model = get_route_model(route["tier"])
+    # One deadline covers the whole list, queueing for the shared quota included
+    deadline = time.monotonic() + route["deadline"]
+    
+    def answer(batch, prompt):
+        timeout = max(1.0, deadline - time.monotonic())
+        reply = call_model(model, limiter, prompt, usage, config, timeout, deadline)
+        replies = {0: reply.strip()} if len(batch) == 1 else split_batch_answers(reply, len(batch))
+        # Each answer is cached on its own, so a later list sharing only some of the items still hits
+        for index, key in enumerate(batch):
+            if index in replies:
+                cached_text("list_items", key, lambda: replies[index], LIST_ITEM_CACHE_TTL)
+        return {key: replies[index] for index, key in enumerate(batch) if index in replies}
+    
+    done = len(answers)
+    if progress:
+        progress(done, len(unique))
+    with ThreadPoolExecutor(max_workers=LIST_MAX_PARALLEL) as pool:
+        futures = {pool.submit(answer, batch, prompt): batch for batch, prompt in requests}
+        for future in as_completed(futures):
+            batch = futures[future]
+            try:
+                answers.update(future.result())
+            except Exception as e:
+                answers.update((key, f"*This item could not be answered: {e}*") for key in batch)
+            for key in batch:
+                answers.setdefault(key, "*This item could not be answered: the reply skipped it.*")
+            done += len(batch)
+            if progress:
+                progress(done, len(unique))
+    
+    text = "\n\n".join(f"{label} {answers[key]}" if label else answers[key] for (label, _), key in zip(items, keys))
+    route["reason"] = (
+        f"{len(items)} items in {len(requests)} parallel request{'s' if len(requests) != 1 else ''}, "
+        f"{len(unique) - len(missing)} from cache"
+    )
+    listed = "\n".join(f"{label} {item}" if label else item for label, item in items)
+    chat_session.history = list(chat_session.history) + [
+        {"role": "user", "parts": [command.render(f"{preamble}\n\n{listed}" if preamble else listed)]},
+        {"role": "model", "parts": [text]},
+    ]
+    return text, route
+
+# Model routing by input size, attachment types and active command
+MODEL_ROUTES = {
+    "lite": {"model_name": "gemini-1.5-flash-8b", "max_output_tokens": 2048},
+    "standard": {"model_name": "gemini-1.5-flash", "max_output_tokens": 8192},
+    "heavy": {"model_name": "gemini-1.5-pro", "max_output_tokens": 8192},
+}
+DEFAULT_ROUTE = "standard"
+
+# Per-command tier overrides for the built-ins; commands not listed are routed by input size alone
+COMMAND_ROUTES = {
+    "/synonyms": "lite",
+    "/citation": "lite",
+    "/paraphrase": "standard",
+    "/check4grammar": "standard",
+    "/litanalysis": "heavy",
+    "/code": "heavy",
+}
+
+LITE_MAX_INPUT_TOKENS = 1000
+HEAVY_MIN_INPUT_TOKENS = 100000
+HEAVY_MIME_PREFIXES = ("video/",)
+IMAGE_TOKENS = 258
+ROUTE_LOG_LIMIT = 100
+
+@st.cache_resource
+def get_route_model(tier):
+    return genai.GenerativeModel(
+        model_name=MODEL_ROUTES[tier]["model_name"],
+        generation_config=generation_config,
+        system_instruction=SYSTEM_INSTRUCTION,
+    )
+
+def estimate_attachment_tokens(mime_type, size):
+    if mime_type.startswith('image/'):
+        return IMAGE_TOKENS
+    if mime_type.startswith('text/') or mime_type in ['application/json', 'application/xml']:
+        return size // CHARS_PER_TOKEN
+    # Binary containers (PDF, DOCX, media) carry far fewer tokens than bytes
+    return size // (CHARS_PER_TOKEN * 4)
+
+def estimate_history_tokens(history):
+    # The chat session resends its whole history with every turn, so it counts toward the input
+    tokens = 0
+    for content in history:
+        for part in content["parts"] if isinstance(content, dict) else content.parts:
+            if isinstance(part, str):
+                tokens += estimate_tokens(part)
+            elif isinstance(part, dict):
+                tokens += estimate_attachment_tokens(part.get("mime_type", ""), len(part.get("data", b"")))
+            elif part.text:
+                tokens += estimate_tokens(part.text)
+            elif "inline_data" in part:
+                tokens += estimate_attachment_tokens(part.inline_data.mime_type, len(part.inline_data.data))
+            elif "file_data" in part:
+                # Only files past the inline limit go through the File API
+                tokens += estimate_attachment_tokens(part.file_data.mime_type, INLINE_UPLOAD_LIMIT)
+    return tokens
+
+@profiled
+def route_request(input_tokens, mime_types=(), command=None):
+    if any(mime_type.startswith(HEAVY_MIME_PREFIXES) for mime_type in mime_types):
+        tier, reason = "heavy", "video attachment"
+    elif input_tokens >= HEAVY_MIN_INPUT_TOKENS:
+        tier, reason = "heavy", f"~{input_tokens} input tokens"
+    elif input_tokens <= LITE_MAX_INPUT_TOKENS and not mime_types:
+        tier, reason = "lite", f"~{input_tokens} input tokens"
+    else:
+        tier, reason = DEFAULT_ROUTE, f"~{input_tokens} input tokens"
+    
+    override = command.settings["tier"] if command else None
+    # A lite override never gets input the lite model was not sized for
+    if override and (override != "lite" or tier == "lite"):
+        tier, reason = override, f"{command.name} override"
+    
+    route = dict(MODEL_ROUTES[tier])
+    route.update({
+        "tier": tier,
+        "reason": reason,
+        "input_tokens": input_tokens,
+        "command": command.name if command else None,
+        "mime_types": list(mime_types),
+    })
+    if command and command.settings["max_output_tokens"]:
+        route["max_output_tokens"] = min(route["max_output_tokens"], command.settings["max_output_tokens"])
+    if command and command.settings["temperature"] is not None:
+        route["temperature"] = command.settings["temperature"]
+    route["deadline"] = (
+        command and command.settings["deadline"]
+        or REQUEST_DEADLINES.get(st.session_state.get("access_level"), REQUEST_DEADLINE)
+    )
+    return route
+
+# Identical requests in flight at the same time (a class pasting the same prompt) share one call
+SYSTEM_INSTRUCTION_DIGEST = hashlib.sha256(SYSTEM_INSTRUCTION.encode("utf-8")).hexdigest()
+
+class SingleFlight:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.stats = {"upstream": 0, "coalesced": 0, "coalesced_input_tokens": 0}
+
+    def run(self, key, call, input_tokens=0, timeout=None):
+        """Returns (result, shared); shared is True when a concurrent identical call supplied the result."""
+        with self.lock:
+            future = self.calls.get(key)
+            leader = future is None
+            if leader:
+                future = self.calls[key] = Future()
+                self.stats["upstream"] += 1
+            else:
+                self.stats["coalesced"] += 1
+                self.stats["coalesced_input_tokens"] += input_tokens
+        if not leader:
+            # A failed call fails its followers too, rather than sending the same request again
+            try:
+                return future.result(timeout), True
+            except TimeoutError:
+                raise RequestDeadlineExceeded("The identical request this one joined did not finish in time.") from None
+        try:
+            result = call()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                self.calls.pop(key, None)
+        future.set_result(result)
+        return result, False
+
+@st.cache_resource
+def get_single_flight():
+    return SingleFlight()
+
+def content_digest(value, hasher):
+    if isinstance(value, str):
+        hasher.update(b"s" + value.encode("utf-8"))
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        hasher.update(b"b" + hashlib.sha256(value).digest())
+    elif isinstance(value, dict):
+        for key in sorted(value):
+            hasher.update(b"k" + str(key).encode("utf-8"))
+            content_digest(value[key], hasher)
+    elif isinstance(value, (list, tuple)):
+        hasher.update(b"l%d" % len(value))
+        for item in value:
+            content_digest(item, hasher)
+    elif hasattr(value, "_pb"):
+        hasher.update(b"p" + value._pb.SerializeToString(deterministic=True))
+    else:
+        # Remote files are identified by their File API name
+        hasher.update(b"o" + str(getattr(value, "name", value)).encode("utf-8"))
+
+def request_key(route, input_parts, history):
+    """Digest of everything the model sees: model, settings, system instruction, history and input."""
+    hasher = hashlib.sha256()
+    # The deadline decides where a reply is cut off, and a follower never waits past its own
+    settings = {key: route.get(key) for key in ("model_name", "max_output_tokens", "temperature", "deadline")}
+    hasher.update(json.dumps(settings, sort_keys=True).encode("utf-8") + SYSTEM_INSTRUCTION_DIGEST.encode("utf-8"))
+    content_digest(list(history), hasher)
+    content_digest(input_parts, hasher)
+    return hasher.hexdigest()
+
+def level_settings(name, cast):
+    # "Bronze=50000,Silver=150000" -> {"Bronze": 50000, "Silver": 150000}
+    return {
+        level.strip(): cast(value)
+        for level, _, value in (item.partition("=") for item in os.getenv(name, "").split(","))
+        if level.strip()
+    }
+
+# Deadlines and hedging: every model call is streamed against a deadline, and a stuck call can
+# be raced by a duplicate once it runs past the tier's recent p95 latency
+REQUEST_DEADLINE = float(os.getenv("MAINFRAME_REQUEST_DEADLINE", "90"))
+# Per access level overrides in seconds, e.g. "Bronze=30,Platinum=180"; commands can set their own
+REQUEST_DEADLINES = level_settings("MAINFRAME_REQUEST_DEADLINES", float)
+HEDGE_REQUESTS = os.getenv("MAINFRAME_HEDGE_REQUESTS", "0") == "1"
+HEDGE_MIN_SAMPLES = 20
+HEDGE_WINDOW = 200
+PARTIAL_REPLY_NOTE = "\n\n*[Cut off at the {seconds:.0f} s time limit; the answer above is incomplete.]*"
+
+class RequestDeadlineExceeded(Exception):
+    pass
+
+class LatencyTracker:
+    """Recent completion times per model tier, for deciding when a call counts as stuck."""
+
+    def __init__(self, window=HEDGE_WINDOW):
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.window = window
+
+    def record(self, tier, seconds):
+        with self.lock:
+            self.samples.setdefault(tier, deque(maxlen=self.window)).append(seconds)
+
+    def percentile(self, tier, fraction=0.95):
+        with self.lock:
+            samples = sorted(self.samples.get(tier, ()))
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+@st.cache_resource
+def get_latency_tracker():
+    return LatencyTracker()
+
+@st.cache_resource
+def get_request_pool():
+    # Calls the script has given up on finish here, bounded by their own upstream timeout
+    return ThreadPoolExecutor(max_workers=MODEL_MAX_CONCURRENCY * 4, thread_name_prefix="model-request")
+
+class ModelAttempt:
+    """One streamed call; the text received so far stays readable if the caller stops waiting."""
+
+    def __init__(self, model, contents, config, deadline):
+        self.model = model
+        self.contents = contents
+        self.config = config
+        self.deadline = deadline
+        self.chunks = []
+        self.response = None
+        self.started = None
+        self.cancelled = threading.Event()
+        # Set when the stream opens, the call fails or the attempt is cancelled
+        self.settled = threading.Event()
+        self.error = None
+
+    @property
+    def text(self):
+        return "".join(self.chunks)
+
+    def cancel(self):
+        self.cancelled.set()
+        self.settled.set()
+        self.close()
+
+    def close(self):
+        # Closing the gRPC stream frees the connection now rather than at the upstream timeout
+        cancel = getattr(getattr(self.response, "_iterator", None), "cancel", None)
+        if cancel:
+            cancel()
+
+    def open(self, remaining):
+        # generate_content blocks until the first chunk and only then hands back a stream that can be cancelled
+        try:
+            self.response = self.model.generate_content(
+                self.contents, generation_config=self.config, stream=True, request_options={"timeout": remaining}
+            )
+        except Exception as e:
+            self.error = e
+        self.settled.set()
+        if self.cancelled.is_set():
+            self.close()
+
+    def run(self, limiter):
+        with limiter.slot(self.deadline):
+            remaining = self.deadline - time.monotonic()
+            if remaining <= 0 or self.cancelled.is_set():
+                raise RequestDeadlineExceeded("The request was cancelled before it was sent.")
+            self.started = time.monotonic()
+            # Wait for the first chunk here so a cancelled or late attempt gives back its slot and pool thread
+            threading.Thread(target=self.open, args=(remaining,), daemon=True).start()
+            self.settled.wait(max(0.0, self.deadline - time.monotonic()))
+            if self.error is not None:
+                raise self.error
+            if self.cancelled.is_set():
+                raise RequestDeadlineExceeded("The request was cancelled before the model answered.")
+            if self.response is None:
+                self.cancel()
+                raise RequestDeadlineExceeded("The model did not start answering before the time limit.")
+            for chunk in self.response:
+                if self.cancelled.is_set():
+                    break
+                try:
+                    self.chunks.append(chunk.text)
+                except ValueError:
+                    # Chunks that only carry a finish reason or safety ratings have no text
+                    continue
+        return self
+
+def estimated_usage(input_tokens, text):
+    return SimpleNamespace(
+        prompt_token_count=input_tokens, cached_content_token_count=0, candidates_token_count=estimate_tokens(text)
+    )
+
+def run_with_deadline(model, contents, config, route, tags):
+    """Streams one reply before route["deadline"], hedging once past the tier's p95 if enabled."""
+    limiter = get_rate_limiter()
+    pool = get_request_pool()
+    tracker = get_latency_tracker()
+    started = time.monotonic()
+    deadline = started + route["deadline"]
+    hedge_at = None
+    if HEDGE_REQUESTS:
+        p95 = tracker.percentile(route["tier"])
+        hedge_at = started + p95 if p95 is not None else None
+    
+    attempts = [ModelAttempt(model, contents, config, deadline)]
+    pending = {pool.submit(attempts[0].run, limiter)}
+    error = None
+    while pending:
+        wake = deadline if hedge_at is None else min(deadline, hedge_at)
+        done, pending = wait(pending, timeout=max(0.0, wake - time.monotonic()), return_when=FIRST_COMPLETED)
+        for future in done:
+            try:
+                winner = future.result()
+            except Exception as e:
+                error = error or e
+                continue
+            tracker.record(route["tier"], time.monotonic() - winner.started)
+            for attempt in attempts:
+                if attempt is not winner:
+                    attempt.cancel()
+                    # A cancelled duplicate was still sent; meter what it used
+                    record_usage(tags, SimpleNamespace(usage_metadata=estimated_usage(route["input_tokens"], attempt.text)), 0, ok=False)
+            return SimpleNamespace(
+                text=winner.text,
+                usage_metadata=getattr(winner.response, "usage_metadata", None),
+                partial=False,
+                hedged=winner is not attempts[0],
+            )
+        if time.monotonic() >= deadline:
+            break
+        # Past the p95 with nothing back yet: race a duplicate, once
+        if hedge_at is not None and time.monotonic() >= hedge_at:
+            hedge_at = None
+            if pending and not attempts[0].chunks:
+                attempts.append(ModelAttempt(model, contents, config, deadline))
+                pending.add(pool.submit(attempts[-1].run, limiter))
+    
+    for attempt in attempts:
+        attempt.cancel()
+    timed_out = time.monotonic() >= deadline or isinstance(error, (RequestDeadlineExceeded, google_exceptions.DeadlineExceeded))
+    if not timed_out:
+        raise error
+    # Out of time: keep the longest partial answer and say it was cut off
+    text = max((attempt.text for attempt in attempts), key=len)
+    if not text:
+        raise RequestDeadlineExceeded(f"The model did not answer within {route['deadline']:.0f} seconds.")
+    return SimpleNamespace(
+        text=text + PARTIAL_REPLY_NOTE.format(seconds=route["deadline"]),
+        usage_metadata=estimated_usage(route["input_tokens"], text),
+        partial=True,
+        hedged=False,
+    )
+
+@profiled
+def send_routed_message(chat_session, input_parts, route):
+    check_token_budget(route["input_tokens"])
+    tags = usage_tags(route["tier"], route.get("command"), route.get("mime_types", ()))
+    return send_with_route(chat_session, input_parts, route, tags)
+
+def send_with_route(chat_session, input_parts, route, tags):
+    # Nothing here reads session state, so fan-out workers can call it off the script thread
+    model = get_route_model(route["tier"])
+    chat_session.model = model
+    config = {"max_output_tokens": route["max_output_tokens"]}
+    if "temperature" in route:
+        config["temperature"] = route["temperature"]
+    history = list(chat_session.history)
+    parts = input_parts if isinstance(input_parts, list) else [input_parts]
+    
+    def call():
+        return run_with_deadline(model, history + [{"role": "user", "parts": parts}], config, route, tags)
+    
+    key = request_key(route, input_parts, history)
+    started = time.perf_counter()
+    try:
+        reply, shared = get_single_flight().run(key, call, route["input_tokens"], route["deadline"])
+    except Exception:
+        record_usage(tags, None, time.perf_counter() - started, ok=False)
+        raise
+    # Coalesced turns are metered with zero tokens, since the leader's call paid for them
+    record_usage(tags, reply, time.perf_counter() - started, ok=not reply.partial, coalesced=shared)
+    # Calls are streamed outside the chat session, so the turn (cut-off note included) is added by hand
+    chat_session.history = history + [
+        {"role": "user", "parts": parts},
+        {"role": "model", "parts": [reply.text]},
+    ]
+    if shared:
+        route["coalesced"] = True
+    if reply.partial:
+        route["partial"] = True
+    if reply.hedged:
+        route["hedged"] = True
+    return reply
+
+def record_route(route):
+    if 'route_log' not in st.session_state:
+        st.session_state.route_log = []
+    st.session_state.route_log.append({
+        "time": datetime.now().isoformat(timespec="seconds"),
+        "tier": route["tier"],
+        "model_name": route["model_name"],
+        "reason": route["reason"],
+        "input_tokens": route["input_tokens"],
+    })
+    del st.session_state.route_log[:-ROUTE_LOG_LIMIT]
+
+def route_caption(route):
+    caption = f"{route['model_name']} · {route['reason']}"
+    if route.get("coalesced"):
+        caption += " · shared with an identical request"
+    if route.get("hedged"):
+        caption += " · answered by a hedged duplicate"
+    if route.get("partial"):
+        caption += f" · cut off at {route['deadline']:.0f} s"
+    return caption
+
+# Token and cost metering, tagged by access level, command, model tier and attachment types
+USAGE_DB_PATH = os.getenv("MAINFRAME_USAGE_DB", os.path.join(DATA_DIR, "usage.db"))
+USAGE_RETENTION_DAYS = int(os.getenv("MAINFRAME_USAGE_RETENTION_DAYS", "30"))
+USAGE_PURGE_EVERY = 500
+USAGE_DIMENSIONS = ("hour", "access_level", "command", "tier", "mime_types")
+# USD per million tokens (list prices for prompts up to 128k tokens): input, cached input, output
+MODEL_PRICES = {
+    "gemini-1.5-flash-8b": (0.0375, 0.01, 0.15),
+    "gemini-1.5-flash": (0.075, 0.01875, 0.30),
+    "gemini-1.5-pro": (1.25, 0.3125, 5.00),
+}
+# Optional daily token budget per access level, e.g. "Bronze=50000,Silver=150000". Each budget is one pool
+# shared by everyone signed in at that level, so reloading or clearing cookies does not reset it.
+TOKEN_BUDGETS = level_settings("MAINFRAME_DAILY_TOKEN_BUDGETS", int)
+
+class TokenBudgetExceeded(Exception):
+    pass
+
+class UsageStore:
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.lock = threading.Lock()
+        self.writes = 0
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS usage (
+                id INTEGER PRIMARY KEY,
+                ts REAL NOT NULL,
+                session_id TEXT NOT NULL,
+                access_level TEXT NOT NULL,
+                command TEXT NOT NULL,
+                tier TEXT NOT NULL,
+                model_name TEXT NOT NULL,
+                mime_types TEXT NOT NULL,
+                prompt_tokens INTEGER NOT NULL,
+                cached_tokens INTEGER NOT NULL,
+                output_tokens INTEGER NOT NULL,
+                cost REAL NOT NULL,
+                latency_ms INTEGER NOT NULL,
+                coalesced INTEGER NOT NULL,
+                ok INTEGER NOT NULL
+            )"""
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS usage_session ON usage (session_id, ts)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS usage_level ON usage (access_level, ts)")
+        # Hourly rollups are updated with each turn and kept after the raw rows expire
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS usage_hourly (
+                hour INTEGER NOT NULL,
+                access_level TEXT NOT NULL,
+                command TEXT NOT NULL,
+                tier TEXT NOT NULL,
+                mime_types TEXT NOT NULL,
+                requests INTEGER NOT NULL,
+                errors INTEGER NOT NULL,
+                coalesced INTEGER NOT NULL,
+                prompt_tokens INTEGER NOT NULL,
+                cached_tokens INTEGER NOT NULL,
+                output_tokens INTEGER NOT NULL,
+                cost REAL NOT NULL,
+                latency_ms INTEGER NOT NULL,
+                PRIMARY KEY (hour, access_level, command, tier, mime_types)
+            )"""
+        )
+        self.conn.commit()
+
+    def record(self, entry):
+        hour = int(entry["ts"] // 3600)
+        with self.lock, self.conn:
+            self.conn.execute(
+                """INSERT INTO usage (ts, session_id, access_level, command, tier, model_name, mime_types,
+                   prompt_tokens, cached_tokens, output_tokens, cost, latency_ms, coalesced, ok)
+                   VALUES (:ts, :session_id, :access_level, :command, :tier, :model_name, :mime_types,
+                   :prompt_tokens, :cached_tokens, :output_tokens, :cost, :latency_ms, :coalesced, :ok)""",
+                entry,
+            )
+            self.conn.execute(
+                """INSERT INTO usage_hourly VALUES (?, ?, ?, ?, ?, 1, ?, ?, ?, ?, ?, ?, ?)
+                   ON CONFLICT (hour, access_level, command, tier, mime_types) DO UPDATE SET
+                   requests = requests + 1,
+                   errors = errors + excluded.errors,
+                   coalesced = coalesced + excluded.coalesced,
+                   prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+                   cached_tokens = cached_tokens + excluded.cached_tokens,
+                   output_tokens = output_tokens + excluded.output_tokens,
+                   cost = cost + excluded.cost,
+                   latency_ms = latency_ms + excluded.latency_ms""",
+                (
+                    hour, entry["access_level"], entry["command"], entry["tier"], entry["mime_types"],
+                    1 - entry["ok"], entry["coalesced"], entry["prompt_tokens"], entry["cached_tokens"],
+                    entry["output_tokens"], entry["cost"], entry["latency_ms"],
+                ),
+            )
+            self.writes += 1
+            if self.writes % USAGE_PURGE_EVERY == 0:
+                self.conn.execute("DELETE FROM usage WHERE ts < ?", (time.time() - USAGE_RETENTION_DAYS * 86400,))
+
+    def level_tokens(self, access_level, since):
+        with self.lock:
+            return self.conn.execute(
+                "SELECT COALESCE(SUM(prompt_tokens + output_tokens), 0) FROM usage WHERE access_level = ? AND ts >= ?",
+                (access_level, since),
+            ).fetchone()[0]
+
+    def rollup(self, since, dimensions):
+        columns = ", ".join(dimension for dimension in dimensions if dimension in USAGE_DIMENSIONS)
+        with self.lock:
+            return pd.read_sql_query(
+                f"""SELECT {columns}, SUM(requests) AS requests, SUM(errors) AS errors, SUM(coalesced) AS coalesced,
+                    SUM(prompt_tokens) AS prompt_tokens, SUM(cached_tokens) AS cached_tokens,
+                    SUM(output_tokens) AS output_tokens, SUM(cost) AS cost,
+                    SUM(latency_ms) / SUM(requests) AS avg_latency_ms
+                    FROM usage_hourly WHERE hour >= ? GROUP BY {columns} ORDER BY {columns}""",
+                self.conn,
+                params=(int(since // 3600),),
+            )
+
+@st.cache_resource
+def get_usage_store():
+    return UsageStore(USAGE_DB_PATH)
+
+def usage_tags(tier, command=None, mime_types=()):
+    # Read on the script thread; map-reduce workers get these passed in
+    return {
+        "session_id": st.session_state.session_id,
+        "access_level": st.session_state.get("access_level") or "",
+        "command": command or "",
+        "tier": tier,
+        "model_name": MODEL_ROUTES[tier]["model_name"],
+        "mime_types": ",".join(sorted(set(mime_types))),
+    }
+
+def record_usage(tags, response, latency, ok=True, coalesced=False):
+    metadata = getattr(response, "usage_metadata", None) if not coalesced else None
+    prompt_tokens = getattr(metadata, "prompt_token_count", 0) or 0
+    cached_tokens = getattr(metadata, "cached_content_token_count", 0) or 0
+    output_tokens = getattr(metadata, "candidates_token_count", 0) or 0
+    input_price, cached_price, output_price = MODEL_PRICES.get(tags["model_name"], (0.0, 0.0, 0.0))
+    cost = ((prompt_tokens - cached_tokens) * input_price + cached_tokens * cached_price + output_tokens * output_price) / 1e6
+    try:
+        get_usage_store().record(dict(
+            tags,
+            ts=time.time(),
+            prompt_tokens=prompt_tokens,
+            cached_tokens=cached_tokens,
+            output_tokens=output_tokens,
+            cost=cost,
+            latency_ms=int(latency * 1000),
+            coalesced=int(coalesced),
+            ok=int(ok),
+        ))
+    except sqlite3.Error:
+        # Metering never fails a turn
+        pass
+
+def check_token_budget(input_tokens):
+    budget = TOKEN_BUDGETS.get(st.session_state.get("access_level"))
+    if budget is None:
+        return
+    midnight = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0).timestamp()
+    used = get_usage_store().level_tokens(st.session_state.access_level, midnight)
+    if used + input_tokens > budget:
+        raise TokenBudgetExceeded(
+            f"This request (~{input_tokens:,} tokens) would go over the {st.session_state.access_level} level's daily "
+            f"budget of {budget:,} tokens, shared by everyone at that level ({used:,} used today). It resets at midnight."
+        )
+
+# Persistent chat history (append-only SQLite log, loaded a page at a time)
+HISTORY_DB_PATH = os.getenv("MAINFRAME_HISTORY_DB", os.path.join(DATA_DIR, "history.db"))
+HISTORY_PAGE_SIZE = 20
+HISTORY_CONTEXT_MESSAGES = 40
+HISTORY_COMPRESS_MIN_BYTES = 512
+ROLE_CODES = {"user": "u", "assistant": "a"}
+ROLE_NAMES = {code: role for role, code in ROLE_CODES.items()}
+INITIAL_MESSAGE = """Hello! Mainframe AI speaking. How can I assist you today?"""
+SESSION_COOKIE = "mainframe_ai_sid"
+SESSION_COOKIE_MAX_AGE = 365 * 24 * 60 * 60
+
+class HistoryStore:
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY,
+                session_id TEXT NOT NULL,
+                role TEXT NOT NULL,
+                content BLOB NOT NULL,
+                meta TEXT
+            )"""
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS messages_session ON messages (session_id, id)")
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS preferences (
+                session_id TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                PRIMARY KEY (session_id, key)
+            )"""
+        )
+        self.conn.commit()
+
+    def append(self, session_id, message):
+        content = message["content"].encode("utf-8")
+        # Long replies are stored zlib-compressed as BLOBs, short ones as plain TEXT
+        content = zlib.compress(content) if len(content) >= HISTORY_COMPRESS_MIN_BYTES else message["content"]
+        meta = {key: value for key, value in message.items() if key not in ("id", "role", "content")}
+        with self.lock, self.conn:
+            cursor = self.conn.execute(
+                "INSERT INTO messages (session_id, role, content, meta) VALUES (?, ?, ?, ?)",
+                (session_id, ROLE_CODES[message["role"]], content, json.dumps(meta, separators=(",", ":")) if meta else None),
+            )
+        return cursor.lastrowid
+
+    def page(self, session_id, before_id=None, limit=HISTORY_PAGE_SIZE):
+        """Returns (messages, has_older) with messages in chronological order."""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT id, role, content, meta FROM messages WHERE session_id = ? AND id < ? ORDER BY id DESC LIMIT ?",
+                (session_id, before_id if before_id is not None else 2 ** 63 - 1, limit + 1),
+            ).fetchall()
+        has_older = len(rows) > limit
+        messages = []
+        for row_id, role, content, meta in reversed(rows[:limit]):
+            message = json.loads(meta) if meta else {}
+            message.update({
+                "id": row_id,
+                "role": ROLE_NAMES[role],
+                "content": zlib.decompress(content).decode("utf-8") if isinstance(content, bytes) else content,
+            })
+            messages.append(message)
+        return messages, has_older
+
+    def load_preferences(self, session_id):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT key, value FROM preferences WHERE session_id = ?", (session_id,)
+            ).fetchall()
+        return dict(rows)
+
+    def save_preference(self, session_id, key, value):
+        with self.lock, self.conn:
+            if value is None:
+                self.conn.execute("DELETE FROM preferences WHERE session_id = ? AND key = ?", (session_id, key))
+            else:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO preferences (session_id, key, value) VALUES (?, ?, ?)",
+                    (session_id, key, value),
+                )
+
+@st.cache_resource
+def get_history_store():
+    return HistoryStore(HISTORY_DB_PATH)
+
+def get_session_id():
+    # The id lives in a cookie of this browser, so a refresh or worker restart reopens the same history
+    # while a copied link never opens someone else's
+    if "sid" in st.query_params:
+        del st.query_params["sid"]
+    session_id = str(st.context.cookies.get(SESSION_COOKIE) or "")
+    if not re.fullmatch(r"[0-9a-f]{32}", session_id):
+        session_id = uuid.uuid4().hex
+    return session_id
+
+def session_cookie_stored():
+    # True once the browser has sent the cookie back, so the id will survive the next visit
+    return st.context.cookies.get(SESSION_COOKIE) == st.session_state.session_id
+
+def session_cookie():
+    return f"{SESSION_COOKIE}={st.session_state.session_id}; Max-Age={SESSION_COOKIE_MAX_AGE}; Path=/; SameSite=Strict"
+
+@profiled
+def load_history():
+    messages, has_older = get_history_store().page(st.session_state.session_id)
+    if not messages:
+        record_message({"role": "assistant", "content": INITIAL_MESSAGE})
+        return
+    st.session_state.messages = messages
+    st.session_state.history_has_older = has_older
+
+def load_older_messages():
+    oldest_id = st.session_state.messages[0]["id"] if st.session_state.messages else None
+    older, has_older = get_history_store().page(st.session_state.session_id, before_id=oldest_id)
+    st.session_state.messages = older + st.session_state.messages
+    st.session_state.history_limit += len(older)
+    st.session_state.history_has_older = has_older
+
+@profiled
+def record_message(message):
+    message["id"] = get_history_store().append(st.session_state.session_id, message)
+    if 'messages' not in st.session_state:
+        st.session_state.messages = []
+        st.session_state.history_has_older = False
+    st.session_state.messages.append(message)
+    # Only a bounded window stays in memory and on screen; the rest is a "load older" away
+    if len(st.session_state.messages) > st.session_state.history_limit:
+        st.session_state.messages = st.session_state.messages[-st.session_state.history_limit:]
+        st.session_state.history_has_older = True
+
+def build_chat_history(session_id):
+    messages, _ = get_history_store().page(session_id, limit=HISTORY_CONTEXT_MESSAGES)
+    history = []
+    for message in messages:
+        role = "user" if message["role"] == "user" else "model"
+        if not history and role == "model":
+            continue
+        if history and history[-1]["role"] == role:
+            history[-1]["parts"].append(message["content"])
+        else:
+            history.append({"role": role, "parts": [message["content"]]})
+    return history
+
+# Command registry: built-in and custom commands compiled once, looked up by name
+COMMANDS_DB_PATH = os.getenv("MAINFRAME_COMMANDS_DB", HISTORY_DB_PATH)
+COMMAND_NAME_PATTERN = re.compile(r"/[a-z0-9_-]{2,31}")
+COMMAND_PLACEHOLDERS = {"input", "attachments", "options"}
+COMMAND_SETTINGS = {
+    "tier": None, "temperature": None, "max_output_tokens": None, "map_reduce": False, "deadline": None, "per_item": False,
+}
+SHARED_COMMAND_OWNER = ""
+
+class CommandTemplate:
+    """A prompt template parsed once into literal text and {input}/{attachments}/{options} slots."""
+
+    def __init__(self, text):
+        self.segments = []
+        try:
+            parsed = list(string.Formatter().parse(text))
+        except ValueError as e:
+            raise ValueError(f"Template has unbalanced braces ({e}); write {{{{ and }}}} for literal braces")
+        for literal, field, spec, conversion in parsed:
+            if literal:
+                self.segments.append((True, literal))
+            if field is not None:
+                if field not in COMMAND_PLACEHOLDERS or spec or conversion:
+                    raise ValueError(f"Unknown placeholder {{{field}}}; use {{input}}, {{attachments}} or {{options}}")
+                self.segments.append((False, field))
+        self.fields = {value for is_literal, value in self.segments if not is_literal}
+
+    def render(self, values):
+        return "".join(value if is_literal else values[value] for is_literal, value in self.segments)
+
+class Command:
+    def __init__(self, name, title, description, template, message_text="", options=None, settings=None,
+                 owner=None, version=0, builtin=False):
+        self.name = name
+        self.title = title or name
+        self.description = description
+        self.template_text = template
+        self.message_text = message_text
+        self.options = dict(options or {})
+        self.settings = dict(COMMAND_SETTINGS, **(settings or {}))
+        self.owner = owner
+        self.version = version
+        self.builtin = builtin
+        # Without an {input} slot the message follows the instructions on a new line
+        self.template = CommandTemplate(template if "{input}" in template else template + "\n{input}")
+        self.digest = hashlib.sha256(json.dumps(self.definition(), sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+    def definition(self):
+        return {
+            "name": self.name,
+            "title": self.title,
+            "description": self.description,
+            "template": self.template_text,
+            "message_text": self.message_text,
+            "options": self.options,
+            "settings": self.settings,
+        }
+
+    def render(self, input_text, attachment_names=()):
+        return self.template.render({
+            "input": input_text,
+            "attachments": ", ".join(attachment_names) or "none",
+            "options": "\n".join(f"{key}: {value}" for key, value in self.options.items()),
+        })
+
+def builtin_commands():
+    # Built-in prompts are plain text, so any braces in them are literal
+    return [
+        Command(
+            name,
+            info["title"],
+            info["description"],
+            info["prompt"].replace("{", "{{").replace("}", "}}"),
+            info.get("message_text", ""),
+            settings={
+                "tier": COMMAND_ROUTES.get(name),
+                "map_reduce": name in MAP_REDUCE_COMMANDS,
+                "per_item": name in LIST_COMMANDS,
+            },
+            builtin=True,
+        )
+        for name, info in PREBUILT_COMMANDS.items()
+    ]
+
+class CommandRegistry:
+    def __init__(self, path, builtins):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        # Every edit is a new version row; the highest version of (owner, name) is the live one
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS commands (
+                owner TEXT NOT NULL,
+                name TEXT NOT NULL,
+                version INTEGER NOT NULL,
+                definition TEXT,
+                digest TEXT,
+                created REAL NOT NULL,
+                PRIMARY KEY (owner, name, version)
+            )"""
+        )
+        self.conn.commit()
+        self.builtins = {command.name: command for command in builtins}
+        self.custom = {}
+        self.data_version = None
+
+    def _refresh(self):
+        # data_version only moves when another connection (another worker) commits
+        data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+        if data_version == self.data_version:
+            return
+        rows = self.conn.execute(
+            """SELECT c.owner, c.name, c.version, c.definition FROM commands c
+               JOIN (SELECT owner, name, MAX(version) AS version FROM commands GROUP BY owner, name) latest
+               USING (owner, name, version)"""
+        ).fetchall()
+        self.custom = {}
+        for owner, name, version, definition in rows:
+            if definition is None:
+                continue
+            info = json.loads(definition)
+            self.custom[(owner, name)] = Command(
+                name, info["title"], info["description"], info["template"], info["message_text"],
+                info["options"], info["settings"], owner=owner, version=version,
+            )
+        self.data_version = data_version
+
+    def get(self, name, owner):
+        """O(1) lookup: the owner's own command, then a shared one, then a built-in."""
+        if name in self.builtins:
+            return self.builtins[name]
+        with self.lock:
+            self._refresh()
+            return self.custom.get((owner, name)) or self.custom.get((SHARED_COMMAND_OWNER, name))
+
+    def visible(self, owner):
+        with self.lock:
+            self._refresh()
+            commands = {}
+            for (command_owner, name), command in self.custom.items():
+                if command_owner == owner or (command_owner == SHARED_COMMAND_OWNER and name not in commands):
+                    commands[name] = command
+        return [commands[name] for name in sorted(commands)]
+
+    def _write(self, owner, name, definition, digest):
+        with self.lock, self.conn:
+            self._refresh()
+            version = self.conn.execute(
+                "SELECT COALESCE(MAX(version), 0) + 1 FROM commands WHERE owner = ? AND name = ?", (owner, name)
+            ).fetchone()[0]
+            self.conn.execute(
+                "INSERT INTO commands (owner, name, version, definition, digest, created) VALUES (?, ?, ?, ?, ?, ?)",
+                (owner, name, version, definition, digest, time.time()),
+            )
+        return version
+
+    def save(self, command, owner):
+        if not COMMAND_NAME_PATTERN.fullmatch(command.name):
+            raise ValueError("Command names start with / followed by 2-31 lowercase letters, digits, - or _")
+        if command.name in self.builtins:
+            raise ValueError(f"{command.name} is a built-in command")
+        current = self.get(command.name, owner)
+        if current is not None and current.owner == owner and current.digest == command.digest:
+            return current
+        command.owner = owner
+        command.version = self._write(owner, command.name, json.dumps(command.definition()), command.digest)
+        with self.lock:
+            self.custom[(owner, command.name)] = command
+        return command
+
+    def delete(self, name, owner):
+        if (owner, name) in self.custom:
+            self._write(owner, name, None, None)
+            with self.lock:
+                self.custom.pop((owner, name), None)
+
+@st.cache_resource
+def get_command_registry():
+    return CommandRegistry(COMMANDS_DB_PATH, builtin_commands())
+
+def get_command(name):
+    return get_command_registry().get(name, st.session_state.session_id)
+
+def parse_command_options(text):
+    options = {}
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        key, separator, value = line.partition(":")
+        if not separator or not key.strip():
+            raise ValueError(f"Options are one 'name: value' per line; could not read '{line.strip()}'")
+        options[key.strip()] = value.strip()
+    return options
+
+# Uploads are spooled to disk once, deduplicated by content hash and read back through mmap
+UPLOAD_DIR = os.path.join(DATA_DIR, "uploads")
+UPLOAD_SESSION_QUOTA = int(os.getenv("MAINFRAME_UPLOAD_SESSION_QUOTA_MB", "300")) * 1024 * 1024
+UPLOAD_GLOBAL_QUOTA = int(os.getenv("MAINFRAME_UPLOAD_GLOBAL_QUOTA_MB", "4096")) * 1024 * 1024
+UPLOAD_COPY_CHUNK = 1024 * 1024
+# Gemini's inline-data ceiling; anything larger is sent by path through the File API
+INLINE_UPLOAD_LIMIT = 20 * 1024 * 1024
+REMOTE_FILE_TTL = 46 * 60 * 60
+
+class StoredFile:
+    """Handle to a spooled upload. Holds no file contents, so it is cheap to keep in session state."""
+
+    def __init__(self, name, path, size, digest, source="upload"):
+        self.name = name
+        self.path = path
+        self.size = size
+        self.digest = digest
+        self.source = source
+        self.original_size = size
+        self.mime_type = None
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    @contextmanager
+    def view(self):
+        if self.size == 0:
+            yield memoryview(b"")
+            return
+        with open(self.path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            view = memoryview(mapped)
+            try:
+                yield view
+            finally:
+                view.release()
+
+class UploadStore:
+    def __init__(self, root, session_quota, global_quota):
+        self.root = root
+        self.session_quota = session_quota
+        self.global_quota = global_quota
+        self.lock = threading.Lock()
+        # digest -> {"size": int, "sessions": set}, least recently used first
+        self.entries = OrderedDict()
+        self.remote_files = {}
+        os.makedirs(root, exist_ok=True)
+        
+        # Adopt files spooled by a previous run so they count against the quota
+        existing = []
+        for name in os.listdir(root):
+            path = os.path.join(root, name)
+            if name.endswith(".part"):
+                os.unlink(path)
+            elif os.path.isfile(path):
+                existing.append((os.path.getmtime(path), name, os.path.getsize(path)))
+        for _, digest, size in sorted(existing):
+            self.entries[digest] = {"size": size, "sessions": set()}
+
+    def total_size(self):
+        return sum(entry["size"] for entry in self.entries.values())
+
+    def session_size(self, session_id):
+        return sum(entry["size"] for entry in self.entries.values() if session_id in entry["sessions"])
+
+    def put(self, session_id, name, source, kind="upload", keep=()):
+        """Spools bytes or a file-like object to disk and returns a StoredFile.
+
+        Files in keep (digests still attached to the session) are never released to make room."""
+        hasher = hashlib.sha256()
+        size = 0
+        with tempfile.NamedTemporaryFile(dir=self.root, suffix=".part", delete=False) as tmp:
+            if isinstance(source, (bytes, bytearray, memoryview)):
+                chunks = [source]
+            elif hasattr(source, "getbuffer"):
+                # In-memory uploads expose their buffer directly, so nothing is copied
+                chunks = [source.getbuffer()]
+            else:
+                source.seek(0)
+                chunks = iter(lambda: source.read(UPLOAD_COPY_CHUNK), b"")
+            for chunk in chunks:
+                hasher.update(chunk)
+                tmp.write(chunk)
+                size += len(chunk)
+        
+        digest = hasher.hexdigest()
+        path = os.path.join(self.root, digest)
+        with self.lock:
+            if digest in self.entries and os.path.exists(path):
+                os.unlink(tmp.name)
+            else:
+                os.replace(tmp.name, path)
+            entry = self.entries.setdefault(digest, {"size": size, "sessions": set()})
+            entry["sessions"].add(session_id)
+            self.entries.move_to_end(digest)
+            
+            self._enforce_session_quota(session_id, keep={digest, *keep})
+            if self.session_size(session_id) > self.session_quota:
+                entry["sessions"].discard(session_id)
+                if not entry["sessions"]:
+                    self._remove(digest)
+                raise ValueError(f"{name} does not fit in your {self.session_quota // (1024 * 1024)} MB upload quota")
+            self._enforce_global_quota()
+        
+        return StoredFile(name, path, size, digest, kind)
+
+    def touch(self, digest):
+        with self.lock:
+            if digest in self.entries:
+                self.entries.move_to_end(digest)
+
+    def release(self, session_id, keep=()):
+        with self.lock:
+            for digest, entry in self.entries.items():
+                if digest not in keep:
+                    entry["sessions"].discard(session_id)
+
+    def _enforce_session_quota(self, session_id, keep):
+        for digest, entry in list(self.entries.items()):
+            if self.session_size(session_id) <= self.session_quota:
+                break
+            if digest not in keep and session_id in entry["sessions"]:
+                entry["sessions"].discard(session_id)
+
+    def _enforce_global_quota(self):
+        # Unreferenced files go first, then whatever was used least recently
+        for referenced in (False, True):
+            for digest, entry in list(self.entries.items()):
+                if self.total_size() <= self.global_quota:
+                    return
+                if bool(entry["sessions"]) == referenced:
+                    self._remove(digest)
+
+    def _remove(self, digest):
+        self.entries.pop(digest, None)
+        self.remote_files.pop(digest, None)
+        try:
+            os.unlink(os.path.join(self.root, digest))
+        except OSError:
+            pass
+
+    def remote_file(self, stored, mime_type, deadline=None):
+        cached = self.remote_files.get(stored.digest)
+        if cached and time.time() - cached[1] < REMOTE_FILE_TTL:
+            remote, uploaded = cached
+        else:
+            remote = genai.upload_file(path=stored.path, mime_type=mime_type, display_name=stored.name)
+            uploaded = time.time()
+        # Video and audio are processed server-side before they can be referenced
+        while remote.state.name == "PROCESSING":
+            # Kept while processing so the next turn resumes polling instead of uploading again
+            self.remote_files[stored.digest] = (remote, uploaded)
+            if deadline is not None and time.monotonic() + 2 > deadline:
+                raise RequestDeadlineExceeded(f"{stored.name} is still being processed; send it again in a moment.")
+            time.sleep(2)
+            remote = genai.get_file(remote.name)
+        self.remote_files[stored.digest] = (remote, uploaded)
+        return remote
+
+@st.cache_resource
+def get_upload_store():
+    return UploadStore(UPLOAD_DIR, UPLOAD_SESSION_QUOTA, UPLOAD_GLOBAL_QUOTA)
+
+def attached_digests():
+    return {file.digest for file in st.session_state.get('uploaded_files', [])}
+
+@profiled
+def spool_uploads(uploaded_files):
+    store = get_upload_store()
+    if 'spooled_uploads' not in st.session_state:
+        st.session_state.spooled_uploads = {}
+    if 'rejected_uploads' not in st.session_state:
+        st.session_state.rejected_uploads = {}
+    rejected = st.session_state.rejected_uploads
+    spooled = {}
+    for file in uploaded_files:
+        file_key = getattr(file, "file_id", None) or f"{file.name}:{file.size}"
+        if file_key in rejected:
+            st.warning(f"{file.name} was not added: {rejected[file_key]}")
+            continue
+        stored = st.session_state.spooled_uploads.get(file_key)
+        if stored is None or not stored.exists():
+            try:
+                stored = store.put(st.session_state.session_id, file.name, file, keep=attached_digests())
+            except ValueError as e:
+                st.warning(str(e))
+                continue
+            # Rejected here, its spooled copy is dropped by the release() that follows
+            problem = validate_upload(stored)
+            if problem:
+                rejected[file_key] = problem
+                st.warning(f"{file.name} was not added: {problem}")
+                continue
+        spooled[file_key] = stored
+    st.session_state.spooled_uploads = spooled
+    return list(spooled.values())
+
+def file_source(file):
+    # Spooled uploads are handed to extractors by path instead of as in-memory bytes.
+    # (Duck-typed: the script re-executes on every rerun, so StoredFile is a new class each time.)
+    return getattr(file, "path", file)
+
+@contextmanager
+def open_source(source):
+    if isinstance(source, str):
+        with open(source, "rb") as f:
+            yield f
+    else:
+        source.seek(0)
+        yield source
+
+@profiled
+def model_part_for(file, mime_type, deadline=None):
+    store = get_upload_store()
+    store.touch(file.digest)
+    if file.size > INLINE_UPLOAD_LIMIT:
+        return store.remote_file(file, mime_type, deadline)
+    with file.view() as view:
+        return {'mime_type': mime_type, 'data': bytes(view)}
+
+# Camera and pasted images are normalized before they are sent
+# Gemini reads images in 768 px tiles; pixels beyond two tiles per side add payload, not detail
+IMAGE_MAX_SIDE = 1536
+IMAGE_JPEG_QUALITY = 85
+IMAGE_PALETTE_COLORS = 256
+
+def format_bytes(size):
+    for unit in ("B", "KB", "MB"):
+        if size < 1024 or unit == "MB":
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+
+@st.cache_data(max_entries=128, show_spinner=False)
+def normalize_image_cached(digest, _data):
+    """Returns (bytes, mime_type) for the smallest faithful encoding of an image, keyed by content hash."""
+    image = Image.open(BytesIO(_data))
+    image = ImageOps.exif_transpose(image)
+    image.thumbnail((IMAGE_MAX_SIDE, IMAGE_MAX_SIDE), Image.LANCZOS)
+    
+    candidates = []
+    
+    # Screenshots and diagrams with few colors compress best as palette PNGs
+    if image.getcolors(IMAGE_PALETTE_COLORS) is not None:
+        png = BytesIO()
+        image.convert("RGBA" if "A" in image.getbands() else "RGB").quantize(IMAGE_PALETTE_COLORS).save(png, format="PNG", optimize=True)
+        candidates.append((png.getvalue(), "image/png"))
+    
+    if "A" in image.getbands():
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel("A"))
+        image = background
+    jpeg = BytesIO()
+    # Saving without exif/icc arguments drops the source metadata
+    image.convert("RGB").save(jpeg, format="JPEG", quality=IMAGE_JPEG_QUALITY, optimize=True, progressive=True)
+    candidates.append((jpeg.getvalue(), "image/jpeg"))
+    
+    return min(candidates, key=lambda candidate: len(candidate[0]))
+
+def normalize_image(data, mime_type):
+    """Returns (bytes, mime_type); falls back to the original when re-encoding would not help."""
+    try:
+        normalized, normalized_type = normalize_image_cached(hashlib.sha256(data).hexdigest(), data)
+    except Exception:
+        return data, mime_type
+    if len(normalized) >= len(data):
+        return data, mime_type
+    return normalized, normalized_type
+
+def payload_caption(payload):
+    saved = 1 - payload["after"] / payload["before"] if payload["before"] else 0
+    return f"Image payload {format_bytes(payload['before'])} → {format_bytes(payload['after'])} (−{saved:.0%})"
+
+# Video preprocessing: scene-change keyframes plus an audio transcript instead of the whole file
+FFMPEG_PATH = shutil.which("ffmpeg")
+VIDEO_MODES = ["Keyframes + transcript", "Full video"]
+VIDEO_SCENE_THRESHOLD = float(os.getenv("MAINFRAME_VIDEO_SCENE_THRESHOLD", "0.3"))
+VIDEO_MIN_FRAME_INTERVAL = float(os.getenv("MAINFRAME_VIDEO_MIN_FRAME_INTERVAL", "2"))
+VIDEO_MAX_FRAME_INTERVAL = float(os.getenv("MAINFRAME_VIDEO_MAX_FRAME_INTERVAL", "60"))
+VIDEO_MAX_FRAMES = int(os.getenv("MAINFRAME_VIDEO_MAX_FRAMES", "40"))
+VIDEO_FRAME_WIDTH = 768
+VIDEO_AUDIO_SEGMENT_SECONDS = 50
+VIDEO_WORKERS = int(os.getenv("MAINFRAME_VIDEO_WORKERS", "4"))
+
+@st.cache_resource
+def get_media_pool():
+    return ThreadPoolExecutor(max_workers=VIDEO_WORKERS, thread_name_prefix="media")
+
+@st.cache_resource
+def get_video_bundle_cache():
+    return OrderedDict()
+
+def format_timestamp(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}" if seconds >= 3600 else f"{seconds // 60:02d}:{seconds % 60:02d}"
+
+def extract_keyframes(video_path, output_dir):
+    """Returns [(timestamp, jpeg_bytes)] for frames where the scene changes."""
+    select = (
+        f"eq(n\\,0)"
+        f"+gt(scene\\,{VIDEO_SCENE_THRESHOLD})*gte(t-prev_selected_t\\,{VIDEO_MIN_FRAME_INTERVAL})"
+        f"+gte(t-prev_selected_t\\,{VIDEO_MAX_FRAME_INTERVAL})"
+    )
+    result = subprocess.run(
+        [
+            FFMPEG_PATH, "-hide_banner", "-nostdin", "-i", video_path,
+            "-vf", f"select={select},scale=w=min({VIDEO_FRAME_WIDTH}\\,iw):h=-2,showinfo",
+            "-vsync", "vfr", "-frames:v", str(VIDEO_MAX_FRAMES), "-q:v", "4",
+            os.path.join(output_dir, "frame_%04d.jpg"),
+        ],
+        capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        raise Exception(f"Could not extract video frames: {result.stderr.strip()[-300:]}")
+    
+    timestamps = [float(t) for t in re.findall(r"Parsed_showinfo.*?pts_time:\s*([\d.]+)", result.stderr)]
+    frames = []
+    for i, name in enumerate(sorted(f for f in os.listdir(output_dir) if f.startswith("frame_"))):
+        with open(os.path.join(output_dir, name), "rb") as f:
+            frames.append((timestamps[i] if i < len(timestamps) else 0.0, f.read()))
+    return frames
+
+def extract_audio_segments(video_path, output_dir):
+    """Splits the audio track into mono 16 kHz WAV segments; returns [] when there is no audio."""
+    result = subprocess.run(
+        [
+            FFMPEG_PATH, "-hide_banner", "-nostdin", "-loglevel", "error", "-i", video_path,
+            "-map", "0:a:0?", "-vn", "-ac", "1", "-ar", "16000",
+            "-f", "segment", "-segment_time", str(VIDEO_AUDIO_SEGMENT_SECONDS),
+            os.path.join(output_dir, "audio_%04d.wav"),
+        ],
+        capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        return []
+    return sorted(os.path.join(output_dir, f) for f in os.listdir(output_dir) if f.startswith("audio_"))
+
+def transcribe_segment(path):
+    try:
+        return convert_audio_to_text(path)
+    except Exception:
+        # Silence and music come back as "could not understand"; skip those stretches
+        return ""
+
+@profiled
+def preprocess_video(stored, progress=None):
+    """Builds a frames-plus-transcript bundle of model parts for a spooled video."""
+    cache = get_video_bundle_cache()
+    cache_key = (stored.digest, VIDEO_SCENE_THRESHOLD, VIDEO_MIN_FRAME_INTERVAL, VIDEO_MAX_FRAME_INTERVAL, VIDEO_MAX_FRAMES)
+    if cache_key in cache:
+        cache.move_to_end(cache_key)
+        return cache[cache_key]
+    
+    pool = get_media_pool()
+    with tempfile.TemporaryDirectory(prefix="mainframe_video_") as work_dir:
+        frames_dir = os.path.join(work_dir, "frames")
+        audio_dir = os.path.join(work_dir, "audio")
+        os.makedirs(frames_dir)
+        os.makedirs(audio_dir)
+        
+        if progress:
+            progress(0, 1, "Extracting keyframes and audio")
+        frames_future = pool.submit(extract_keyframes, stored.path, frames_dir)
+        segments = pool.submit(extract_audio_segments, stored.path, audio_dir).result()
+        
+        transcripts = [""] * len(segments)
+        futures = {pool.submit(transcribe_segment, path): i for i, path in enumerate(segments)}
+        for done, future in enumerate(as_completed(futures), start=1):
+            transcripts[futures[future]] = future.result()
+            if progress:
+                progress(done, len(segments), "Transcribing audio")
+        frames = frames_future.result()
+    if not frames:
+        raise Exception("No video frames could be extracted")
+    
+    parts = [
+        f"The video {stored.name} was condensed into {len(frames)} keyframes (chosen at scene changes) "
+        f"and a transcript of its audio track. Treat them as the video itself."
+    ]
+    for timestamp, data in frames:
+        parts.append(f"Frame at {format_timestamp(timestamp)}:")
+        parts.append({'mime_type': 'image/jpeg', 'data': data})
+    
+    transcript_lines = [
+        f"[{format_timestamp(i * VIDEO_AUDIO_SEGMENT_SECONDS)}] {text}"
+        for i, text in enumerate(transcripts) if text
+    ]
+    parts.append("Audio transcript:\n" + ("\n".join(transcript_lines) if transcript_lines else "(no speech detected)"))
+    
+    cache[cache_key] = parts
+    while len(cache) > 16:
+        cache.popitem(last=False)
+    return parts
+
+# Per-session memory accounting; idle sessions give back whatever can be rebuilt from disk
+SESSION_IDLE_SECONDS = int(os.getenv("MAINFRAME_SESSION_IDLE_MINUTES", "30")) * 60
+SESSION_SWEEP_INTERVAL = 60
+# Rebuilt on the session's next rerun: history from SQLite, the chat session from that history
+EVICTABLE_STATE_KEYS = ["messages", "history_has_older", "chat_session", "camera_image", "clipboard_data"]
+# Shared between sessions through st.cache_resource, so not charged to any one of them
+SHARED_STATE_KEYS = {"chat_model"}
+
+def state_size(obj, seen=None):
+    """Approximate deep size in bytes. Spooled uploads count their handle, not the file on disk."""
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj, 0)
+    if isinstance(obj, dict):
+        size += sum(state_size(key, seen) + state_size(value, seen) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(state_size(item, seen) for item in obj)
+    elif isinstance(obj, BytesIO):
+        size += obj.getbuffer().nbytes
+    elif hasattr(obj, "_pb"):
+        # proto-plus messages (chat history turns) keep their payload in the wrapped protobuf
+        size += obj._pb.ByteSize()
+    elif hasattr(obj, "history") and hasattr(obj, "send_message"):
+        size += state_size(obj.history, seen)
+    return size
+
+def process_rss():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+class SessionRegistry:
+    """Tracks every live session's state so idle ones can be measured and trimmed from one place."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.last_sweep = None
+        threading.Thread(target=self._sweep_forever, name="session-sweeper", daemon=True).start()
+
+    def touch(self, ctx, access_level):
+        # Called before the run reads its state, so a sweep either finishes first or sees the session as active
+        with self.lock:
+            record = self.sessions.setdefault(ctx.session_id, {"bytes": 0, "keys": {}, "evictions": 0, "freed": 0})
+            record.update({
+                "state": ctx.session_state,
+                "sid": ctx.session_state["session_id"] if "session_id" in ctx.session_state else None,
+                "level": access_level,
+                "last_seen": time.time(),
+                "evicted": False,
+            })
+
+    def measure(self, record):
+        state = record["state"].filtered_state
+        record["keys"] = {key: state_size(value) for key, value in state.items() if key not in SHARED_STATE_KEYS}
+        record["bytes"] = sum(record["keys"].values())
+
+    def evict(self, session_id, idle_seconds):
+        with self.lock:
+            record = self.sessions.get(session_id)
+            if not record or record["evicted"] or time.time() - record["last_seen"] < idle_seconds:
+                return
+            state = record["state"]
+            before = record["bytes"]
+            for key in EVICTABLE_STATE_KEYS + [key for key in record["keys"] if key.startswith("help_")]:
+                if key in state:
+                    del state[key]
+            state["history_limit"] = HISTORY_PAGE_SIZE
+            record["evicted"] = True
+            record["evictions"] += 1
+        self.measure(record)
+        record["freed"] += max(0, before - record["bytes"])
+
+    def sweep(self, idle_seconds=SESSION_IDLE_SECONDS):
+        runtime = Runtime.instance() if Runtime.exists() else None
+        with self.lock:
+            records = list(self.sessions.items())
+        for session_id, record in records:
+            if runtime is not None and not runtime.is_active_session(session_id):
+                with self.lock:
+                    self.sessions.pop(session_id, None)
+                continue
+            self.measure(record)
+            self.evict(session_id, idle_seconds)
+        self.last_sweep = time.time()
+
+    def _sweep_forever(self):
+        while True:
+            time.sleep(SESSION_SWEEP_INTERVAL)
+            try:
+                self.sweep()
+            except Exception:
+                # A session closing mid-measurement is retried on the next pass
+                pass
+
+    def snapshot(self):
+        """Returns (rows for display, total bytes), largest sessions first."""
+        with self.lock:
+            records = [dict(record, session_id=session_id) for session_id, record in self.sessions.items()]
+        now = time.time()
+        rows = [
+            {
+                "Session": (record["sid"] or record["session_id"])[:8],
+                "Level": record["level"],
+                "Idle (min)": round((now - record["last_seen"]) / 60, 1),
+                "State": format_bytes(record["bytes"]),
+                "Largest key": max(record["keys"], key=record["keys"].get) if record["keys"] else "",
+                "Evicted": record["evicted"],
+                "Freed": format_bytes(record["freed"]),
+            }
+            for record in sorted(records, key=lambda record: record["bytes"], reverse=True)
+        ]
+        return rows, sum(record["bytes"] for record in records)
+
+@st.cache_resource
+def get_session_registry():
+    return SessionRegistry()
+
+@profiled
+def track_session(access_level):
+    ctx = get_script_run_ctx()
+    if ctx is not None:
+        get_session_registry().touch(ctx, access_level)
+
+# Sidebar panels run as fragments so their widgets only rerun their own panel
+AVAILABLE_FONTS = [
+    "Montserrat", "Orbitron", "DM Sans", "Calibri", 
+    "Arial", "Times New Roman", "Roboto", "Open Sans",
+    "Lato", "Poppins", "Ubuntu", "Playfair Display"
+]
+
+@st.fragment
+@profiled
+def render_settings_panel():
+    with st.expander("**Settings & Preferences**", expanded=False): 
+        # Font search/filter
+        font_search = st.text_input("Search Fonts", key="font_search")
+        filtered_fonts = [f for f in AVAILABLE_FONTS if font_search.lower() in f.lower()] if font_search else AVAILABLE_FONTS
+        
+        font_family = st.selectbox(
+            "Font Family",
+            filtered_fonts,
+            index=filtered_fonts.index(st.session_state.font_preferences["font_family"]) if st.session_state.font_preferences["font_family"] in filtered_fonts else 0,
+            key="font_family_select"
+        )
+        
+        # Fonts are applied page-wide, so this one needs a full rerun
+        if st.button("Apply Font", key="apply_font"):
+            st.session_state.font_preferences = {
+                "font_family": font_family
+            }
+            save_font_preferences()
+            st.rerun()
+        
+        # Add accessibility options directly (not in another expander)
+        st.markdown("---")
+        st.markdown("**Accessibility Options**")
+        
+        # Initialize accessibility state if needed
+        if 'accessibility' not in st.session_state:
+            st.session_state.accessibility = {
+                'high_contrast': False
+            }
+        
+        # High contrast mode
+        high_contrast = st.checkbox(
+            "High Contrast Mode", 
+            value=st.session_state.accessibility.get('high_contrast', False),
+            key="high_contrast",
+            help="Increases color contrast for better visibility"
+        )
+        
+        # Apply settings button
+        if st.button("Apply Settings", key="apply_accessibility"):
+            st.session_state.accessibility = {
+                'high_contrast': high_contrast
+            }
+            save_accessibility_preferences()
+            st.rerun()
+
+@st.fragment
+@profiled
+def render_upload_panel():
+    with st.expander("**File Upload**", expanded=False): 
+        st.markdown("**ALWAYS** upload one file at a time.")
+        clipboard_file = handle_clipboard_data()
+        if clipboard_file:
+            st.session_state.uploaded_files.append(clipboard_file)
+        pasted_files = [file for file in st.session_state.uploaded_files if file.source == "paste"]
+        uploaded_files = st.file_uploader(
+            "Upload files to analyze", 
+            type=[
+                'png', 'jpg', 'jpeg', 'gif', 'bmp', 'webp', 'tiff',
+                'mp4', 'avi', 'mov', 'mkv', 'webm',
+                'mp3', 'wav', 'ogg', 'm4a',
+                'pdf', 'doc', 'docx', 'txt', 'csv', 'xlsx', 'json', 'xml'
+            ],
+            accept_multiple_files=True
+        )
+
+        if uploaded_files:
+            oversized_files = []
+            valid_files = []
+            
+            for file in uploaded_files:
+                if file.size > 100 * 1024 * 1024:  # 100MB limit
+                    oversized_files.append(file.name)
+                else:
+                    valid_files.append(file)
+            
+            if oversized_files:
+                st.warning(f"Files exceeding 100MB limit: {', '.join(oversized_files)}")
+            
+            st.session_state.uploaded_files = spool_uploads(valid_files) + pasted_files
+            get_upload_store().release(st.session_state.session_id, keep=attached_digests())
+        
+        # A file the global quota had to delete is detached here rather than failing the next send
+        missing = [file for file in st.session_state.uploaded_files if not file.exists()]
+        if missing:
+            st.session_state.uploaded_files = [file for file in st.session_state.uploaded_files if file.exists()]
+            st.warning(f"{', '.join(file.name for file in missing)} expired from the server; add it again to use it.")
+
+        if FFMPEG_PATH and any(detect_file_type(file).startswith('video/') for file in st.session_state.uploaded_files):
+            st.radio(
+                "Video handling",
+                VIDEO_MODES,
+                key="video_mode",
+                help="Keyframes + transcript sends scene-change frames and the spoken audio as text, which is much faster than the full video."
+            )
+
+@st.fragment
+@profiled
+def render_camera_panel():
+    with st.expander("**Camera Input**", expanded=False): 
+        camera_enabled = st.checkbox("Enable camera", value=st.session_state.camera_enabled)
+        
+        if camera_enabled != st.session_state.camera_enabled:
+            st.session_state.camera_enabled = camera_enabled
+            st.session_state.camera_image = None
+            
+        if st.session_state.camera_enabled:
+            camera_image = st.camera_input("Take a picture")
+            if camera_image is not None:
+                st.session_state.camera_image = camera_image
+                st.image(camera_image, caption="Captured Image")
+                st.success("Image captured! You can now ask about the image.")
+
+# Callbacks update state before the panel redraws, so no extra rerun is needed
+def reset_command_selection():
+    st.session_state.current_command = None
+    st.session_state.fan_out_commands = []
+
+def toggle_command(cmd):
+    if st.session_state.get("fan_out_mode"):
+        selected = st.session_state.fan_out_commands
+        if cmd in selected:
+            selected.remove(cmd)
+        elif len(selected) < FAN_OUT_MAX_COMMANDS:
+            selected.append(cmd)
+        return
+    if st.session_state.current_command == cmd:
+        st.session_state.current_command = None
+    else:
+        st.session_state.current_command = cmd
+
+def toggle_command_help(cmd):
+    help_key = f"help_{cmd}"
+    if st.session_state.get(help_key):
+        del st.session_state[help_key]
+    else:
+        st.session_state[help_key] = True
+
+def toggle_custom_command_form():
+    st.session_state.show_custom_cmd_form = not st.session_state.show_custom_cmd_form
+
+def save_custom_command():
+    state = st.session_state
+    name = state.custom_cmd_name.strip().lower()
+    # Only Platinum users publish commands for everyone; the rest belong to this browser's session cookie
+    owner = SHARED_COMMAND_OWNER if state.get("custom_cmd_shared") and state.access_level == "Platinum" else state.session_id
+    try:
+        if not state.custom_cmd_template.strip():
+            raise ValueError("The template is empty")
+        command = Command(
+            name, name, state.custom_cmd_description.strip(), state.custom_cmd_template,
+            f" ----- **Active Command:** {name} ----- ",
+            options=parse_command_options(state.custom_cmd_options),
+            settings={
+                "tier": None if state.custom_cmd_tier == "Automatic" else state.custom_cmd_tier,
+                "temperature": state.custom_cmd_temperature,
+                "max_output_tokens": int(state.custom_cmd_max_tokens) if state.custom_cmd_max_tokens else None,
+                "map_reduce": state.custom_cmd_map_reduce,
+                "deadline": float(state.custom_cmd_deadline) if state.custom_cmd_deadline else None,
+                "per_item": state.custom_cmd_per_item,
+            },
+        )
+        get_command_registry().save(command, owner)
+    except ValueError as e:
+        state.custom_cmd_error = str(e)
+        return
+    state.custom_cmd_error = None
+    state.show_custom_cmd_form = False
+
+def delete_custom_command(name, owner):
+    get_command_registry().delete(name, owner)
+    if st.session_state.current_command == name:
+        st.session_state.current_command = None
+    if name in st.session_state.fan_out_commands:
+        st.session_state.fan_out_commands.remove(name)
+
+def render_command_button(command, can_delete=False):
+    columns = st.columns([3, 1, 1] if can_delete else [4, 1])
+    
+    with columns[0]:
+        button_active = st.session_state.current_command == command.name or command.name in st.session_state.fan_out_commands
+        st.button(
+            command.title,
+            key=f"cmd_{command.name}",
+            type="primary" if button_active else "secondary",
+            on_click=toggle_command,
+            args=(command.name,)
+        )
+    
+    with columns[1]:
+        # Only open help panels keep a flag in session state
+        help_open = st.session_state.get(f"help_{command.name}", False)
+        button_text = "×" if help_open else "?"
+        st.button(button_text, key=f"help_btn_{command.name}", on_click=toggle_command_help, args=(command.name,))
+    
+    if can_delete:
+        with columns[2]:
+            st.button("🗑", key=f"delete_cmd_{command.name}", on_click=delete_custom_command, args=(command.name, command.owner))
+    
+    if help_open:
+        st.info(command.description or command.template_text)
+
+def render_custom_command_form():
+    with st.form("custom_cmd_form"):
+        st.text_input("Name", key="custom_cmd_name", placeholder="/mycommand")
+        st.text_input("Description", key="custom_cmd_description")
+        st.text_area(
+            "Prompt template",
+            key="custom_cmd_template",
+            help="{input} is replaced by your message, {attachments} by the attached file names and {options} by the options below. Without {input}, your message is added at the end."
+        )
+        st.text_area("Options", key="custom_cmd_options", help="One name: value per line, inserted at {options}")
+        st.selectbox("Model", ["Automatic"] + list(MODEL_ROUTES), key="custom_cmd_tier")
+        st.number_input("Temperature", min_value=0.0, max_value=2.0, value=None, step=0.1, key="custom_cmd_temperature", placeholder="Default")
+        st.number_input("Max output tokens", min_value=1, max_value=8192, value=None, step=256, key="custom_cmd_max_tokens", placeholder="Default")
+        st.number_input("Time limit (seconds)", min_value=5, max_value=600, value=None, step=5, key="custom_cmd_deadline", placeholder="Default")
+        st.checkbox("Condense book-length documents first", key="custom_cmd_map_reduce")
+        st.checkbox("Answer each item of a list separately", key="custom_cmd_per_item")
+        if st.session_state.access_level == "Platinum":
+            st.checkbox("Share with everyone", key="custom_cmd_shared")
+        st.form_submit_button("Save command", on_click=save_custom_command)
+    
+    if st.session_state.get("custom_cmd_error"):
+        st.error(st.session_state.custom_cmd_error)
+
+@st.fragment
+@profiled
+def render_prebuilt_commands_panel():
+    with st.expander("**Prebuilt Commands**", expanded=False): 
+        if 'current_command' not in st.session_state:
+            st.session_state.current_command = None
+            
+        st.toggle(
+            "Run several commands at once",
+            key="fan_out_mode",
+            on_change=reset_command_selection,
+            help=f"Pick up to {FAN_OUT_MAX_COMMANDS} commands; they run side by side on the same message and attachments"
+        )
+        if st.session_state.get("fan_out_mode"):
+            st.write("**Active:**", ", ".join(st.session_state.fan_out_commands) or "None")
+        else:
+            st.write("**Active:**", st.session_state.current_command if st.session_state.current_command else "None")
+        
+        registry = get_command_registry()
+        for command in registry.builtins.values():
+            render_command_button(command)
+        
+        custom_commands = registry.visible(st.session_state.session_id)
+        if custom_commands:
+            st.markdown("**Custom Commands**")
+            for command in custom_commands:
+                can_delete = command.owner == st.session_state.session_id or st.session_state.access_level == "Platinum"
+                render_command_button(command, can_delete)
+        
+        st.button(
+            "Cancel" if st.session_state.show_custom_cmd_form else "New custom command",
+            key="toggle_custom_cmd_form",
+            on_click=toggle_custom_command_form
+        )
+        if st.session_state.show_custom_cmd_form:
+            render_custom_command_form()
+
+@st.fragment
+@profiled
+def render_memory_panel():
+    with st.expander("**Server Status**", expanded=False):
+        registry = get_session_registry()
+        if st.button("Measure now", key="measure_sessions"):
+            registry.sweep()
+        rows, total = registry.snapshot()
+        rss = process_rss()
+        st.caption(
+            f"{len(rows)} sessions, {format_bytes(total)} of session state, "
+            f"process RSS {format_bytes(rss) if rss else 'n/a'}"
+        )
+        last_sweep = datetime.fromtimestamp(registry.last_sweep).strftime("%H:%M:%S") if registry.last_sweep else "not yet"
+        st.caption(f"Sessions idle for {SESSION_IDLE_SECONDS // 60} min are trimmed. Last sweep: {last_sweep}")
+        if rows:
+            st.dataframe(pd.DataFrame(rows), hide_index=True)
+        
+        flight_stats = get_single_flight().stats
+        st.caption(
+            f"Model calls: {flight_stats['upstream']} sent, {flight_stats['coalesced']} shared with an identical "
+            f"in-flight request (~{flight_stats['coalesced_input_tokens']} input tokens saved)"
+        )
+        if st.button("Usage & cost", key="open_usage_dashboard"):
+            show_usage_dashboard()
+        
+        if PROFILE_ENABLED:
+            profiler = get_rerun_profiler()
+            st.caption(f"Rerun profile: {profiler.runs} full reruns across all sessions")
+            st.dataframe(profiler.table(), hide_index=True)
+            st.download_button(
+                "Download flamegraph (wall time)", profiler.folded("wall"),
+                file_name="rerun.wall.folded", key="download_rerun_profile"
+            )
+
+USAGE_RANGES = {"Last 24 hours": 1, "Last 7 days": 7, "Last 30 days": 30, "Last 90 days": 90}
+
+@st.dialog("Usage & Cost", width="large")
+def show_usage_dashboard():
+    days = USAGE_RANGES[st.selectbox("Range", list(USAGE_RANGES), index=1, key="usage_range")]
+    store = get_usage_store()
+    since = time.time() - days * 86400
+    totals = store.rollup(since, ["access_level"])
+    if totals.empty:
+        st.info("No model requests recorded in this range.")
+        return
+    
+    columns = st.columns(4)
+    columns[0].metric("Requests", f"{int(totals['requests'].sum()):,}")
+    columns[1].metric("Input tokens", f"{int(totals['prompt_tokens'].sum()):,}")
+    columns[2].metric("Output tokens", f"{int(totals['output_tokens'].sum()):,}")
+    columns[3].metric("Cost", f"${totals['cost'].sum():,.2f}")
+    
+    # Hourly buckets for a day, daily buckets otherwise
+    over_time = store.rollup(since, ["hour", "access_level"])
+    bucket = 3600 if days == 1 else 86400
+    over_time["time"] = pd.to_datetime(over_time["hour"] * 3600 // bucket * bucket, unit="s")
+    over_time["tokens"] = over_time["prompt_tokens"] + over_time["output_tokens"]
+    st.markdown("**Tokens by access level**")
+    st.bar_chart(over_time.pivot_table(index="time", columns="access_level", values="tokens", aggfunc="sum"))
+    
+    if TOKEN_BUDGETS:
+        st.caption("Daily token budgets, shared by each access level: " + ", ".join(f"{level} {limit:,}" for level, limit in TOKEN_BUDGETS.items()))
+    
+    labels = {"access_level": "Access level", "command": "Command", "tier": "Model tier", "mime_types": "Attachment types"}
+    for tab, dimension in zip(st.tabs(list(labels.values())), labels):
+        with tab:
+            table = store.rollup(since, [dimension]).sort_values("cost", ascending=False)
+            table[dimension] = table[dimension].replace("", "(none)")
+            st.dataframe(
+                table.rename(columns={dimension: labels[dimension]}),
+                hide_index=True,
+                column_config={"cost": st.column_config.NumberColumn("cost", format="$%.4f")},
+            )
+
+# Fan-out: several commands on one message share one set of attachment parts and run side by side
+FAN_OUT_MAX_COMMANDS = int(os.getenv("MAINFRAME_FAN_OUT_MAX_COMMANDS", "4"))
+
+def render_fan_out(message):
+    # The stored content is the sections back to back; each entry knows its own length
+    tabs = st.tabs([entry["title"] for entry in message["fan_out"]])
+    offset = 0
+    for tab, entry in zip(tabs, message["fan_out"]):
+        with tab:
+            st.markdown(message["content"][offset:offset + entry["length"]], unsafe_allow_html=True)
+            st.caption(route_caption(entry["route"]))
+        offset += entry["length"]
+
+@profiled
+def run_fan_out(prompt, commands):
+    attachment_names = [file.name for file in st.session_state.uploaded_files]
+    if st.session_state.camera_image:
+        attachment_names.append("camera image")
+    user_message = {"role": "user", "content": prompt + " **[" + ", ".join(command.name for command in commands) + "]**"}
+    user_bubble = st.chat_message("user")
+    user_bubble.markdown(user_message["content"])
+    
+    with st.chat_message("assistant"):
+        try:
+            try:
+                # Uploaded or inlined once, then shared by every command
+                with user_bubble:
+                    attachment_parts, attachment_tokens, attachment_mime_types, image_payload = build_attachment_parts()
+                    if image_payload["before"]:
+                        user_message["payload"] = image_payload
+                        st.caption(payload_caption(image_payload))
+            finally:
+                record_message(user_message)
+            
+            # Every command's chat session starts from the same history
+            history_tokens = estimate_history_tokens(st.session_state.chat_session.history)
+            jobs = []
+            for command in commands:
+                final_prompt = command.render(prompt, attachment_names)
+                route = route_request(
+                    estimate_tokens(final_prompt) + attachment_tokens + history_tokens, attachment_mime_types, command
+                )
+                jobs.append((command, attachment_parts + [final_prompt], route))
+            check_token_budget(sum(route["input_tokens"] for _, _, route in jobs))
+        except TokenBudgetExceeded as e:
+            st.warning(str(e))
+            return
+        except Exception as e:
+            st.error(f"An error occurred: {str(e)}")
+            st.warning("Please try again in a moment.")
+            return
+        
+        tabs = st.tabs([command.title for command, _, _ in jobs])
+        slots = []
+        for tab in tabs:
+            with tab:
+                body = st.empty()
+                body.caption("Waiting for the model...")
+                slots.append((body, st.empty()))
+        
+        # Each command gets its own chat session over the same history; the rate limiter paces them
+        history = list(st.session_state.chat_session.history)
+        results = [None] * len(jobs)
+        with ThreadPoolExecutor(max_workers=len(jobs)) as pool:
+            futures = {
+                pool.submit(
+                    send_with_route,
+                    get_route_model(route["tier"]).start_chat(history=history),
+                    parts,
+                    route,
+                    usage_tags(route["tier"], command.name, route["mime_types"]),
+                ): i
+                for i, (command, parts, route) in enumerate(jobs)
+            }
+            for future in as_completed(futures):
+                i = futures[future]
+                command, _, route = jobs[i]
+                body, caption = slots[i]
+                try:
+                    text = process_response(future.result().text)
+                except Exception as e:
+                    body.error(f"An error occurred: {str(e)}")
+                    continue
+                if command.message_text:
+                    text = f"{command.message_text}\n\n{text}"
+                body.markdown(text, unsafe_allow_html=True)
+                caption.caption(route_caption(route))
+                record_route(route)
+                results[i] = (command, route, text)
+    
+    finished = [result for result in results if result]
+    if finished:
+        record_message({
+            "role": "assistant",
+            "content": "".join(text for _, _, text in finished),
+            "fan_out": [{"title": command.title, "length": len(text), "route": route} for command, route, text in finished],
+        })
+        # Follow-up questions see the commands and their answers as one turn
+        st.session_state.chat_session.history = history + [
+            {"role": "user", "parts": attachment_parts + [user_message["content"]]},
+            {"role": "model", "parts": ["\n\n".join(f"{command.title}:\n{text}" for command, _, text in finished)]},
+        ]
+
+    if st.session_state.camera_image and not st.session_state.camera_enabled:
+        st.session_state.camera_image = None
+
+@profiled
+def build_attachment_parts():
+    # Uploads and the camera image as model parts, plus what routing and the payload caption need
+    input_parts = []
+    attachment_tokens = 0
+    attachment_mime_types = []
+    image_payload = {"before": 0, "after": 0}
+    # The route isn't chosen yet; the level's deadline also bounds server-side processing of large uploads
+    deadline = time.monotonic() + REQUEST_DEADLINES.get(st.session_state.get("access_level"), REQUEST_DEADLINE)
+    
+    if st.session_state.uploaded_files:
+        for file in st.session_state.uploaded_files:
+            mime_type = detect_file_type(file)
+            if file.source == "paste" and mime_type.startswith('image/'):
+                image_payload["before"] += file.original_size
+                image_payload["after"] += file.size
+            if mime_type.startswith('video/') and FFMPEG_PATH and st.session_state.get('video_mode', VIDEO_MODES[0]) == VIDEO_MODES[0]:
+                video_progress = st.progress(0.0, text=f"Preparing {file.name}...")
+                
+                def show_video_progress(done, total, label):
+                    video_progress.progress(done / total if total else 1.0, text=f"{label}: {done}/{total}")
+                
+                try:
+                    bundle = preprocess_video(file, show_video_progress)
+                except Exception:
+                    # Anything ffmpeg cannot condense still goes to the model as the full video
+                    bundle = None
+                    st.warning(f"{file.name} could not be condensed into keyframes, so the full video is sent instead.")
+                video_progress.empty()
+                if bundle is not None:
+                    input_parts.extend(bundle)
+                    for part in bundle:
+                        if isinstance(part, dict):
+                            attachment_tokens += IMAGE_TOKENS
+                            attachment_mime_types.append(part['mime_type'])
+                        else:
+                            attachment_tokens += estimate_tokens(part)
+                    continue
+            if mime_type in EXTRACTED_MIME_TYPES:
+                content = extract_file_text(file, mime_type)
+                if content.startswith("Error "):
+                    st.error(f"{file.name}: {content}")
+                    continue
+                input_parts.append(f"Contents of {file.name}:\n\n{content}")
+                attachment_mime_types.append(mime_type)
+                attachment_tokens += estimate_tokens(content)
+                show_file_preview(file)
+                continue
+            input_parts.append(model_part_for(file, mime_type, deadline))
+            attachment_mime_types.append(mime_type)
+            attachment_tokens += estimate_attachment_tokens(mime_type, file.size)
+            show_file_preview(file)
+    
+    if st.session_state.camera_image:
+        camera_data = st.session_state.camera_image.getvalue()
+        image_data, image_type = normalize_image(camera_data, 'image/jpeg')
+        image_payload["before"] += len(camera_data)
+        image_payload["after"] += len(image_data)
+        input_parts.append({
+            'mime_type': image_type,
+            'data': image_data
+        })
+        attachment_tokens += IMAGE_TOKENS
+        attachment_mime_types.append(image_type)
+    
+    return input_parts, attachment_tokens, attachment_mime_types, image_payload
+
+def main(): 
+    with profile_section("main"):
+        run_main()
+
+def run_main(): 
+    # Check password and get access level 
+    password_correct, access_level = check_password() 
+    if not password_correct: 
+        return 
+    
+    track_session(access_level)
+    initialize_session_state()
+
+    # Set the title based on access level 
+    title_suffix = f" ({access_level} Level)" if access_level else "" 
+    st.title(f"💬 Mainframe AI{title_suffix}") 
+
+    # Sign Out Button and Settings
+    with st.sidebar, profile_section("sidebar"):
+        
+        # Conditional display of sidebar elements 
+        if access_level: #Only show if password is correct 
+            if access_level != "Bronze": 
+                render_settings_panel()
+
+            if access_level == "Platinum": 
+                render_upload_panel()
+
+            if access_level in ["Silver", "Gold", "Platinum"]: 
+                render_camera_panel()
+
+                with st.expander("**Voice Input**", expanded=False): 
+                    audio_input = st.audio_input("Record your question")
+
+            if access_level in ["Gold", "Platinum"]: 
+                render_prebuilt_commands_panel()
+
+            if access_level == "Platinum": 
+                render_memory_panel()
+
+    # Display messages
+    if st.session_state.get('history_has_older'):
+        if st.button("Load older messages", key="load_older_messages"):
+            load_older_messages()
+            st.rerun()
+
+    with profile_section("messages"):
+        for message in st.session_state.messages:
+            with st.chat_message(message["role"]):
+                if message.get("fan_out"):
+                    render_fan_out(message)
+                    continue
+                st.markdown(message["content"], unsafe_allow_html=True)
+                if message.get("payload"):
+                    st.caption(payload_caption(message["payload"]))
+                if message.get("route"):
+                    st.caption(route_caption(message["route"]))
+
+    # Handle audio input safely
+    audio_input = None  # Initialize the variable to avoid UnboundLocalError
+    
+    if 'audio_input' in st.session_state:
+        audio_input = st.session_state.audio_input
+    
+    # Handle audio input
+    if audio_input is not None:
+        audio_hash = get_audio_hash(audio_input)
+        
+        if audio_hash != st.session_state.last_audio_hash:
+            try:
+                audio_file = save_audio_file(audio_input)
+                st.audio(audio_input, format='audio/wav')
+                
+                try:
+                    st.info("Converting speech to text...")
+                    transcribed_text = convert_audio_to_text(audio_file)
+                    
+                    st.success("Speech converted to text!")
+                    st.text(f"Transcribed text: {transcribed_text}")
+                    
+                    st.chat_message("user").markdown(transcribed_text)
+                    record_message({"role": "user", "content": transcribed_text})
+                    
+                    with st.chat_message("assistant"):
+                        message_placeholder = st.empty()
+                        route = route_request(
+                            estimate_tokens(transcribed_text) + estimate_history_tokens(st.session_state.chat_session.history)
+                        )
+                        response = send_routed_message(st.session_state.chat_session, transcribed_text, route)
+                        full_response = handle_chat_response(response, message_placeholder)
+                        st.caption(route_caption(route))
+                        record_route(route)
                         
-                        st.session_state.messages.append({
+                        record_message({
                             "role": "assistant", 
-                            "content": full_response
+                            "content": full_response,
+                            "route": route
                         })
                     
-                    st.session_state.processed_audio_hashes.add(audio_hash)
+                    st.session_state.last_audio_hash = audio_hash
                     
                 finally:
                     os.unlink(audio_file)
                     
+            except TokenBudgetExceeded as e:
+                st.warning(str(e))
             except Exception as e:
                 st.error(f"An error occurred while processing the audio: {str(e)}")
                 st.warning("Please try again or type your question instead.")
@@ -1124,61 +3915,124 @@ def main():
     # Chat input handling
     prompt = st.chat_input("What can I help you with?")
 
-    if prompt:
+    # Two or more selected commands fan out; a single one runs like any other command
+    fan_out = [command for command in map(get_command, st.session_state.fan_out_commands) if command]
+    if prompt and len(fan_out) == 1:
+        st.session_state.current_command = fan_out[0].name
+    if prompt and st.session_state.fan_out_commands:
+        st.session_state.fan_out_commands = []
+    
+    if prompt and len(fan_out) > 1:
+        run_fan_out(prompt, fan_out)
+    elif prompt:
         final_prompt = prompt
         command_suffix = ""
         command_message = ""
+        command = None
+        map_reduce_text = None
+        list_items = None
+        attachment_names = [file.name for file in st.session_state.uploaded_files]
+        if st.session_state.camera_image:
+            attachment_names.append("camera image")
         
         if hasattr(st.session_state, 'current_command') and st.session_state.current_command:
-            command = st.session_state.current_command
+            # Built-in and custom commands come from the same registry
+            command = get_command(st.session_state.current_command)
+            st.session_state.current_command = None
+        
+        if command:
+            command_suffix = f" **[{command.name}]**"
+            command_message = command.message_text
+            final_prompt = command.render(prompt, attachment_names)
             
-            # Check if it's a built-in command or custom command
-            if command in PREBUILT_COMMANDS:
-                command_prompt = PREBUILT_COMMANDS[command]["prompt"]
-                command_suffix = f" **[{command}]**"
-                command_message = PREBUILT_COMMANDS[command].get("message_text", "")
-            elif command in st.session_state.custom_commands:
-                command_prompt = st.session_state.custom_commands[command]["prompt"]
-                command_suffix = f" **[{command}]**"
-                command_message = st.session_state.custom_commands[command].get("message_text", "")
+            # Book-length input goes through map-reduce instead of one oversized request
+            if command.settings["map_reduce"]:
+                ceiling = estimate_tokens(prompt) + sum(map(document_token_ceiling, st.session_state.uploaded_files))
+                if ceiling > MAP_REDUCE_THRESHOLD_TOKENS:
+                    document_text = collect_document_text(prompt, st.session_state.uploaded_files)
+                    if estimate_tokens(document_text) > MAP_REDUCE_THRESHOLD_TOKENS:
+                        map_reduce_text = document_text
             
-            final_prompt = f"{command_prompt}\n{prompt}"
-            st.session_state.current_command = None
+            # A typed list of terms or problems goes out as one small request per item
+            if command.settings["per_item"] and not attachment_names:
+                list_items = split_list_items(prompt)
 
         input_parts = []
-        
-        if st.session_state.uploaded_files:
-            st.rerun() 
-            for file in st.session_state.uploaded_files:
-                input_parts.append({
-                    'mime_type': detect_file_type(file),
-                    'data': file.getvalue()
-                })
-                show_file_preview(file)
-        
-        if st.session_state.camera_image:
-            input_parts.append({
-                'mime_type': 'image/jpeg',
-                'data': st.session_state.camera_image.getvalue()
-            })
-
-        input_parts.append(final_prompt)
+        attachment_tokens = 0
+        attachment_mime_types = []
 
-        st.chat_message("user").markdown(prompt + command_suffix)
-        st.session_state.messages.append({"role": "user", "content": prompt + command_suffix})
+        user_message = {"role": "user", "content": prompt + command_suffix}
+        user_bubble = st.chat_message("user")
+        user_bubble.markdown(user_message["content"])
         
         with st.chat_message("assistant"):
             message_placeholder = st.empty()
             
             try:
-                response = st.session_state.chat_session.send_message(input_parts)
-                full_response = handle_chat_response(response, message_placeholder, command_message)
+                # Attachments are prepared inside the turn, so a failed upload is reported like any other error
+                try:
+                    if map_reduce_text is None:
+                        with user_bubble:
+                            input_parts, attachment_tokens, attachment_mime_types, image_payload = build_attachment_parts()
+                            if image_payload["before"]:
+                                user_message["payload"] = image_payload
+                                st.caption(payload_caption(image_payload))
+                        input_parts.append(final_prompt)
+                finally:
+                    record_message(user_message)
+                
+                checkpoint_key = None
+                if map_reduce_text is not None:
+                    progress_bar = st.progress(0.0, text="Splitting document into sections...")
+                    
+                    def show_progress(done, total, label):
+                        progress_bar.progress(done / total if total else 1.0, text=f"{label}: {done}/{total}")
+                    
+                    check_token_budget(estimate_tokens(map_reduce_text))
+                    notes, checkpoint_key = run_map_reduce(
+                        map_reduce_text, command, get_route_model(DEFAULT_ROUTE), get_rate_limiter(), show_progress,
+                        usage_tags(DEFAULT_ROUTE, command.name)
+                    )
+                    progress_bar.empty()
+                    instructions = prompt if estimate_tokens(prompt) <= MAP_REDUCE_INSTRUCTION_TOKENS else ""
+                    input_parts = [command.render(f"{instructions}\n\n{MAP_REDUCE_FINAL_NOTE}\n\n{notes}", attachment_names)]
                 
-                st.session_state.messages.append({
+                if list_items:
+                    items_bar = st.empty()
+                    
+                    def show_items(done, total):
+                        items_bar.progress(done / total, text=f"Answering items: {done}/{total}")
+                    
+                    text, route = run_list_command(st.session_state.chat_session, command, *list_items, show_items)
+                    items_bar.empty()
+                    # Items arrive all at once, so there is nothing to replay with the typing effect
+                    full_response = process_response(text)
+                    if command_message:
+                        full_response = f"{command_message}\n\n{full_response}"
+                    message_placeholder.markdown(full_response, unsafe_allow_html=True)
+                else:
+                    route = route_request(
+                        sum(estimate_tokens(part) for part in input_parts if isinstance(part, str)) + attachment_tokens
+                        + estimate_history_tokens(st.session_state.chat_session.history),
+                        attachment_mime_types,
+                        command
+                    )
+                    response = send_routed_message(st.session_state.chat_session, input_parts, route)
+                    full_response = handle_chat_response(response, message_placeholder, command_message)
+                st.caption(route_caption(route))
+                record_route(route)
+                
+                record_message({
                     "role": "assistant", 
-                    "content": full_response
+                    "content": full_response,
+                    "route": route
                 })
                 
+                if checkpoint_key:
+                    clear_checkpoint(checkpoint_key)
+                
+            except TokenBudgetExceeded as e:
+                st.warning(str(e))
             except Exception as e:
                 st.error(f"An error occurred: {str(e)}")
                 if "rate_limit" in str(e).lower():
@@ -0,0 +1,26 @@
+import os
+import sys
+
+# The app module refuses to import without a key; these tests never call the API
+os.environ.setdefault("GEMINI_API_KEY", "test")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from streamlit_app import split_batch_answers
+
+def test_answers_are_split_on_marker_lines():
+    reply = "[[1]]\nglad, cheerful\n\n[[2]]\nunhappy, gloomy\n[[3]]\nfamous"
+    assert split_batch_answers(reply, 3) == {0: "glad, cheerful", 1: "unhappy, gloomy", 2: "famous"}
+
+def test_markdown_around_markers_and_text_before_the_first_one():
+    reply = "Here are your answers.\n\n**[[1]]**\nx = 4\n\n### [[2]]\ny = 3"
+    assert split_batch_answers(reply, 2) == {0: "x = 4", 1: "y = 3"}
+
+def test_markers_inside_a_line_do_not_split():
+    assert split_batch_answers("[[1]]\nSee [[2]] below\n[[2]]\nDone", 2) == {0: "See [[2]] below", 1: "Done"}
+
+def test_skipped_empty_repeated_and_unknown_items_are_left_out():
+    reply = "[[1]]\nfirst\n[[1]]\nagain\n[[3]]\n\n[[7]]\nextra"
+    assert split_batch_answers(reply, 3) == {0: "first"}
+
+def test_reply_without_markers():
+    assert split_batch_answers("I cannot help with that.", 4) == {}
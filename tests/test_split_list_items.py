@@ -0,0 +1,56 @@
+import os
+import sys
+
+# The app module refuses to import without a key; these tests never call the API
+os.environ.setdefault("GEMINI_API_KEY", "test")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from streamlit_app import split_list_items
+
+WORD_PROBLEM = """A train leaves Chicago at 3pm traveling east at 60 miles per hour.
+A second train leaves the same station at 4pm traveling east at 80 miles per hour.
+They travel on parallel tracks without stopping.
+At what time does the second train catch up with the first?"""
+
+def test_word_problem_lines_are_not_split():
+    assert split_list_items(WORD_PROBLEM) is None
+
+def test_prose_paragraph_is_not_split():
+    text = "Photosynthesis happens in the chloroplasts.\nLight is absorbed by chlorophyll.\nWater is split.\nOxygen is released."
+    assert split_list_items(text) is None
+
+def test_equations_on_plain_lines_are_not_split():
+    assert split_list_items("Solve the system:\nx + y = 10\nx - y = 2\n2x + z = 7\ny + z = 9") is None
+
+def test_comma_separated_sentence_is_not_split():
+    assert split_list_items("I went to the store, bought milk, picked up eggs, and then came home.") is None
+
+def test_numbered_problems_keep_their_labels_and_continuations():
+    text = "Answer these:\n1. What is 2 + 2?\n2. A box holds 12 eggs.\nHow many are in 3 boxes?\n3) Solve x + 1 = 5\n4. Simplify 6/8"
+    preamble, items = split_list_items(text)
+    assert preamble == "Answer these:"
+    assert items == [
+        ("1.", "What is 2 + 2?"),
+        ("2.", "A box holds 12 eggs.\nHow many are in 3 boxes?"),
+        ("3)", "Solve x + 1 = 5"),
+        ("4.", "Simplify 6/8"),
+    ]
+
+def test_bulleted_terms():
+    preamble, items = split_list_items("- Treaty of Versailles\n- League of Nations\n* Appeasement\n• Blitzkrieg")
+    assert preamble == ""
+    assert [item for _, item in items] == ["Treaty of Versailles", "League of Nations", "Appeasement", "Blitzkrieg"]
+
+def test_plain_lines_of_terms_with_lead_in():
+    preamble, items = split_list_items("Synonyms for:\nhappy\nsad\nwell-known\ndon't")
+    assert preamble == "Synonyms for:"
+    assert [item for _, item in items] == ["happy", "sad", "well-known", "don't"]
+
+def test_comma_separated_terms_with_lead_in():
+    preamble, items = split_list_items("Define these: mitosis, meiosis; cell wall, nucleus")
+    assert preamble == "Define these:"
+    assert [item for _, item in items] == ["mitosis", "meiosis", "cell wall", "nucleus"]
+
+def test_too_few_or_too_many_items():
+    assert split_list_items("apple, banana, cherry") is None
+    assert split_list_items("\n".join(f"{i}. item" for i in range(1, 200))) is None